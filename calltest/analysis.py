@@ -0,0 +1,411 @@
+"""
+This module analyses recorded audio.
+
+A recording is measured by itself (level, silence, clipping, tones,
+in-band DTMF) and, if the sound file that the other side played is
+available, compared with it: where the sound starts in the recording,
+and how similar the two are.
+
+This requires NumPy. WAV files are memory-mapped and processed in
+blocks, so long recordings don't need to fit in RAM. The analysis runs
+in a pool of worker processes, so it doesn't block the event loop.
+
+The measurements are a pipeline of generator stages, so
+:mod:`calltest.media` uses them for streamed audio as well.
+"""
+
+import anyio
+import math
+import os
+import struct
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+BLOCK = 1<<16  # samples to process at a time
+
+DTMF_LOW = (697, 770, 852, 941)
+DTMF_HIGH = (1209, 1336, 1477, 1633)
+DTMF_KEYS = ("123A", "456B", "789C", "*0#D")  # [low][high]
+DTMF_FRAME = 0.01  # seconds; a digit must fill two frames
+DTMF_TWIST = 8  # dB, max difference between a digit's two tones
+DTMF_SHARE = 0.7  # min part of a frame's power in a digit's tones
+
+_pool = None
+
+
+class AudioError(RuntimeError):
+    """A recording didn't match the test's requirements."""
+    def __init__(self, name, what, value, limit):
+        self.name = name
+        self.what = what
+        self.value = value
+        self.limit = limit
+
+    def __str__(self):
+        return "AudioError(%s: %s %.3g, limit %.3g)" % (self.name, self.what, self.value, self.limit)
+
+
+def read_wav(path):
+    """
+    Memory-map a 16-bit PCM WAV file.
+
+    Returns the first channel's samples, and the sample rate.
+    """
+    import numpy as np
+
+    with open(path, "rb") as f:
+        hdr = f.read(12)
+        if hdr[:4] != b"RIFF" or hdr[8:12] != b"WAVE":
+            raise ValueError("%s: not a WAV file" % (path,))
+        fmt = None
+        while True:
+            chunk = f.read(8)
+            if len(chunk) < 8:
+                raise ValueError("%s: no data" % (path,))
+            cid, size = struct.unpack("<4sI", chunk)
+            if cid == b"data":
+                offset = f.tell()
+                break
+            if cid == b"fmt ":
+                fmt = struct.unpack("<HHIIHH", f.read(16))
+                size -= 16
+            f.seek(size + (size & 1), 1)
+    if fmt is None or fmt[0] != 1 or fmt[5] != 16:
+        raise ValueError("%s: not 16-bit PCM" % (path,))
+    channels, rate = fmt[1], fmt[2]
+
+    # the header's size may be wrong if the file wasn't closed properly
+    n = min(size, os.path.getsize(path)-offset) // (2*channels)
+    if n == 0:
+        return np.zeros(0, dtype="<i2"), rate
+    data = np.memmap(path, dtype="<i2", mode="r", offset=offset, shape=(n, channels))
+    return data[:, 0], rate
+
+
+def stage(proc):
+    """
+    Decorator for a pipeline stage: a generator that's sent data with
+    ``send()``. Calling the decorated function returns the started stage.
+    """
+    def start(*a, **kw):
+        g = proc(*a, **kw)
+        next(g)
+        return g
+    return start
+
+
+@stage
+def framer(n, *targets):
+    """
+    A stage that's sent 16-bit samples, in arrays of any size, and sends
+    the whole frames of ``n`` samples in them to the ``targets``, as
+    (frames x n) arrays of floats. At most one partial frame is kept.
+    """
+    import numpy as np
+
+    rest = np.zeros(0)
+    while True:
+        x = yield
+        x = np.concatenate((rest, np.asarray(x, dtype=np.float64) / 32768))
+        m = len(x) // n
+        if m:
+            b = x[:m*n].reshape(m, n)
+            for t in targets:
+                t.send(b)
+        rest = x[m*n:]
+
+
+@stage
+def level_meter(res, gate, clip):
+    """
+    Sets ``res["level"]``, the average power (dBFS) of the frames with
+    at least ``gate`` dBFS, and ``res["clipping"]``, the fraction of
+    samples with an absolute value of ``clip`` or more.
+    """
+    import numpy as np
+
+    gate = 10**(gate/10)
+    clip = clip/32768
+    n = n_loud = n_clip = 0
+    power = 0.0
+    res["level"] = None
+    res["clipping"] = 0.0
+    while True:
+        b = yield
+        p = (b*b).mean(axis=1)
+        loud = p >= gate
+        n += b.size
+        n_loud += int(loud.sum())
+        power += float(p[loud].sum())
+        n_clip += int((np.abs(b) >= clip).sum())
+        res["level"] = _db(power/n_loud) if n_loud else None
+        res["clipping"] = n_clip/n
+
+
+@stage
+def silence_detector(res, threshold, frame):
+    """
+    Sets ``res["silence"]``, the fraction of frames with less than
+    ``threshold`` dBFS, and ``res["silence_max"]``, the longest
+    stretch of them in seconds. ``frame`` is a frame's length.
+    """
+    import numpy as np
+
+    threshold = 10**(threshold/10)
+    n = n_silent = run = longest = 0
+    res["silence"] = 1.0
+    res["silence_max"] = 0.0
+    while True:
+        b = yield
+        silent = (b*b).mean(axis=1) < threshold
+        n += len(b)
+        n_silent += int(silent.sum())
+        # the longest run of silent frames, including the one that
+        # continues from the previous block
+        edges = np.flatnonzero(np.diff(np.concatenate(([0], silent.view(np.int8), [0]))))
+        starts, stops = edges[0::2], edges[1::2]
+        for a, e in zip(starts, stops):
+            run = run+e-a if a == 0 else e-a
+            longest = max(longest, run)
+        if not silent[-1]:
+            run = 0
+        res["silence"] = n_silent/n
+        res["silence_max"] = float(longest*frame)
+
+
+@stage
+def tone_detector(res, rate, n, tones, gate):
+    """
+    Sets ``res["tones"]``: for each of these frequencies (Hz), the
+    fraction of frames with at least ``gate`` dBFS that contain it,
+    i.e. that have at least half of their power at that frequency.
+    """
+    import numpy as np
+
+    tones = list(tones)
+    gate = 10**(gate/10)
+    # a single-bin DFT per tone, i.e. Goertzel's algorithm, applied to
+    # all frames of a block at once
+    t = np.arange(n) / rate
+    bins = np.exp(-2j*np.pi*np.outer(t, tones))
+    n_loud = 0
+    n_tone = np.zeros(len(tones), dtype=np.int64)
+    res["tones"] = {f: 0.0 for f in tones}
+    while True:
+        b = yield
+        if not tones:
+            continue
+        p = (b*b).mean(axis=1)
+        loud = p >= gate
+        if not loud.any():
+            continue
+        tp = np.abs(b[loud] @ bins)**2 * 2 / n / n
+        n_tone += (tp >= p[loud, None] / 2).sum(axis=0)
+        n_loud += int(loud.sum())
+        res["tones"] = {f: c/n_loud for f, c in zip(tones, n_tone.tolist())}
+
+
+@stage
+def dtmf_detector(res, rate, n, gate, on_digit=None):
+    """
+    Decodes in-band DTMF. Appends ``(digit, onset, level)`` to
+    ``res["dtmf"]`` for each digit: when it started (seconds from the
+    start of the audio) and the power of its tones (dBFS). Also calls
+    ``on_digit`` with these, if given.
+
+    A frame contains a digit if at least ``DTMF_SHARE`` of its power,
+    which must be at least ``gate`` dBFS, is in the strongest low and
+    high DTMF tone, neither of which is more than ``DTMF_TWIST`` dB
+    stronger than the other. The digit starts when two consecutive
+    frames contain it, and ends when two consecutive frames don't. A
+    digit that's already there when the audio starts is ignored, as its
+    onset isn't known.
+    """
+    import numpy as np
+
+    gate = 10**(gate/10)
+    twist = 10**(DTMF_TWIST/10)
+    keys = np.array([k for row in DTMF_KEYS for k in row])
+    t = np.arange(n) / rate
+    bins = np.exp(-2j*np.pi*np.outer(t, DTMF_LOW + DTMF_HIGH))
+
+    pos = 0  # frames seen so far
+    cur = -1  # the digit we're in, as an index into keys
+    cand = -1  # what the last frames contained
+    cnt = 0  # ... this many of them
+    start = 0  # ... starting at this frame
+    res["dtmf"] = []
+    while True:
+        b = yield
+        p = (b*b).mean(axis=1)
+        tp = np.abs(b @ bins)**2 * 2 / n / n
+        lo, hi = tp[:, :4], tp[:, 4:]
+        li, hj = lo.argmax(axis=1), hi.argmax(axis=1)
+        fr = np.arange(len(b))
+        pl, ph = lo[fr, li], hi[fr, hj]
+        lvl = pl + ph
+        ok = (p >= gate) & (lvl >= DTMF_SHARE*p) & (pl*twist >= ph) & (ph*twist >= pl)
+        code = np.where(ok, li*4 + hj, -1)
+
+        # walk the runs of equal codes, not the frames
+        edges = np.flatnonzero(code[1:] != code[:-1]) + 1
+        for a, e in zip(np.concatenate(([0], edges)), np.concatenate((edges, [len(b)]))):
+            c = int(code[a])
+            if c == cand and a == 0:
+                cnt += e-a
+            else:
+                cand, cnt, start = c, int(e-a), pos+int(a)
+            if cnt >= 2 and cand != cur:
+                cur = cand
+                if cur >= 0 and start > 0:
+                    d = (str(keys[cur]), start*n/rate, _db(float(lvl[start+1-pos])))
+                    res["dtmf"].append(d)
+                    if on_digit is not None:
+                        on_digit(*d)
+        pos += len(b)
+
+
+@stage
+def tee(*targets):
+    """
+    A stage that sends whatever it's sent to all ``targets``.
+    """
+    while True:
+        x = yield
+        for t in targets:
+            t.send(x)
+
+
+def _db(power):
+    return 10*math.log10(power) if power > 0 else None
+
+
+def pipeline(res, rate, frame=0.02, silence=-50, clip=32000, tones=(), dtmf=False, on_digit=None):
+    """
+    Returns a stage that's sent 16-bit samples at this rate and measures
+    them; the results are in ``res``. See :func:`measure`.
+
+    ``on_digit`` is passed to :func:`dtmf_detector`.
+    """
+    n = max(1, int(frame*rate))
+    p = framer(n,
+            level_meter(res, silence, clip),
+            silence_detector(res, silence, n/rate),
+            tone_detector(res, rate, n, tones, silence))
+    if not dtmf:
+        return p
+    m = int(DTMF_FRAME*rate)
+    return tee(p, framer(m, dtmf_detector(res, rate, m, silence, on_digit)))
+
+
+def measure(x, rate, frame=0.02, silence=-50, clip=32000, tones=(), dtmf=False):
+    """
+    Level, silence and clipping of these samples, and how often each of
+    these tones is present.
+
+    :param frame: length of the frames to judge, in seconds.
+    :param silence: frames with less power (dBFS) are silent.
+    :param clip: samples with this absolute value or more are clipped.
+    :param tones: frequencies (Hz) to look for. A frame contains a tone
+                  if at least half of its power is at that frequency.
+    :param dtmf: decode in-band DTMF digits.
+
+    Returns a dict with ``duration``, ``level`` (the average power of
+    the frames that aren't silent, in dBFS, or ``None``), ``silence`` and
+    ``clipping`` (the fraction of silent frames and of clipped samples),
+    ``silence_max`` (the longest silence, in seconds) and ``tones``
+    (frequency > fraction of frames that aren't silent). With ``dtmf``,
+    ``dtmf`` lists the digits, see :func:`dtmf_detector`.
+    """
+    res = {}
+    p = pipeline(res, rate, frame=frame, silence=silence, clip=clip, tones=tones, dtmf=dtmf)
+    for i in range(0, len(x), BLOCK):
+        p.send(x[i:i+BLOCK])
+    res["duration"] = len(x)/rate
+    return res
+
+
+def check(audio, name, res):
+    """
+    Raise :cls:`AudioError` if these results of measuring recording
+    ``name`` violate the limits in this ``audio`` config.
+    """
+    if audio.max_silence is not None and res["silence"] > audio.max_silence:
+        raise AudioError(name, "silence", res["silence"], audio.max_silence)
+    if audio.max_clipping is not None and res["clipping"] > audio.max_clipping:
+        raise AudioError(name, "clipping", res["clipping"], audio.max_clipping)
+    sim = res.get("similarity")
+    if audio.min_similarity is not None and sim is not None and sim < audio.min_similarity:
+        raise AudioError(name, "similarity", sim, audio.min_similarity)
+
+
+def correlate(x, ref, max_offset):
+    """
+    Find ``ref`` in ``x``, starting within the first ``max_offset``
+    samples.
+
+    Returns the offset, and the normalized cross-correlation there:
+    1 if the samples are identical there (up to their volume), about 0
+    if they're unrelated.
+    """
+    import numpy as np
+
+    m = len(ref)
+    x = np.asarray(x[:max_offset+m], dtype=np.float64)
+    ref = np.asarray(ref, dtype=np.float64)
+    if m == 0 or len(x) < m:
+        return None, 0.0
+    size = 1 << (len(x)+m-1).bit_length()
+    c = np.fft.irfft(np.fft.rfft(x, size) * np.conj(np.fft.rfft(ref, size)), size)[:len(x)-m+1]
+
+    # the energy of each window of x
+    e = np.cumsum(np.concatenate(([0.0], x*x)))
+    e = e[m:] - e[:-m]
+    norm = np.sqrt(np.maximum(e, 1e-9) * float(ref @ ref))
+    c = np.abs(c) / norm
+    i = int(np.argmax(c))
+    return i, float(min(c[i], 1.0))
+
+
+def analyze(path, ref=None, frame=0.02, silence=-50, clip=32000, tones=(), max_delay=5, dtmf=False):
+    """
+    Analyse the recording in the WAV file at ``path``; see :func:`measure`.
+
+    If ``ref``, the WAV file that was played into the recording, is
+    given, the result also contains ``offset``, the position of that
+    sound in the recording (seconds), and ``similarity``, the normalized
+    cross-correlation there. ``max_delay`` limits the search, in
+    seconds.
+    """
+    x, rate = read_wav(path)
+    res = measure(x, rate, frame=frame, silence=silence, clip=clip, tones=tones, dtmf=dtmf)
+    if ref is not None:
+        r, r_rate = read_wav(ref)
+        if r_rate != rate:
+            raise ValueError("%s: sample rate %d, %s has %d" % (ref, r_rate, path, rate))
+        offset, res["similarity"] = correlate(x, r, int(max_delay*rate))
+        res["offset"] = offset/rate if offset is not None else None
+    return res
+
+
+def _get_pool(workers):
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn"))
+    return _pool
+
+
+async def run_analysis(cfg, path, ref=None, dtmf=False):
+    """
+    Run :func:`analyze` in a worker process.
+
+    :param cfg: the ``analysis`` section of the configuration.
+    """
+    fut = _get_pool(cfg.workers).submit(analyze, path, ref, frame=cfg.frame,
+            silence=cfg.silence, clip=cfg.clip, tones=tuple(cfg.tones), max_delay=cfg.max_delay,
+            dtmf=dtmf)
+    try:
+        return await anyio.run_in_thread(fut.result, cancellable=True)
+    except BaseException:
+        fut.cancel()
+        raise
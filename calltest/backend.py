@@ -0,0 +1,187 @@
+"""
+This module manages the connections to one or more Asterisk servers.
+"""
+
+import anyio
+import asyncari
+
+from .model import assign_groups
+from .util import attrdict, combine_dict
+
+import logging
+logger = logging.getLogger(__name__)
+
+DEFAULT_BACKEND = "default"
+
+
+class BackendDown(ConnectionError):
+    """There's no ARI connection to this Asterisk server."""
+    def __init__(self, backend):
+        super().__init__(backend.name)
+        self.backend = backend
+
+    def __str__(self):
+        return "BackendDown(%s)" % (self.backend.name,)
+
+
+class Backend:
+    """
+    One Asterisk server. Keeps an ARI client connected to it.
+
+    :param name: The backend's name.
+    :param cfg: The global configuration. Its ``asterisk`` section is
+                specific to this backend.
+    """
+    client = None
+    fake = None  # the simulated server, if asterisk.fake is enabled
+    n_calls = 0
+    running = False
+
+    def __init__(self, name, cfg):
+        self.name = name
+        self.cfg = cfg
+        self._up = None
+
+    def __repr__(self):
+        return "<%s:%s>" % (self.__class__.__name__,self.name)
+
+    async def run(self):
+        """
+        Connect to Asterisk, reconnect when the connection fails.
+        Never returns.
+        """
+        ast = self.cfg.asterisk
+        url = "http://%s:%d/" % (ast.host,ast.port)
+        if self._up is None:
+            self._up = anyio.create_event()
+        if ast.fake.enabled and self.fake is None:
+            from .fakeari import FakeAsterisk
+            self.fake = FakeAsterisk(self.cfg)
+        while True:
+            try:
+                if self.fake is not None:
+                    conn = self.fake.connect(url, ast.app)
+                else:
+                    conn = asyncari.connect(url, ast.app, username=ast.username, password=ast.password)
+                async with conn as client:
+                    client._calltest_config = self.cfg
+                    # the event websocket is opened in the background;
+                    # don't run tests, or check it, before it's there
+                    async with anyio.fail_after(ast.init_timeout):
+                        while not client.websockets:
+                            await anyio.sleep(0.01)
+                    self.client = client
+                    await self._up.set()
+                    logger.info("Connected: %s", self.name)
+                    try:
+                        while client.websockets:
+                            await anyio.sleep(ast.reconnect)
+                        logger.error("Connection lost: %s", self.name)
+                    finally:
+                        # don't leave idle bridges behind
+                        pool = getattr(client, "_calltest_bridges", None)
+                        if pool is not None:
+                            async with anyio.move_on_after(2, shield=True):
+                                await pool.close()
+            except anyio.get_cancelled_exc_class():
+                raise
+            except Exception as exc:
+                logger.error("Connection to %s failed: %r", self.name, exc)
+            finally:
+                self.client = None
+                if self._up.is_set():
+                    self._up = anyio.create_event()
+            await anyio.sleep(ast.reconnect)
+
+    async def get_client(self):
+        """
+        Return this backend's ARI client.
+
+        Waits for ``asterisk.init_timeout`` seconds if it's not connected.
+        """
+        if self.client is None:
+            if self._up is None:
+                self._up = anyio.create_event()
+            async with anyio.move_on_after(self.cfg.asterisk.init_timeout):
+                await self._up.wait()
+            if self.client is None:
+                raise BackendDown(self)
+        return self.client
+
+
+class Backends:
+    """
+    All Asterisk servers, plus the assignment of links to them.
+
+    Links that are used by the same test are always assigned to the same
+    server. Links without an explicit ``backend`` are distributed so
+    that every server runs about the same number of tests.
+
+    :param cfg: The global configuration.
+    :param links: The links to assign.
+    :param calls: The tests that will be run.
+    """
+    def __init__(self, cfg, links, calls):
+        ast = attrdict((k,v) for k,v in cfg.asterisk.items() if k != "backends")
+        backends = cfg.asterisk.backends or {DEFAULT_BACKEND: {}}
+        self.backends = {}
+        self._tg = None
+        for name,bcfg in backends.items():
+            bcfg = combine_dict(bcfg, ast, cls=attrdict)
+            self.backends[name] = Backend(name, combine_dict(attrdict(asterisk=bcfg), cfg, cls=attrdict))
+        self._assign(links, calls)
+
+    def _assign(self, links, calls):
+        def pin(l):
+            res = set() if l.backend is None else {l.backend}
+            if l._backend is not None:
+                res.add(l._backend.name)
+            return res
+
+        load = {name: b.n_calls for name, b in self.backends.items()}
+        for name, g_links, g_calls in assign_groups(calls, links, load, pin, "backend"):
+            b = self.backends[name]
+            b.n_calls += len(g_calls)
+            for l in g_links:
+                l._backend = b
+
+    async def add(self, links, calls):
+        """
+        Assign these new links and tests to a backend, and connect to it
+        if necessary.
+        """
+        self._assign(links, calls)
+        if self._tg is not None:
+            for b in self.backends.values():
+                if b.n_calls and not b.running:
+                    await self._start(b)
+
+    def remove(self, calls):
+        """
+        These tests are no longer used.
+        """
+        for c in calls:
+            link = c.src if c.src is not None else c.dst
+            if link is not None and link._backend is not None:
+                link._backend.n_calls -= 1
+
+    async def _start(self, b):
+        b.running = True
+        await self._tg.spawn(b.run)
+
+    async def run(self):
+        """
+        Keep all backends that have tests connected. Never returns.
+        """
+        async with anyio.create_task_group() as tg:
+            self._tg = tg
+            for b in self.backends.values():
+                if b.n_calls:
+                    await self._start(b)
+
+    async def client_for(self, call):
+        """
+        Return the ARI client to use for this test.
+        """
+        link = call.src if call.src is not None else call.dst
+        return await link._backend.get_client()
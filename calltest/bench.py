@@ -0,0 +1,122 @@
+"""
+This module benchmarks calltest against a simulated Asterisk.
+
+A number of links, each with a number of tests, is run through
+:func:`calltest.server.serve` for a while, with :mod:`calltest.fakeari`
+standing in for Asterisk. The results show how much calltest itself
+costs: how late the scheduler starts tests, how long ARI events take to
+be processed, and CPU time and memory per test.
+"""
+
+import anyio
+import copy
+import gc
+import resource
+import time
+import tracemalloc
+
+from .default import DEFAULT
+from .model import gen_links, gen_calls
+from .registry import get_mode, ConfigError
+from .util import attrdict, percentile
+
+
+def bench_cfg(cfg, n_links, n_checks, mode="call", interval=10):
+    """
+    Return a copy of this configuration, with a simulated Asterisk and
+    ``n_links`` links with ``n_checks`` tests each.
+
+    Each test calls its own number. Tests in modes that answer calls
+    call their own link; the others call a simulated phone.
+    """
+    ends = get_mode(mode).ends
+    if "src" not in ends:
+        raise ConfigError("Mode %s only answers calls, it can't be benchmarked" % (mode,))
+
+    cfg = copy.deepcopy(cfg)
+    cfg.asterisk.fake.enabled = True
+    numbers = cfg.asterisk.fake.numbers = {}
+    links = cfg.links = {DEFAULT: cfg.links[DEFAULT]}
+    calls = cfg.calls = {DEFAULT: cfg.calls[DEFAULT]}
+    for i in range(n_links):
+        name = "bench%d" % i
+        nr = "1%05d" % i
+        links[name] = attrdict(channel="Fake/%s/{number}" % name, number=nr, capacity=2*n_checks)
+        for j in range(n_checks):
+            c = attrdict(src=name, mode=mode, test=attrdict(repeat=interval, retry=interval))
+            if "dst" in ends:
+                c.dst = name
+                c.number = "%s%03d" % (nr, j)
+                numbers[c.number] = name
+            else:
+                # must not start with a link's number
+                c.number = "9%05d%03d" % (i, j)
+            calls["%s.%d" % (name, j)] = c
+    return cfg
+
+
+async def bench(cfg, n_links=10, n_checks=10, duration=60, mode="call", interval=10):
+    """
+    Run the benchmark. Returns a dict with the results.
+
+    :param duration: seconds to run the tests for.
+    :param interval: seconds between runs of each test.
+    """
+    from .server import serve, make_app
+
+    cfg = bench_cfg(cfg, n_links, n_checks, mode=mode, interval=interval)
+    links = gen_links(cfg)
+
+    # Memory: the tests plus their state in the server. The first
+    # make_app() is for importing everything.
+    make_app(cfg, {}, links)
+    gc.collect()
+    tracemalloc.start()
+    calls = gen_calls(links, cfg)
+    for c in calls.values():
+        c.setup_state()
+    app = make_app(cfg, calls, links)
+    mem = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del app
+
+    cpu = time.process_time()
+    t0 = time.monotonic()
+    async with anyio.move_on_after(duration):
+        await serve(cfg, calls, links)
+    t0 = time.monotonic() - t0
+    cpu = time.process_time() - cpu
+
+    n_run = sum(c.state.n_run for c in calls.values())
+    n_fail = sum(c.state.n_fail for c in calls.values())
+    ct_run = sum(c.state.ct_run for c in calls.values())
+    sched = next(iter(calls.values()))._sched
+
+    latency = []
+    stats = attrdict(requests=0, events=0, calls=0)
+    for b in set(l._backend for l in links.values()):
+        if b.fake is None:
+            continue
+        latency.extend(b.fake.latency)
+        for k in stats:
+            stats[k] += b.fake.stats[k]
+    latency.sort()
+
+    res = attrdict(
+        links=n_links, checks=len(calls), mode=mode, duration=t0,
+        runs=n_run, failures=n_fail,
+        rest_requests=stats.requests, events=stats.events,
+        run_time_avg=ct_run / n_run if n_run else None,
+        sched_started=sched.n_started if sched else 0,
+        sched_lag_avg=sched.lag_sum / sched.n_started if sched and sched.n_started else None,
+        sched_lag_max=sched.lag_max if sched else None,
+        event_latency_avg=sum(latency)/len(latency) if latency else None,
+        event_latency_p50=percentile(latency, 0.5),
+        event_latency_p99=percentile(latency, 0.99),
+        event_latency_max=latency[-1] if latency else None,
+        cpu=cpu,
+        cpu_per_call=cpu / n_run if n_run else None,
+        mem_per_check=mem / len(calls),
+        max_rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    )
+    return res
@@ -9,11 +9,11 @@ from functools import partial
 from collections.abc import Mapping
 
 import anyio
-import asyncari
 
-from .util import attrdict, combine_dict
+from .util import attrdict
 from .model import gen_links, gen_calls
-from .default import CFG
+from .config import load_cfg, logging_cfg, yaml_dumper
+from .registry import ConfigError
 
 import logging
 from logging.config import dictConfig
@@ -66,8 +66,9 @@ def cmd():
 )
 @click.option("-c", "--cfg", type=str, default=None, help="Configuration file (YAML).")
 @click.option("-C", "--conf", multiple=True, help="Override a config entry. Example: '-C server.bind_default.port=57586'")
+@click.option("-k", "--cache", type=str, default=None, help="Cache the parsed configuration in this file.")
 @click.pass_context
-async def main(ctx, verbose, quiet, log, cfg, conf):
+async def main(ctx, verbose, quiet, log, cfg, conf, cache):
     """
     "calltest" periodically runs calls to verify that a phone
     line is operational.
@@ -76,56 +77,20 @@ async def main(ctx, verbose, quiet, log, cfg, conf):
     """
     ctx.ensure_object(attrdict)
     ctx.obj.debug = max(verbose - quiet + 1, 0)
-    DEF = "/etc/voice/calltest.cfg"
-    
-    if cfg is None:
-        if os.path.exists(DEF):
-            cfg = open(DEF,"r")
-    elif cfg == "-":
-        cfg = None
-    else:
-        cfg = open(cfg,"r")
-
-    if cfg:
-        logger.debug("Loading %s", cfg)
-        import yaml
-
-        ctx.obj.cfg = combine_dict(yaml.safe_load(cfg), CFG, cls=attrdict)
-        cfg.close()
-    else:
-        ctx.obj.cfg = CFG
-
-    # One-Shot-Hack the config file.
-    for k in conf:
-        try:
-            k,v = k.split('=')
-        except ValueError:
-            v = NotGiven
-        else:
-            try:
-                v = eval(v)
-            except Exception:
-                pass
-        c = ctx.obj.cfg
-        *sl, s = k.split('.')
-        for k in sl:
-            c = c[k]
-        if v is NotGiven:
-            del c[s]
-        else:
-            c[s] = v
+    ctx.obj.cfg = load_cfg(cfg, conf, cache=cache)
+    ctx.obj.reload = partial(load_cfg, cfg, conf, cache=cache)
 
     # Configure logging. This is a somewhat arcane art.
-    lcfg = ctx.obj.cfg.logging
-    lcfg['root']['level'] = "DEBUG" if verbose > 2 else "INFO" if verbose > 1 else "WARNING" if verbose else "ERROR"
-    for k in log:
-        k,v = k.split('=')
-        lcfg['loggers'].setdefault(k, {})['level'] = v
+    lcfg = logging_cfg(ctx.obj.cfg, verbose, log)
+    ctx.obj.cfg = attrdict(ctx.obj.cfg, logging=lcfg)  # for the workers
     dictConfig(lcfg)
     logging.captureWarnings(verbose > 0)
 
-    ctx.obj.links = gen_links(ctx.obj.cfg)
-    ctx.obj.calls = gen_calls(ctx.obj.links, ctx.obj.cfg)
+    try:
+        ctx.obj.links = gen_links(ctx.obj.cfg)
+        ctx.obj.calls = gen_calls(ctx.obj.links, ctx.obj.cfg)
+    except ConfigError as exc:
+        raise click.UsageError(str(exc))
 
 
 @main.command(short_help="Import the debugger",
@@ -158,26 +123,117 @@ async def run(obj, checks, as_list):
             print(c.name, "m" if c.test.skip else "-", c.info, sep="\t")
         return
 
-    ast = obj.cfg.asterisk
-    url = "http://%s:%d/" % (ast.host,ast.port)
-    async with asyncari.connect(url, ast.app, username=ast.username, password=ast.password) as client:
-        client._calltest_config = obj.cfg
-        async with anyio.create_task_group() as tg:
-            for c in checks:
-                await tg.spawn(obj.calls[c], client)
+    from calltest.backend import Backends
+    calls = [obj.calls[c] for c in checks]
+    backends = Backends(obj.cfg, obj.links.values(), calls)
+    async with anyio.create_task_group() as tg:
+        await tg.spawn(backends.run)
+        async with anyio.create_task_group() as tg2:
+            for c in calls:
+                await tg2.spawn(c, backends)
+        await tg.cancel_scope.cancel()
 
 @main.command()
+@click.option("-w","--workers", type=int, default=0, help="Run the checks in this many processes")
 @click.pass_obj
-async def server(obj):
+async def server(obj, workers):
     """
     Run a server with all checks.
     """
     from calltest.server import serve
-    await serve(obj.cfg, obj.calls)
+    await serve(obj.cfg, obj.calls, obj.links, workers=workers, reload=obj.reload)
+
+@main.command()
+@click.option("-n","--links","n_links", type=int, default=10, help="Number of links")
+@click.option("-m","--checks","n_checks", type=int, default=10, help="Number of tests per link")
+@click.option("-M","--mode", default="call", help="The tests' mode")
+@click.option("-d","--duration", type=float, default=60, help="Seconds to run the tests for")
+@click.option("-i","--interval", type=float, default=10, help="Seconds between runs of each test")
+@click.option("-p","--port", type=int, default=0, help="Web server port. Default: any free port")
+@click.option("-j","--json","as_json", is_flag=True, help="Print the results as JSON")
+@click.pass_obj
+async def bench(obj, n_links, n_checks, mode, duration, interval, port, as_json):
+    """
+    Benchmark calltest against a simulated Asterisk.
+
+    The configuration's links and tests are replaced by generated ones;
+    everything else is used as-is.
+    """
+    from calltest.bench import bench
+    cfg = attrdict(obj.cfg, server=attrdict(obj.cfg.server, port=port))
+    try:
+        res = await bench(cfg, n_links=n_links, n_checks=n_checks, duration=duration,
+                mode=mode, interval=interval)
+    except ConfigError as exc:
+        raise click.UsageError(str(exc))
+    if as_json:
+        json.dump(res, sys.stdout, indent=2)
+        print()
+        return
+    for k,v in res.items():
+        if isinstance(v, float):
+            v = "%.6g" % (v,)
+        print("%-18s %s" % (k, v))
+
+@main.command()
+@click.option("-r","--rate", type=float, default=None, help="Peak rate of new calls per second")
+@click.option("-n","--concurrency", type=int, default=None, help="Peak number of concurrent calls")
+@click.option("-u","--ramp", type=float, default=10, help="Seconds to ramp up")
+@click.option("-d","--hold", type=float, default=60, help="Seconds to hold the peak")
+@click.option("-D","--down", type=float, default=10, help="Seconds to ramp down")
+@click.option("-s","--suffix", type=int, default=0, help="Append a running number with this many digits to the dialled number")
+@click.option("-R","--report", type=float, default=1, help="Seconds between progress lines")
+@click.option("-j","--json","as_json", is_flag=True, help="Print the results as JSON")
+@click.argument("check")
+@click.pass_obj
+async def load(obj, check, rate, concurrency, ramp, hold, down, suffix, report, as_json):
+    """
+    Run a test as a load generator.
+
+    Calls are started at a given rate (-r), or kept at a given number of
+    concurrent calls (-n). Links' capacity limits are ignored.
+    """
+    from calltest.backend import Backends
+    from calltest.load import LoadGen
+
+    if (rate is None) == (concurrency is None):
+        raise click.UsageError("Use either --rate or --concurrency.")
+    try:
+        call = obj.calls[check]
+    except KeyError:
+        raise click.UsageError("Unknown test: %s" % (check,))
+    if "src" not in call._mode.ends:
+        raise click.UsageError("Mode %s only answers calls, it can't generate load" % (call._mode.name,))
+
+    def progress(r):
+        print("%6.1fs target %7.1f active %5d cps %7.1f asr %s ok %s pdd %s/%s/%s fail %d %s" % (
+            r.t, r.target, r.active, r.cps, _pc(r.asr), _pc(r.success),
+            _ms(r.pdd_p50), _ms(r.pdd_p95), _ms(r.pdd_p99), r.failed,
+            " ".join("%s=%d" % kv for kv in r.reasons.items())), flush=True)
+
+    backends = Backends(obj.cfg, obj.links.values(), [call])
+    gen = LoadGen(call, backends, rate=rate, concurrency=concurrency,
+            ramp=ramp, hold=hold, down=down, suffix=suffix, report=report,
+            progress=None if as_json else progress)
+    res = await gen.run()
+    if as_json:
+        json.dump(res, sys.stdout, indent=2)
+        print()
+        return
+    for k,v in res.items():
+        if isinstance(v, float):
+            v = "%.6g" % (v,)
+        print("%-18s %s" % (k, v))
+
+def _pc(x):
+    return "  -  " if x is None else "%4.0f%%" % (x*100,)
+
+def _ms(x):
+    return "-" if x is None else "%.0f" % (x*1000,)
 
 @main.command()
 @click.pass_obj
 async def dumpcfg(obj):
     """emit the current configuration as a YAML file."""
     import yaml
-    yaml.safe_dump(obj.cfg, stream=sys.stdout)
+    yaml.dump(obj.cfg, stream=sys.stdout, Dumper=yaml_dumper())
@@ -0,0 +1,150 @@
+"""
+This module reads the configuration file.
+
+YAML is parsed with libyaml if it's available. The result, merged with
+the defaults, may be cached in a pickle file, which is used as long as
+the configuration file and the defaults don't change.
+"""
+
+import hashlib
+import os
+import pickle
+
+from .util import attrdict, merge_defaults, NotGiven
+from .default import CFG
+
+import logging
+logger = logging.getLogger(__name__)
+
+DEF_CFG = "/etc/voice/calltest.cfg"
+
+
+def yaml_loader():
+    """The fastest safe YAML loader available."""
+    import yaml
+    return getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+def yaml_dumper():
+    """The fastest safe YAML dumper available."""
+    import yaml
+    from yaml.representer import SafeRepresenter
+
+    SafeRepresenter.add_representer(attrdict, SafeRepresenter.represent_dict)
+    return getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+
+# Computed once, so that changes to the defaults at runtime, which must
+# not happen, can't invalidate the cache either.
+_DEFAULTS_HASH = hashlib.sha256(pickle.dumps(CFG)).hexdigest()
+
+
+def _parse(data):
+    import yaml
+    return merge_defaults(yaml.load(data, Loader=yaml_loader()) or {}, CFG, cls=attrdict)
+
+
+def _load(path, cache=None):
+    """
+    Read this config file and merge it with the defaults, possibly via
+    the cache.
+    """
+    if cache is None:
+        with open(path, "rb") as f:
+            return _parse(f.read())
+
+    st = os.stat(path)
+    key = dict(path=os.path.abspath(path), mtime=st.st_mtime_ns, size=st.st_size,
+            defaults=_DEFAULTS_HASH)
+    try:
+        with open(cache, "rb") as f:
+            c_key, c_hash, res = pickle.load(f)
+    except FileNotFoundError:
+        c_key = c_hash = None
+    except Exception as exc:
+        logger.warning("Config cache %s: %r", cache, exc)
+        c_key = c_hash = None
+    else:
+        if c_key == key:
+            return res
+
+    with open(path, "rb") as f:
+        data = f.read()
+    h = hashlib.sha256(data).hexdigest()
+    if c_key is None or c_hash != h or c_key["defaults"] != key["defaults"]:
+        res = _parse(data)
+    # otherwise the file was touched but not changed
+
+    tmp = cache+".tmp"
+    try:
+        with open(tmp, "wb") as f:
+            pickle.dump((key, h, res), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, cache)
+    except OSError as exc:
+        logger.warning("Config cache %s: %r", cache, exc)
+    return res
+
+
+def load_cfg(cfg, conf=(), cache=None):
+    """
+    Read the configuration.
+
+    :param cfg: the config file's name. ``None``: use the system default
+                if it exists. ``"-"``: use the built-in defaults.
+    :param conf: a list of ``path.to.entry=value`` overrides.
+    :param cache: a file to cache the parsed configuration in.
+    """
+    if cfg is None:
+        if os.path.exists(DEF_CFG):
+            cfg = DEF_CFG
+    elif cfg == "-":
+        cfg = None
+
+    if cfg:
+        logger.debug("Loading %s", cfg)
+        res = _load(cfg, cache)
+    else:
+        res = CFG
+
+    # One-Shot-Hack the config file. Sub-dicts may be shared with the
+    # defaults (or be the defaults), so copy everything on the way.
+    if conf:
+        res = type(res)(res)
+    for k in conf:
+        try:
+            k,v = k.split('=')
+        except ValueError:
+            v = NotGiven
+        else:
+            try:
+                v = eval(v)
+            except Exception:
+                pass
+        c = res
+        *sl, s = k.split('.')
+        for k in sl:
+            c[k] = type(c[k])(c[k])
+            c = c[k]
+        if v is NotGiven:
+            del c[s]
+        else:
+            c[s] = v
+    return res
+
+
+def logging_cfg(cfg, verbose=0, log=()):
+    """
+    Returns this configuration's ``logging`` section, with the root
+    logger's level set by ``verbose`` and other loggers' by ``log``, a
+    list of ``name=LEVEL`` strings.
+
+    ``cfg`` isn't modified: its sub-dicts may be shared with the defaults.
+    """
+    lcfg = dict(cfg.logging)
+    lcfg['root'] = dict(lcfg['root'],
+            level="DEBUG" if verbose > 2 else "INFO" if verbose > 1 else "WARNING" if verbose else "ERROR")
+    loggers = lcfg['loggers'] = dict(lcfg['loggers'])
+    for k in log:
+        k,v = k.split('=')
+        loggers[k] = dict(loggers.get(k, {}), level=v)
+    return lcfg
@@ -54,12 +54,62 @@ CFG = attrdict(
         ssl=False,
         # ssl=attrdict(cert='/path/to/cert.pem',key='/path/to/cert.key'),
         init_timeout=5,  # time to wait for connection plus greeting
+        reconnect=10,  # delay before reconnecting, and connection check interval
         username="asterisk",
         password="asterisk",
         app="calltest",
+        # Additional Asterisk servers. Name > values to override.
+        # If empty, the values above are used for a single server named
+        # "default".
+        backends={},
+        early=attrdict(
+            # incoming calls that arrive before their test is ready
+            max=20,
+            keep=5,  # seconds
+        ),
+        bridges=attrdict(
+            # mixing bridges are reused
+            pool=10,  # idle bridges to keep; 0: create one per call
+            check=60,  # seconds; verify a bridge that was idle longer before reusing it
+        ),
         audio=attrdict(
             play="sound:calltest/",
             record="/tmp/",
+            sounds=None,  # local directory with the played sounds as WAV files, for analysis
+        ),
+        media=attrdict(
+            # streaming audio via externalMedia, for tests with audio.stream
+            bind="127.0.0.1",  # our address for receiving RTP
+            host=None,  # the address Asterisk should send to, if not "bind"
+            format="slin",  # slin, slin16 or ulaw
+            keep=10,  # seconds of audio to keep, saved if the test fails
+            batch=0.1,  # seconds of audio to measure at a time
+        ),
+
+        fake=attrdict(
+            # simulate Asterisk instead of connecting to it, for testing
+            # and benchmarking. See calltest.fakeari.
+            enabled=False,
+            seed=None,  # for repeatable runs
+            numbers={},  # number > link name. Default: the links' numbers
+            delay=attrdict(  # seconds, or [min,max]
+                rest=0,  # to process a REST request
+                reply=0,  # until its reply arrives; events may overtake it
+                route=0.01,  # until the other end of a call notices anything
+                ring=0.5,  # other numbers: until they ring
+                answer=1,  # other numbers: until they answer
+                dtmf=0.02,  # until a digit arrives at the other end
+                play=1,  # length of any sound file
+                hangup=0.01,  # until the other end is hung up
+                drop=5,  # until a dropped call is hung up
+            ),
+            tempo=1,  # multiplies the DTMF timing requested by calltest
+            fail=0,  # fraction of calls that are rejected
+            drop=0,  # fraction of answered calls that are dropped
+            error=0,  # fraction of originate requests that fail
+            lose_dtmf=0,  # fraction of DTMF digits that are lost
+            lose_rtp=0,  # fraction of externalMedia packets that are lost
+            tone=1000,  # Hz, what externalMedia sends while a sound is played
         ),
 
         dialplan=attrdict(
@@ -74,6 +124,39 @@ CFG = attrdict(
         host="127.0.0.1",
         port=8080,
         prio=0,
+        ws=attrdict(
+            # websocket listeners
+            interval=0.5,  # send collected updates this often
+            max_pending=1000,  # tests with queued updates, before resyncing
+            timeout=10,  # drop listeners that block this long
+        ),
+    ),
+    metrics=attrdict(
+        # histogram buckets for /metrics, in seconds
+        buckets=[0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60],
+    ),
+    analysis=attrdict(
+        # analysing recorded audio; requires NumPy
+        workers=2,  # processes
+        frame=0.02,  # seconds per frame
+        silence=-50,  # frames with less power (dBFS) are silent
+        clip=32000,  # samples with a larger absolute value are clipped
+        tones=[],  # frequencies (Hz) to look for
+        max_delay=5,  # seconds, to search for the played sound in a recording
+    ),
+    history=attrdict(
+        # on-disk log of all test runs, for /test/NAME/history
+        file=None,  # path. Test names are stored in PATH.names
+        max_records=10000,  # limit for a single query
+        recent=1000,  # runs per test to index in memory; older ones are searched on disk
+    ),
+    sched=attrdict(
+        # the server's central test scheduler.
+        workers=50,  # max number of concurrently running tests
+        jitter=0.1,  # randomly vary delays by this fraction
+        spread=60,  # seconds to distribute initial test runs over
+        probe=30,  # seconds; re-run the tests on a link soon after one failed or recovered
+        confirm=2,  # a link is down when this many of its tests fail
     ),
 
     # maps app names to channels and phone numbers.
@@ -85,6 +168,14 @@ CFG = attrdict(
         DEFAULT: {
             "channel": None,
             "number": None,
+            "capacity": 1,  # max #concurrent test calls
+            "backend": None,  # Asterisk server to use. Default: spread
+            "worker": None,  # worker process to use. Default: spread
+            "budget": 0,  # max #calls per hour the scheduler may start; 0: no limit
+            "queue": attrdict(
+                depth=10,  # max #tests waiting for this link
+                policy="fifo",  # or "oldest": least recently run test first
+            ),
         },
     },
 
@@ -95,6 +186,7 @@ CFG = attrdict(
     # These modes call me:
     # * dtmf: answer, exchange a random DTMF sequence to verify connectivity.
     # * call: simply test that a call arrives. It will be rejected, so no cost.
+    # * burst: answer, send DTMF both ways at once, at increasing speed.
     # 
     # These modes only originate:
     # * ring: check for RINGING state (or ANSWER …) then hang up.
@@ -114,6 +206,9 @@ CFG = attrdict(
                 warn=1,  # enter WARN state after this many failures
                 fail=1,  # enter FAIL state after this many failures
                 skip=False,  # test is not auto-run if True
+                defer=30,  # when the link was too busy
+                backoff=2,  # after a failure, multiply the delay from retry
+                            # towards repeat by this per success; 0: off
             ),
             "src": None,   # link. Must be missing for answer tests.
             "dst": None,   # link. Must be missing for originate tests.
@@ -124,12 +219,22 @@ CFG = attrdict(
             "dtmf": attrdict(
                 may_repeat=False, # lax DTMF comparison?
                 len=5, # #digits
+                # burst mode:
+                sweep=[100, 70, 50, 40, 30], # msec per tone and per gap, slowest first
+                jitter=0.5, # max deviation from even spacing, as a fraction of a digit's time
+                slack=2, # seconds to wait for a sequence, beyond its length
+                inband=False, # decode DTMF from the streamed audio, not from Asterisk's events
             ),
             "audio": attrdict( # file names for sound support
                 src_in=None,
                 dst_in=None,
                 src_out=None,
                 dst_out=None,
+                analyze=False, # analyse the recordings, see "analysis"
+                stream=False, # stream and measure the audio instead of recording it
+                min_similarity=None, # fail if a recording is less similar to the sound played into it
+                max_silence=None, # fail if more of a recording is silent (fraction)
+                max_clipping=None, # fail if more of a recording's samples are clipped (fraction)
             ),
             "delay": attrdict(
                 pre=0, # incoming: before doing anything
@@ -137,6 +242,7 @@ CFG = attrdict(
                 answer=1, # after establishing the call
             ),
             "check_callerid": True,
+            "trace": False,  # record timed spans of each run in state.spans
         },
     },
 )
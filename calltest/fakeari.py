@@ -0,0 +1,774 @@
+"""
+This module simulates an Asterisk server, so that calltest can be tested
+and benchmarked without one.
+
+It implements the parts of ARI that calltest uses: channels, bridges,
+playbacks, live recordings, and the event websocket. It replaces the
+HTTP client below :mod:`asyncari`, so everything above that (asyncari's
+models and state machines, calltest's workers) runs unchanged, but no
+network is involved.
+
+Calls to a number that belongs to a link (see ``asterisk.fake.numbers``),
+or that starts with one, arrive on that link, so both ends of a test are
+handled by calltest.
+Any other number is answered by a simulated phone. Ringing, answering,
+DTMF and playback take the times configured in ``asterisk.fake.delay``;
+calls can be made to fail at random.
+
+An externalMedia channel sends RTP with signed linear audio: a tone
+while a sound is played to its bridge or to the far end of a call in
+it, in-band DTMF while the far end sends DTMF, silence otherwise.
+"""
+
+import anyio
+import json
+import math
+import random
+import re
+import struct
+import sys
+import time
+import urllib.parse
+from array import array
+from contextlib import asynccontextmanager
+from itertools import count
+
+from asks.errors import BadStatus
+from asyncari.client import Client
+from wsproto.events import TextMessage
+
+from .util import attrdict
+
+import logging
+logger = logging.getLogger(__name__)
+
+QLEN = 10000  # events buffered per websocket
+RTP_FRAME = 160  # samples per RTP packet: 20 msec at 8 kHz
+
+_servers = count(1)  # for unique IDs
+
+# ARI's hangup reasons, and the causes they map to
+CAUSES = {"normal": 16, "busy": 17, "no_answer": 19, "congestion": 34}
+CAUSE_TXT = {16: "Normal Clearing", 17: "User busy", 19: "No answer",
+        34: "Circuit/channel congestion", 38: "Network out of order"}
+
+# resource > (path, method, nickname, response class, parameters)
+# Path parameters are taken from the path. Parameters starting with '*'
+# are sent in the request body.
+_REC = ("name", "format", "maxDurationSeconds", "maxSilenceSeconds", "ifExists", "beep", "terminateOn")
+_PLAY = ("media", "lang", "offsetms", "skipms", "playbackId")
+_ORIG = ("endpoint", "extension", "context", "priority", "label", "app", "appArgs",
+        "callerId", "timeout", "*variables", "otherChannelId", "originator", "formats")
+_OPS = {
+    "channels": (
+        ("/channels", "POST", "originate", "Channel", _ORIG+("channelId",)),
+        ("/channels/externalMedia", "POST", "externalMedia", "Channel", ("channelId", "app",
+            "*variables", "external_host", "encapsulation", "transport", "connection_type",
+            "format", "direction", "data")),
+        ("/channels/{channelId}", "POST", "originateWithId", "Channel", _ORIG),
+        ("/channels/{channelId}", "GET", "get", "Channel", ()),
+        ("/channels/{channelId}", "DELETE", "hangup", "void", ("reason",)),
+        ("/channels/{channelId}/answer", "POST", "answer", "void", ()),
+        ("/channels/{channelId}/ring", "POST", "ring", "void", ()),
+        ("/channels/{channelId}/ring", "DELETE", "ringStop", "void", ()),
+        ("/channels/{channelId}/dtmf", "POST", "sendDTMF", "void", ("dtmf", "before", "between", "duration", "after")),
+        ("/channels/{channelId}/play", "POST", "play", "Playback", _PLAY),
+        ("/channels/{channelId}/record", "POST", "record", "LiveRecording", _REC),
+    ),
+    "bridges": (
+        ("/bridges", "POST", "create", "Bridge", ("type", "bridgeId", "name")),
+        ("/bridges/{bridgeId}", "GET", "get", "Bridge", ()),
+        ("/bridges/{bridgeId}", "DELETE", "destroy", "void", ()),
+        ("/bridges/{bridgeId}/addChannel", "POST", "addChannel", "void", ("channel", "role")),
+        ("/bridges/{bridgeId}/removeChannel", "POST", "removeChannel", "void", ("channel",)),
+        ("/bridges/{bridgeId}/play", "POST", "play", "Playback", _PLAY),
+        ("/bridges/{bridgeId}/record", "POST", "record", "LiveRecording", _REC),
+    ),
+    "playbacks": (
+        ("/playbacks/{playbackId}", "GET", "get", "Playback", ()),
+        ("/playbacks/{playbackId}", "DELETE", "stop", "void", ()),
+    ),
+    "recordings": (
+        ("/recordings/live/{recordingName}", "GET", "getLive", "LiveRecording", ()),
+        ("/recordings/live/{recordingName}", "DELETE", "cancel", "void", ()),
+        ("/recordings/live/{recordingName}/stop", "POST", "stop", "void", ()),
+    ),
+    "events": (
+        ("/events", "GET", "eventWebsocket", "Message", ("app", "subscribeAll")),
+    ),
+}
+
+# event > field > type
+_EVENTS = {
+    "StasisStart": {"args": "List[string]", "channel": "Channel", "replace_channel": "Channel"},
+    "StasisEnd": {"channel": "Channel"},
+    "ChannelStateChange": {"channel": "Channel"},
+    "ChannelHangupRequest": {"cause": "int", "soft": "boolean", "channel": "Channel"},
+    "ChannelDestroyed": {"cause": "int", "cause_txt": "string", "channel": "Channel"},
+    "ChannelDtmfReceived": {"digit": "string", "duration_ms": "int", "channel": "Channel"},
+    "ChannelEnteredBridge": {"bridge": "Bridge", "channel": "Channel"},
+    "ChannelLeftBridge": {"bridge": "Bridge", "channel": "Channel"},
+    "BridgeDestroyed": {"bridge": "Bridge"},
+    "PlaybackStarted": {"playback": "Playback"},
+    "PlaybackFinished": {"playback": "Playback"},
+    "RecordingStarted": {"recording": "LiveRecording"},
+    "RecordingFinished": {"recording": "LiveRecording"},
+}
+
+
+def _api_docs(base):
+    """
+    The Swagger 1.1 documents that describe the fake's API.
+
+    Returns a dict: path > document.
+    """
+    docs = {}
+    base = base.rstrip("/") + "/ari"
+    docs["resources.json"] = {"swaggerVersion": "1.1", "basePath": base,
+            "apis": [{"path": "/api-docs/%s.{format}" % r, "description": r} for r in _OPS]}
+    for res, ops in _OPS.items():
+        apis = {}
+        for path, method, nick, cls, params in ops:
+            ps = [{"name": p, "paramType": "path", "dataType": "string", "required": True}
+                    for p in re.findall(r"{(\w+)}", path)]
+            for p in params:
+                pt = "query"
+                if p[0] == "*":
+                    p, pt = p[1:], "body"
+                ps.append({"name": p, "paramType": pt, "dataType": "string", "required": False})
+            op = {"httpMethod": method, "nickname": nick, "responseClass": cls, "parameters": ps}
+            if res == "events":
+                op["upgrade"] = "websocket"
+            apis.setdefault(path, []).append(op)
+        models = {}
+        if res == "events":
+            for evt, props in _EVENTS.items():
+                props = dict(props, type={"type": "string"}, application={"type": "string"},
+                        timestamp={"type": "Date"})
+                models[evt] = {"id": evt, "properties": {k: (v if isinstance(v, dict) else {"type": v})
+                    for k, v in props.items()}}
+        docs[res+".json"] = {"swaggerVersion": "1.1", "basePath": base,
+                "resourcePath": "/api-docs/%s.{format}" % res,
+                "apis": [{"path": p, "description": p, "operations": o} for p, o in apis.items()],
+                "models": models}
+    return docs
+
+
+class _Response:
+    def __init__(self, status_code, data=None):
+        self.status_code = status_code
+        self.text = "" if data is None else json.dumps(data)
+
+    def json(self):
+        return json.loads(self.text)
+
+    def __repr__(self):
+        return "<%s:%d>" % (self.__class__.__name__, self.status_code)
+
+
+class _Error(Exception):
+    def __init__(self, status, message):
+        self.status = status
+        self.message = message
+
+
+class _WebSocket:
+    """
+    The event websocket of one connection.
+
+    Records how long each event took to be processed: from being sent
+    until the client asks for the next one.
+    """
+    def __init__(self, pbx, app):
+        self.pbx = pbx
+        self.app = app
+        self._q = anyio.create_queue(QLEN)
+        self._t = None  # when the event that's being processed was sent
+        self.closed = False
+
+    async def send(self, evt):
+        if not self.closed:
+            await self._q.put((time.monotonic(), TextMessage(data=json.dumps(evt))))
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._t is not None:
+            self.pbx.latency.append(time.monotonic() - self._t)
+            self._t = None
+        msg = await self._q.get()
+        if msg is None:
+            raise StopAsyncIteration
+        self._t, msg = msg
+        return msg
+
+    async def close(self):
+        if not self.closed:
+            self.closed = True
+            self.pbx.sockets.discard(self)
+            await self._q.put(None)
+
+
+class _HttpClient:
+    """
+    Stands in for asyncswagger11's HTTP client.
+    """
+    def __init__(self, pbx, base):
+        self.pbx = pbx
+        self.docs = _api_docs(base)
+        self.websockets = set()
+
+    async def request(self, method, url, params=None, data=None, headers=None):
+        path = urllib.parse.unquote(urllib.parse.urlsplit(url).path)
+        if path.startswith("/ari/api-docs/"):
+            return _Response(200, self.docs[path[14:]])
+        if data:
+            params = dict(params or {}, **json.loads(data))
+        try:
+            res = await self.pbx.request(method, path[4:], params or {})
+        except _Error as exc:
+            resp = _Response(exc.status, {"message": exc.message})
+            err = BadStatus(exc.message, resp, exc.status)
+            err.data = {"message": exc.message}
+            raise err
+        return _Response(200 if res is not None else 204, res)
+
+    async def ws_connect(self, url, params=None, headers=None):
+        ws = _WebSocket(self.pbx, params["app"])
+        self.pbx.sockets.add(ws)
+        self.websockets.add(ws)
+        return ws
+
+    async def close(self):
+        for ws in list(self.websockets):
+            await ws.close()
+
+
+_DTMF = {d: (f1, f2) for f1, row in zip((697, 770, 852, 941), ("123A", "456B", "789C", "*0#D"))
+        for f2, d in zip((1209, 1336, 1477, 1633), row)}
+
+
+def _dtmf_frame(digit, ts):
+    # one RTP packet of this DTMF digit, in big-endian slin, continuing
+    # at sample number ts
+    f1, f2 = _DTMF[digit]
+    x = array('h', (int(6000*(math.sin(2*math.pi*f1*(ts+i)/8000) + math.sin(2*math.pi*f2*(ts+i)/8000)))
+            for i in range(RTP_FRAME)))
+    if sys.byteorder == "little":
+        x.byteswap()
+    return x.tobytes()
+
+
+class _Channel:
+    def __init__(self, pbx, id, name, app, caller, state):
+        self.pbx = pbx
+        self.id = id
+        self.name = name
+        self.app = app
+        self.caller = caller
+        self.state = state
+        self.peer = None  # the other end of the call, if it's ours
+        self.bridge = None
+        self.in_stasis = False
+        self.playbacks = set()
+        self.recordings = set()
+        self.created = time.time()
+        self.tone = None  # the DTMF digit this channel hears
+
+    def json(self):
+        return {"id": self.id, "name": self.name, "state": self.state,
+                "caller": self.caller, "connected": {"name": "", "number": ""},
+                "accountcode": "", "language": "en",
+                "dialplan": {"context": "default", "exten": "s", "priority": 1},
+                "creationtime": time.strftime("%Y-%m-%dT%H:%M:%S.000+0000", time.gmtime(self.created))}
+
+
+class _Bridge:
+    def __init__(self, id, type):
+        self.id = id
+        self.type = type
+        self.channels = set()
+        self.playbacks = set()
+        self.recordings = set()
+        self.app = None
+
+    def json(self):
+        return {"id": self.id, "technology": "simple_bridge", "bridge_type": self.type,
+                "bridge_class": "stasis", "creator": "Stasis", "name": "",
+                "channels": sorted(self.channels)}
+
+
+class FakeAsterisk:
+    """
+    A simulated Asterisk server.
+
+    :param cfg: The configuration. Its ``asterisk.fake`` section controls
+                the simulation; ``links`` supplies the default number
+                plan.
+
+    ``latency`` collects the time each event took from being sent until
+    calltest had processed it, in seconds. ``stats`` counts REST requests,
+    events and calls.
+    """
+    def __init__(self, cfg):
+        self.cfg = cfg.asterisk.fake
+        self.numbers = {v["number"]: k for k, v in cfg.links.items()
+                if isinstance(v, dict) and v.get("number")}
+        self.numbers.update(self.cfg.numbers)
+        self.random = random.Random(self.cfg.seed)
+        self.channels = {}
+        self.bridges = {}
+        self.playbacks = {}  # id > (playback, target)
+        self.recordings = {}  # name > (recording, target)
+        self.sockets = set()
+        self.latency = array('d')
+        self.stats = attrdict(requests=0, events=0, calls=0, failed=0, dropped=0)
+        self._ids = count(1)
+        # asyncari caches objects by ID, across clients
+        self._prefix = "F%d." % next(_servers)
+        self._tg = None
+
+        self._routes = []
+        for res, ops in _OPS.items():
+            for path, method, nick, _, _ in ops:
+                fn = getattr(self, "_%s_%s" % (res, nick), None)
+                if fn is None:
+                    continue
+                rx = re.compile("^" + re.sub(r"{(\w+)}", r"(?P<\1>[^/]+)", path) + "$")
+                self._routes.append((method, rx, fn))
+
+    def __repr__(self):
+        return "<%s:%d>" % (self.__class__.__name__, len(self.channels))
+
+    @asynccontextmanager
+    async def connect(self, base_url, apps):
+        """
+        Connect an ARI client to this server, like :func:`asyncari.connect`.
+        """
+        http_client = _HttpClient(self, base_url)
+        try:
+            async with anyio.create_task_group() as tg:
+                self._tg = tg
+                client = Client(tg, base_url, apps, http_client)
+                async with client:
+                    try:
+                        yield client
+                    finally:
+                        await tg.cancel_scope.cancel()
+        finally:
+            self._tg = None
+            await http_client.close()
+
+    def _delay(self, name):
+        d = self.cfg.delay[name]
+        if isinstance(d, (list, tuple)):
+            d = self.random.uniform(*d)
+        return d
+
+    def _chance(self, name):
+        p = self.cfg[name]
+        return p > 0 and self.random.random() < p
+
+    async def _later(self, delay, proc, *args):
+        if self._tg is None:
+            return  # disconnected
+        async def _run():
+            await anyio.sleep(delay)
+            await proc(*args)
+        await self._tg.spawn(_run)
+
+    def _new_id(self):
+        return self._prefix + str(next(self._ids))
+
+    async def request(self, method, path, params):
+        """
+        Process a REST request. Returns the result's JSON data, or ``None``.
+        """
+        self.stats.requests += 1
+        d = self._delay("rest")
+        if d:
+            await anyio.sleep(d)
+        for m, rx, fn in self._routes:
+            if m != method:
+                continue
+            r = rx.match(path)
+            if r is not None:
+                res = await fn(**r.groupdict(), **params)
+                d = self._delay("reply")
+                if d:
+                    await anyio.sleep(d)
+                return res
+        raise _Error(404, "Not found: %s %s" % (method, path))
+
+    # Events
+
+    async def _emit(self, app, typ, **kw):
+        if app is None:
+            return
+        kw["type"] = typ
+        kw["application"] = app
+        kw["timestamp"] = time.strftime("%Y-%m-%dT%H:%M:%S.000+0000", time.gmtime())
+        self.stats.events += 1
+        for ws in list(self.sockets):
+            if ws.app == app:
+                await ws.send(kw)
+
+    async def _set_state(self, ch, state):
+        if ch.state == state or ch.id not in self.channels:
+            return
+        ch.state = state
+        await self._emit(ch.app, "ChannelStateChange", channel=ch.json())
+
+    # Channels
+
+    def _chan(self, channelId):
+        try:
+            return self.channels[channelId]
+        except KeyError:
+            raise _Error(404, "Channel not found") from None
+
+    async def _channels_originate(self, channelId=None, **kw):
+        return await self._channels_originateWithId(channelId=channelId or self._new_id(), **kw)
+
+    async def _channels_originateWithId(self, channelId, endpoint, app=None, appArgs="",
+            callerId="", variables=None, **kw):
+        if channelId in self.channels:
+            raise _Error(409, "Channel %s exists" % (channelId,))
+        if self._chance("error"):
+            raise _Error(500, "Allocation failed")
+        self.stats.calls += 1
+
+        args = appArgs.split(",") if isinstance(appArgs, str) else list(appArgs)
+        vars = variables or {}
+        name, nr = callerId, ""
+        m = re.match(r"\s*(.*?)\s*<(.*)>\s*$", callerId or "")
+        if m:
+            name, nr = m.groups()
+        nr = vars.get("CALLERID(num)", nr)
+        name = vars.get("CALLERID(name)", name)
+
+        ch = _Channel(self, channelId, "%s-%08x" % (endpoint, next(self._ids)), app,
+                {"name": "", "number": ""}, "Down")
+        ch.args = args
+        self.channels[channelId] = ch
+
+        dialled = args[1] if len(args) > 1 and args[0] == ":dialed" else endpoint.rsplit("/", 1)[-1]
+        link = self._link_for(dialled)
+        if self._chance("fail"):
+            self.stats.failed += 1
+            await self._later(self._delay("route") + self._delay("ring"), self._hangup, ch, CAUSES["busy"], True)
+        elif link is None:
+            # a simulated phone
+            await self._later(self._delay("route") + self._delay("ring"), self._set_state, ch, "Ringing")
+            await self._later(self._delay("route") + self._delay("ring") + self._delay("answer"), self._answered, ch)
+        else:
+            await self._later(self._delay("route"), self._incoming, ch, link, dialled, {"name": name, "number": nr})
+        return ch.json()
+
+    def _link_for(self, dialled):
+        # the link a number belongs to: exact match, else the longest
+        # link number it starts with (a block of DIDs)
+        link = self.numbers.get(dialled)
+        if link is None:
+            best = 0
+            for nr, l in self.numbers.items():
+                if len(nr) > best and dialled.startswith(nr):
+                    link, best = l, len(nr)
+        return link
+
+    async def _incoming(self, och, link, dialled, caller):
+        if och.id not in self.channels:
+            return
+        ch = _Channel(self, self._new_id(), "Fake/%s-%08x" % (link, next(self._ids)),
+                och.app, caller, "Ring")
+        ch.peer, och.peer = och, ch
+        self.channels[ch.id] = ch
+        ch.in_stasis = True
+        await self._emit(ch.app, "StasisStart", args=[link, dialled], channel=ch.json())
+
+    async def _answered(self, ch):
+        if ch.id not in self.channels or ch.state == "Up":
+            return
+        await self._set_state(ch, "Up")
+        if not ch.in_stasis:
+            ch.in_stasis = True
+            await self._emit(ch.app, "StasisStart", args=ch.args, channel=ch.json())
+        if ch.peer is None and self._chance("drop"):
+            self.stats.dropped += 1
+            await self._later(self._delay("drop"), self._hangup, ch, 38, True)
+
+    async def _channels_externalMedia(self, app, external_host, format="slin", channelId=None, **kw):
+        if format != "slin":
+            raise _Error(400, "Unsupported format %s" % (format,))
+        host, port = external_host.rsplit(":", 1)
+        ch = _Channel(self, channelId or self._new_id(),
+                "UnicastRTP/%s-%08x" % (external_host, next(self._ids)), app,
+                {"name": "", "number": ""}, "Up")
+        self.channels[ch.id] = ch
+        ch.in_stasis = True
+        await self._emit(app, "StasisStart", args=[], channel=ch.json())
+        await self._tg.spawn(self._rtp, ch, host, int(port))
+        return ch.json()
+
+    def _hears(self, ch):
+        # what an externalMedia channel hears: a DTMF digit, True for
+        # a sound, or None
+        br = self.bridges.get(ch.bridge)
+        if br is None:
+            return None
+        sound = bool(br.playbacks)
+        for c in br.channels:
+            c = self.channels.get(c)
+            if c is None:
+                continue
+            if c.tone is not None:
+                return c.tone
+            if c.peer is not None and c.peer.playbacks:
+                sound = True
+        return sound or None
+
+    async def _rtp(self, ch, host, port):
+        # send what the channel hears, in 20 msec packets
+        tone = array('h', (int(8000*math.sin(2*math.pi*self.cfg.tone*i/8000))
+                for i in range(RTP_FRAME)))
+        if sys.byteorder == "little":
+            tone.byteswap()
+        tone = tone.tobytes()
+        quiet = bytes(2*RTP_FRAME)
+        seq = self.random.randrange(0x10000)
+        ts = self.random.randrange(0x100000000)
+        ssrc = self.random.randrange(0x100000000)
+
+        sock = await anyio.create_udp_socket(target_host=host, target_port=port)
+        t = time.monotonic()
+        try:
+            while ch.id in self.channels:
+                if not self._chance("lose_rtp"):
+                    hdr = struct.pack("!BBHII", 0x80, 118, seq, ts, ssrc)
+                    what = self._hears(ch)
+                    if what is None:
+                        data = quiet
+                    elif what is True:
+                        data = tone
+                    else:
+                        data = _dtmf_frame(what, ts)
+                    await sock.send(hdr + data)
+                seq = (seq+1) & 0xFFFF
+                ts = (ts+RTP_FRAME) & 0xFFFFFFFF
+                t += RTP_FRAME/8000
+                await anyio.sleep(max(0, t-time.monotonic()))
+        finally:
+            await sock.close()
+
+    async def _channels_get(self, channelId):
+        return self._chan(channelId).json()
+
+    async def _channels_ring(self, channelId):
+        ch = self._chan(channelId)
+        await self._set_state(ch, "Ringing")
+        if ch.peer is not None:
+            await self._later(self._delay("route"), self._set_state, ch.peer, "Ringing")
+
+    async def _channels_ringStop(self, channelId):
+        ch = self._chan(channelId)
+        await self._set_state(ch, "Ring")
+
+    async def _channels_answer(self, channelId):
+        ch = self._chan(channelId)
+        await self._set_state(ch, "Up")
+        if ch.peer is not None:
+            await self._later(self._delay("route"), self._answered, ch.peer)
+            if self._chance("drop"):
+                self.stats.dropped += 1
+                await self._later(self._delay("drop"), self._hangup, ch, 38, True)
+
+    async def _channels_hangup(self, channelId, reason="normal"):
+        ch = self._chan(channelId)
+        await self._hangup(ch, CAUSES.get(reason, 16))
+
+    async def _hangup(self, ch, cause, remote=False):
+        if self.channels.pop(ch.id, None) is None:
+            return
+        if remote:
+            await self._emit(ch.app, "ChannelHangupRequest", cause=cause, soft=False, channel=ch.json())
+        for pb in list(ch.playbacks):
+            await self._playback_done(pb)
+        for rec in list(ch.recordings):
+            await self._recording_done(rec)
+        if ch.bridge is not None:
+            await self._leave(self.bridges[ch.bridge], ch)
+        if ch.in_stasis:
+            await self._emit(ch.app, "StasisEnd", channel=ch.json())
+        await self._emit(ch.app, "ChannelDestroyed", cause=cause, cause_txt=CAUSE_TXT.get(cause, ""),
+                channel=ch.json())
+        peer, ch.peer = ch.peer, None
+        if peer is not None:
+            peer.peer = None
+            await self._later(self._delay("hangup"), self._hangup, peer, cause, True)
+
+    async def _channels_sendDTMF(self, channelId, dtmf, before=0, between=100, duration=100, after=0):
+        ch = self._chan(channelId)
+        await self._tg.spawn(self._send_dtmf, ch, dtmf, float(before), float(between), int(duration))
+
+    async def _send_dtmf(self, ch, dtmf, before, between, duration):
+        # ARI's timings are in milliseconds
+        tempo = self.cfg.tempo
+        await anyio.sleep(before / 1000 * tempo)
+        for i, digit in enumerate(dtmf):
+            if i:
+                await anyio.sleep(between / 1000 * tempo)
+            # the tone is heard in-band even if the event gets lost
+            peer = ch.peer
+            if peer is not None:
+                peer.tone = digit
+            await anyio.sleep(duration / 1000 * tempo)
+            if peer is not None and peer.tone == digit:
+                peer.tone = None
+            peer = ch.peer
+            if ch.id not in self.channels:
+                return
+            if peer is None or self._chance("lose_dtmf"):
+                continue
+            await self._later(self._delay("dtmf"), self._dtmf, peer, digit, duration)
+
+    async def _dtmf(self, ch, digit, duration):
+        if ch.id in self.channels:
+            await self._emit(ch.app, "ChannelDtmfReceived", digit=digit, duration_ms=duration,
+                    channel=ch.json())
+
+    # Bridges
+
+    def _bridge(self, bridgeId):
+        try:
+            return self.bridges[bridgeId]
+        except KeyError:
+            raise _Error(404, "Bridge not found") from None
+
+    async def _bridges_create(self, bridgeId=None, type="mixing", name=None):
+        if bridgeId is None:
+            bridgeId = self._new_id()
+        br = self.bridges.get(bridgeId)
+        if br is None:
+            br = self.bridges[bridgeId] = _Bridge(bridgeId, type)
+        return br.json()
+
+    async def _bridges_get(self, bridgeId):
+        return self._bridge(bridgeId).json()
+
+    async def _bridges_destroy(self, bridgeId):
+        br = self._bridge(bridgeId)
+        for pb in list(br.playbacks):
+            await self._playback_done(pb)
+        for rec in list(br.recordings):
+            await self._recording_done(rec)
+        for c in list(br.channels):
+            await self._leave(br, self.channels[c])
+        del self.bridges[bridgeId]
+        await self._emit(br.app, "BridgeDestroyed", bridge=br.json())
+
+    async def _bridges_addChannel(self, bridgeId, channel, role=None):
+        br = self._bridge(bridgeId)
+        for c in channel.split(","):
+            ch = self._chan(c)
+            if ch.bridge == br.id:
+                continue
+            if ch.bridge is not None:
+                await self._leave(self.bridges[ch.bridge], ch)
+            ch.bridge = br.id
+            br.channels.add(ch.id)
+            br.app = ch.app
+            await self._emit(ch.app, "ChannelEnteredBridge", bridge=br.json(), channel=ch.json())
+
+    async def _bridges_removeChannel(self, bridgeId, channel):
+        br = self._bridge(bridgeId)
+        for c in channel.split(","):
+            ch = self._chan(c)
+            if ch.bridge != br.id:
+                raise _Error(422, "Channel not in this bridge")
+            await self._leave(br, ch)
+
+    async def _leave(self, br, ch):
+        br.channels.discard(ch.id)
+        ch.bridge = None
+        await self._emit(ch.app, "ChannelLeftBridge", bridge=br.json(), channel=ch.json())
+
+    # Playbacks and recordings
+
+    def _target(self, channelId=None, bridgeId=None):
+        if channelId is not None:
+            return self._chan(channelId), "channel:"+channelId
+        return self._bridge(bridgeId), "bridge:"+bridgeId
+
+    async def _play(self, media, playbackId=None, lang=None, offsetms=None, skipms=None, **kw):
+        obj, uri = self._target(**kw)
+        if playbackId is None:
+            playbackId = self._new_id()
+        pb = {"id": playbackId, "media_uri": media, "target_uri": uri, "language": lang or "en",
+                "state": "playing"}
+        self.playbacks[playbackId] = (pb, obj)
+        obj.playbacks.add(playbackId)
+        await self._emit(obj.app, "PlaybackStarted", playback=pb)
+        await self._later(self._delay("play"), self._playback_done, playbackId)
+        return dict(pb, state="queued")
+
+    _channels_play = _play
+    _bridges_play = _play
+
+    async def _playback_done(self, playbackId):
+        pb = self.playbacks.pop(playbackId, None)
+        if pb is None:
+            return
+        pb, obj = pb
+        obj.playbacks.discard(playbackId)
+        pb["state"] = "done"
+        await self._emit(obj.app, "PlaybackFinished", playback=pb)
+
+    async def _playbacks_get(self, playbackId):
+        try:
+            return self.playbacks[playbackId][0]
+        except KeyError:
+            raise _Error(404, "Playback not found") from None
+
+    async def _playbacks_stop(self, playbackId):
+        if playbackId not in self.playbacks:
+            raise _Error(404, "Playback not found")
+        await self._playback_done(playbackId)
+
+    async def _record(self, name, format="wav", ifExists="fail", **kw):
+        kw = {k: v for k, v in kw.items() if k in ("channelId", "bridgeId")}
+        obj, uri = self._target(**kw)
+        if name in self.recordings:
+            if ifExists == "fail":
+                raise _Error(409, "Recording %s exists" % (name,))
+            await self._recording_done(name)
+        rec = {"name": name, "format": format, "target_uri": uri, "state": "recording"}
+        self.recordings[name] = (rec, obj)
+        obj.recordings.add(name)
+        await self._emit(obj.app, "RecordingStarted", recording=rec)
+        return dict(rec, state="queued")
+
+    _channels_record = _record
+    _bridges_record = _record
+
+    async def _recording_done(self, name):
+        rec = self.recordings.pop(name, None)
+        if rec is None:
+            return
+        rec, obj = rec
+        obj.recordings.discard(name)
+        rec["state"] = "done"
+        await self._emit(obj.app, "RecordingFinished", recording=rec)
+
+    async def _recordings_getLive(self, recordingName):
+        try:
+            return self.recordings[recordingName][0]
+        except KeyError:
+            raise _Error(404, "Recording not found") from None
+
+    async def _recordings_stop(self, recordingName):
+        if recordingName not in self.recordings:
+            raise _Error(404, "Recording not found")
+        await self._recording_done(recordingName)
+
+    _recordings_cancel = _recordings_stop
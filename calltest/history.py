@@ -0,0 +1,220 @@
+"""
+This module stores the results of all test runs on disk.
+
+The log is append-only. Each run is one fixed-size record; test names
+are stored once, in a sidecar file, and records refer to them by number.
+
+Records are written in time order, so a time range is found by binary
+search on the file. The numbers of each test's last ``history.recent``
+records are kept in memory; older runs are found by reading the
+records in the range. The file is read via mmap, so neither large
+histories nor the number of runs need to fit in RAM.
+
+Queries may run in a separate thread while records are appended.
+"""
+
+import math
+import mmap
+import struct
+from array import array
+from bisect import bisect_left
+
+from .metrics import PHASES
+
+# time, test number, outcome, phases
+RECORD = struct.Struct("<dIB3x%df" % len(PHASES))
+RECORD_ID = struct.Struct("<8xI%dx" % (RECORD.size-12))  # just the test number
+
+OK = 0
+FAIL = 1
+
+SCAN = 65536  # records to read at a time when searching the file
+
+
+class History:
+    """
+    The on-disk results log.
+
+    :param cfg: the ``history`` section of the configuration.
+    """
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.path = cfg.file
+        self._ids = {}  # test name > number
+        self._names = []
+        # test number > (first, array of record numbers): all of the
+        # test's records from "first" on
+        self._recent = {}
+        self._t_stop = {}  # test name > end of the last run we stored
+        self._map = None
+        self._map_size = 0
+        self._last = 0  # time of the last record
+
+        try:
+            with open(self.path + ".names", "r") as f:
+                for name in f:
+                    self._add_name(name.rstrip("\n"))
+        except FileNotFoundError:
+            pass
+        self._names_f = open(self.path + ".names", "a")
+
+        self._f = open(self.path, "a+b")
+        n = self._f.tell() // RECORD.size
+        if self._f.tell() != n * RECORD.size:
+            # partial record, from a crash
+            self._f.truncate(n * RECORD.size)
+            self._f.seek(n * RECORD.size)
+        self.n_records = self._n_open = n
+        if n:
+            self._last = self._record(n-1)[0]
+
+    def _add_name(self, name):
+        self._ids[name] = len(self._names)
+        self._names.append(name)
+
+    def _id(self, name):
+        i = self._ids.get(name)
+        if i is None:
+            self._add_name(name)
+            i = self._ids[name]
+            self._names_f.write(name + "\n")
+            self._names_f.flush()
+        return i
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._f.close()
+        self._names_f.close()
+
+    def update(self, call):
+        """
+        Store this test's last run, if it has finished since the last
+        call.
+        """
+        st = call.state
+        t = st.get("t_stop")
+        if t is None or self._t_stop.get(call.name) == t:
+            return
+        self._t_stop[call.name] = t
+        self.add(call.name, t, FAIL if st.get("fail_count") else OK, st.get("phases") or {})
+
+    def add(self, name, t, outcome, phases):
+        """
+        Append a record.
+
+        :param phases: phase name > seconds. Missing phases are stored as NaN.
+        """
+        # keep the file sorted
+        t = max(t, self._last)
+        i = self._id(name)
+        ph = [phases.get(p, math.nan) for p in PHASES]
+        try:
+            self._f.write(RECORD.pack(t, i, outcome, *ph))
+            self._f.flush()
+        except OSError:
+            # don't leave a partial record
+            self._f.truncate(self.n_records * RECORD.size)
+            self._f.seek(self.n_records * RECORD.size)
+            raise
+        self._last = t
+
+        first, r = self._recent.get(i, (self._n_open, None))
+        if r is None:
+            r = array("I")
+        elif len(r) >= 2*self.cfg.recent:
+            # A query in another thread may still use the old array
+            r = r[-self.cfg.recent:]
+            first = r[0]
+        self._recent[i] = (first, r)
+        r.append(self.n_records)
+        self.n_records += 1
+
+    def _mapped(self):
+        # A query in another thread may still use the old map; it's
+        # closed when that's done.
+        n = self.n_records * RECORD.size
+        if self._map_size != n:
+            self._map = mmap.mmap(self._f.fileno(), n, access=mmap.ACCESS_READ) if n else None
+            self._map_size = n
+        return self._map
+
+    def _record(self, i, m=None):
+        return RECORD.unpack_from(m or self._mapped(), i * RECORD.size)
+
+    def records(self, name, t_from=None, t_to=None):
+        """
+        Iterate over this test's records between these times.
+
+        Yields ``(time, outcome, phases)`` tuples. Phases that weren't
+        measured are missing.
+        """
+        i = self._ids.get(name)
+        if i is None:
+            return
+        first, recent = self._recent.get(i, (self._n_open, ()))
+
+        # records appended after this point aren't in the map
+        m = self._mapped()
+        n = len(m) // RECORD.size if m is not None else 0
+        lo = 0 if t_from is None else self._search(m, n, t_from)
+        hi = n if t_to is None else self._search(m, n, math.nextafter(t_to, math.inf))
+
+        # older records: read them
+        for a in range(lo, min(hi, first), SCAN):
+            b = min(a+SCAN, hi, first)
+            for k, (j,) in enumerate(RECORD_ID.iter_unpack(m[a*RECORD.size:b*RECORD.size]), a):
+                if j == i:
+                    yield self._unpack(k, m)
+
+        # recent records: look them up
+        for j in range(bisect_left(recent, max(lo, first)), len(recent)):
+            k = recent[j]
+            if k >= hi:
+                break
+            yield self._unpack(k, m)
+
+    def _search(self, m, n, t):
+        # the first record at or after t
+        lo, hi = 0, n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._record(mid, m)[0] < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _unpack(self, k, m):
+        t, _, outcome, *ph = self._record(k, m)
+        return t, outcome, {p: v for p, v in zip(PHASES, ph) if not math.isnan(v)}
+
+    def aggregate(self, name, t_from, t_to, step):
+        """
+        Summarize this test's runs in ``step``-second intervals.
+
+        Returns a list of dicts with the interval's start, the number of
+        runs and failures, and the average and maximum duration of each
+        phase.
+        """
+        res = []
+        cur = None
+        for t, outcome, ph in self.records(name, t_from, t_to):
+            start = t_from + ((t - t_from) // step) * step
+            if cur is None or cur["t"] != start:
+                cur = dict(t=start, n=0, n_fail=0, avg={}, max={})
+                cnt = {}
+                res.append((cur, cnt))
+            cur["n"] += 1
+            if outcome != OK:
+                cur["n_fail"] += 1
+            for k, v in ph.items():
+                cur["avg"][k] = cur["avg"].get(k, 0) + v
+                cur["max"][k] = max(cur["max"].get(k, 0), v)
+                cnt[k] = cnt.get(k, 0) + 1
+        for cur, cnt in res:
+            # sums to averages
+            for k, v in cur["avg"].items():
+                cur["avg"][k] = v / cnt[k]
+        return [cur for cur, _ in res]
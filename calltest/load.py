@@ -0,0 +1,225 @@
+"""
+This module generates load: one test is run many times in parallel,
+either at a given rate of new calls or with a given number of concurrent
+calls.
+
+The load ramps up to its peak, holds it, and ramps down again. The test's
+mode worker places and checks each call, as in a normal run, but the
+links' capacity is not enforced. Every attempt runs in its own task: the
+generator only spawns it and moves on, so originating a call never waits
+for an earlier one.
+
+Each attempt dials the test's number, followed by a running number of
+``suffix`` digits if that is set. The receiving end of a test can only
+tell concurrent calls apart by the number they dialled, so use this with
+modes that answer their own calls.
+"""
+
+import anyio
+import copy
+import time
+from collections import Counter
+from array import array
+
+from .model import CallState
+from .util import attrdict, percentile
+
+import logging
+logger = logging.getLogger(__name__)
+
+TICK = 0.01  # seconds between generator steps
+
+
+def reason(exc):
+    """A short description of why an attempt failed."""
+    while getattr(exc, "exceptions", None):
+        # a multi-error: report the first interesting part
+        sub = [e for e in exc.exceptions if not isinstance(e, anyio.get_cancelled_exc_class())]
+        exc = (sub or exc.exceptions)[0]
+    if isinstance(exc, TimeoutError):
+        return "timeout"
+    res = type(exc).__name__
+    code = getattr(exc, "status_code", None) or getattr(exc, "cause_code", None)
+    if code is not None:
+        res += ":%s" % (code,)
+    return res
+
+
+class _Window:
+    """Counters for one reporting interval, or for the whole run."""
+    def __init__(self):
+        self.started = 0
+        self.done = 0
+        self.ok = 0
+        self.answered = 0
+        self.pdd = array('d')
+        self.reasons = Counter()
+
+    def add(self, ok, phases, why):
+        self.done += 1
+        if ok:
+            self.ok += 1
+        else:
+            self.reasons[why] += 1
+        if "answer" in phases:
+            self.answered += 1
+        if "ringing" in phases:
+            self.pdd.append(phases.ringing)
+
+    def result(self, seconds):
+        pdd = sorted(self.pdd)
+        return attrdict(
+            started=self.started, done=self.done, ok=self.ok, failed=self.done-self.ok,
+            cps=self.started/seconds if seconds else None,
+            asr=self.answered/self.done if self.done else None,
+            success=self.ok/self.done if self.done else None,
+            pdd_p50=percentile(pdd, 0.5), pdd_p95=percentile(pdd, 0.95),
+            pdd_p99=percentile(pdd, 0.99), pdd_max=pdd[-1] if pdd else None,
+            reasons=dict(self.reasons.most_common()),
+        )
+
+
+class LoadGen:
+    """
+    Run a test as a load generator.
+
+    :param call: The :cls:`calltest.model.Call` to run.
+    :param backends: The :cls:`calltest.backend.Backends` to get an ARI
+                     client from.
+    :param rate: The peak rate of new calls per second.
+    :param concurrency: The peak number of concurrent calls. Exactly one
+                        of ``rate`` and ``concurrency`` must be given.
+    :param ramp: Seconds to ramp up to the peak.
+    :param hold: Seconds to hold the peak.
+    :param down: Seconds to ramp down from the peak.
+    :param suffix: Number of digits of a running number to append to the
+                   dialled number.
+    :param report: Seconds between calls to ``progress``.
+    :param progress: Called with each interval's results. They contain
+                     ``t`` (seconds since the start), ``target`` and
+                     ``active``, plus the fields of :meth:`result`.
+    """
+    def __init__(self, call, backends, *, rate=None, concurrency=None,
+            ramp=0, hold=60, down=0, suffix=0, report=1, progress=None):
+        if (rate is None) == (concurrency is None):
+            raise ValueError("Set either rate or concurrency")
+        self.call = call
+        self.backends = backends
+        self.rate = rate
+        self.concurrency = concurrency
+        self.ramp = ramp
+        self.hold = hold
+        self.down = down
+        self.suffix = suffix
+        self.report = report
+        self.progress = progress
+
+        self.active = 0
+        self.total = _Window()
+        self.lag_max = 0  # how late the generator was, at worst
+        self._win = _Window()
+        self._seq = 0
+        self._t0 = None
+
+    @property
+    def duration(self):
+        return self.ramp + self.hold + self.down
+
+    def target(self, t):
+        """The rate or concurrency we want ``t`` seconds after the start."""
+        peak = self.rate if self.rate is not None else self.concurrency
+        if t < self.ramp:
+            return peak * t / self.ramp
+        t -= self.ramp + self.hold
+        if t < 0:
+            return peak
+        if t < self.down:
+            return peak * (1 - t/self.down)
+        return 0
+
+    async def _start(self, tg):
+        # counted here, not in the task, which starts later
+        c = copy.copy(self.call)
+        c.state = CallState(status="running", t_start=time.time(), phases=attrdict())
+        if self.suffix:
+            nr = self.call.number or self.call.dst.number
+            c.number = "%s%0*d" % (nr, self.suffix, self._seq % 10**self.suffix)
+        self._seq += 1
+        self.active += 1
+        self.total.started += 1
+        self._win.started += 1
+        await tg.spawn(self._attempt, c)
+
+    async def _attempt(self, c):
+        ok, why = False, None
+        try:
+            client = await self.backends.client_for(c)
+            async with anyio.fail_after(c.timeout):
+                await c.mode(client, c)()
+        except anyio.get_cancelled_exc_class():
+            raise
+        except Exception as exc:
+            why = reason(exc)
+            logger.debug("Attempt %s: %r", c.number, exc)
+        else:
+            ok = True
+        finally:
+            self.active -= 1
+        self.total.add(ok, c.state.phases, why)
+        self._win.add(ok, c.state.phases, why)
+
+    async def _generate(self, tg):
+        t0 = self._t0 = time.monotonic()
+        t_last = t_report = t0
+        credit = 0
+        while True:
+            now = time.monotonic()
+            self.lag_max = max(self.lag_max, now - t_last - TICK)
+            t = now - t0
+            if t >= self.duration:
+                break
+            target = self.target(t)
+            if self.rate is not None:
+                credit += target * (now - t_last)
+                while credit >= 1:
+                    credit -= 1
+                    await self._start(tg)
+            else:
+                while self.active < round(target):
+                    await self._start(tg)
+            t_last = now
+
+            if now - t_report >= self.report:
+                self._report(now, t_report, target)
+                t_report = now
+            await anyio.sleep(TICK)
+
+    def _report(self, now, t_last, target):
+        if self.progress is None:
+            return
+        res = self._win.result(now - t_last)
+        self._win = _Window()
+        res.t = now - self._t0
+        res.target = target
+        res.active = self.active
+        self.progress(res)
+
+    async def run(self):
+        """
+        Generate the load, then wait for the remaining calls to finish.
+        """
+        async with anyio.create_task_group() as tg:
+            await tg.spawn(self.backends.run)
+            await self.backends.client_for(self.call)
+            async with anyio.create_task_group() as tg2:
+                await tg2.spawn(self._generate, tg2)
+            await tg.cancel_scope.cancel()
+        return self.result()
+
+    def result(self):
+        """The results of the whole run."""
+        res = self.total.result(self.duration)
+        res.test = self.call.name
+        res.duration = self.duration
+        res.generator_lag_max = self.lag_max
+        return res
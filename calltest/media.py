@@ -0,0 +1,272 @@
+"""
+This module streams a call's audio into calltest.
+
+Instead of asking Asterisk to write a recording, a test with
+``audio.stream`` set adds an ARI "externalMedia" channel to the call's
+bridge. Asterisk sends that channel's audio to a UDP socket of ours, as
+RTP. The frames are sent through the measuring pipeline of
+:mod:`calltest.analysis` as they arrive, in batches of
+``asterisk.media.batch`` seconds; its stages only keep a few counters.
+The raw audio of the last ``asterisk.media.keep`` seconds is kept as
+well, and written to a WAV file only if the test fails.
+
+Tests with ``dtmf.inband`` set use this to read DTMF from the audio,
+instead of relying on Asterisk's DTMF events.
+
+This requires NumPy.
+"""
+
+import anyio
+import struct
+import wave
+from collections import deque
+from contextlib import asynccontextmanager
+
+from asyncari.util import mayNotExist
+from asyncari.state import BridgeState
+
+from .analysis import pipeline, check, AudioError
+from .mode import bridge_pool
+
+import logging
+logger = logging.getLogger(__name__)
+
+MAX_PACKET = 2048
+
+_ulaw = None
+
+
+def rtp_payload(pkt):
+    """
+    The sequence number and payload of an RTP packet, or ``None`` if it
+    isn't one.
+    """
+    if len(pkt) < 12 or pkt[0] >> 6 != 2:
+        return None
+    off = 12 + 4*(pkt[0] & 0x0F)  # CSRCs
+    if pkt[0] & 0x10:  # header extension
+        if len(pkt) < off+4:
+            return None
+        off += 4 + 4*struct.unpack_from("!H", pkt, off+2)[0]
+    end = len(pkt)
+    if pkt[0] & 0x20:  # padding
+        end -= pkt[-1]
+    if end < off:
+        return None
+    return struct.unpack_from("!H", pkt, 2)[0], pkt[off:end]
+
+
+def decoder(format):
+    """
+    Returns a function that converts an RTP payload in this ARI format
+    to 16-bit samples, and the sample rate.
+    """
+    import numpy as np
+    global _ulaw
+
+    if format == "slin":
+        return (lambda p: np.frombuffer(p, dtype=">i2")), 8000
+    if format == "slin16":
+        return (lambda p: np.frombuffer(p, dtype=">i2")), 16000
+    if format == "ulaw":
+        if _ulaw is None:
+            u = ~np.arange(256, dtype=np.uint8)
+            exp = (u >> 4) & 7
+            mag = (((u & 0x0F).astype(np.int32) << 3) + 0x84 << exp) - 0x84
+            _ulaw = np.where(u & 0x80, -mag, mag).astype(np.int16)
+        return (lambda p: _ulaw[np.frombuffer(p, dtype=np.uint8)]), 8000
+    raise ValueError("Unsupported media format: %r" % (format,))
+
+
+class Tap:
+    """
+    The audio stream of one call, and its measurements.
+
+    Don't instantiate this yourself; use :func:`tap`.
+
+    ``result`` contains what :func:`calltest.analysis.measure` returns,
+    plus ``lost``, the number of RTP packets that didn't arrive.
+    """
+    channel = None  # the externalMedia channel
+
+    def __init__(self, client, name, dtmf=False):
+        cfg = client._calltest_config
+        self.client = client
+        self.name = name
+        self.cfg = cfg.asterisk.media
+        self.dir = cfg.asterisk.audio.record
+        self._decode, self.rate = decoder(self.cfg.format)
+        an = cfg.analysis
+        self.result = {"lost": 0}
+        self._pipe = pipeline(self.result, self.rate, frame=an.frame, silence=an.silence,
+                clip=an.clip, tones=an.tones, dtmf=dtmf)
+        self._digit = anyio.create_event()
+        self._flowing = anyio.create_event()
+        self._batch = []
+        self._batched = 0
+        self._max_batch = int(self.cfg.batch * self.rate)
+        self.n_samples = 0
+        self._keep = deque()
+        self._kept = 0
+        self._max_keep = int(self.cfg.keep * self.rate)
+        self._seq = None
+        self._sock = None
+
+    async def attach(self, bridge):
+        """
+        Start streaming the audio of this :cls:`asyncari.model.Bridge`.
+        """
+        host = self.cfg.host or self._sock.address[0]
+        self.channel = await self.client.channels.externalMedia(app=self.client._app,
+                external_host="%s:%d" % (host, self._sock.address[1]), format=self.cfg.format)
+        await bridge.addChannel(channel=self.channel.id)
+
+    async def detach(self):
+        """
+        Stop streaming.
+        """
+        ch, self.channel = self.channel, None
+        if ch is not None:
+            with mayNotExist:
+                await ch.hangup()
+
+    async def _receive(self):
+        async for pkt, _ in self._sock.receive_packets(MAX_PACKET):
+            p = rtp_payload(pkt)
+            if p is None:
+                continue
+            seq, p = p
+            if self._seq is not None:
+                gap = (seq - self._seq - 1) & 0xFFFF
+                if gap < 0x8000:
+                    self.result["lost"] += gap
+                else:
+                    continue  # late or duplicate
+            self._seq = seq
+            x = self._decode(p)
+            if not self.n_samples:
+                await self._flowing.set()
+            self.n_samples += len(x)
+            self._batch.append(x)
+            self._batched += len(x)
+            if self._batched >= self._max_batch:
+                await self._flush()
+
+            self._keep.append(x)
+            self._kept += len(x)
+            while self._kept - len(self._keep[0]) >= self._max_keep:
+                self._kept -= len(self._keep.popleft())
+
+    async def _flush(self):
+        # measuring a packet at a time would be slow
+        import numpy as np
+
+        if not self._batch:
+            return
+        n = len(self.result.get("dtmf", ()))
+        self._pipe.send(np.concatenate(self._batch))
+        self._batch = []
+        self._batched = 0
+        if len(self.result.get("dtmf", ())) > n:
+            evt, self._digit = self._digit, anyio.create_event()
+            await evt.set()
+
+    async def flowing(self):
+        """
+        Wait until audio arrives.
+        """
+        await self._flowing.wait()
+
+    async def digits(self):
+        """
+        Iterate over the in-band DTMF digits, as ``(digit, onset, level)``
+        tuples (see :func:`calltest.analysis.dtmf_detector`), as they
+        arrive. The tap must have been created with ``dtmf`` set.
+        """
+        i = 0
+        while True:
+            d = self.result["dtmf"]
+            while i < len(d):
+                yield d[i]
+                i += 1
+            await self._digit.wait()
+
+    def save(self):
+        """
+        Write the audio we kept to ``asterisk.audio.record``/NAME.wav.
+        """
+        import numpy as np
+
+        path = self.dir + self.name + ".wav"
+        x = np.concatenate(self._keep) if self._keep else np.zeros(0)
+        with wave.open(path, "wb") as f:
+            f.setnchannels(1)
+            f.setsampwidth(2)
+            f.setframerate(self.rate)
+            f.writeframes(x.astype("<i2").tobytes())
+        logger.info("Saved %.1f sec of %s to %s", len(x)/self.rate, self.name, path)
+        return path
+
+
+@asynccontextmanager
+async def tap(worker, state, name, dtmf=False):
+    """
+    Stream and measure the audio that ``state``, a :cls:`ChannelState`
+    or :cls:`BridgeState`, receives, while the context is active.
+    Channels are put into a bridge of their own for this. With ``dtmf``,
+    in-band DTMF is decoded as well.
+
+    Afterwards the results are stored with the worker's
+    :meth:`calltest.mode.BaseWorker.audio_result`. If they violate the
+    test's ``audio`` limits, or the call fails, the last bit of audio is
+    saved.
+    """
+    t = Tap(worker.client, name, dtmf=dtmf)
+    cfg = t.cfg
+    ok = False
+    t._sock = await anyio.create_udp_socket(interface=cfg.bind)
+    try:
+        async with anyio.create_task_group() as tg:
+            await tg.spawn(t._receive)
+            try:
+                if isinstance(state, BridgeState):
+                    await t.attach(state.bridge)
+                    yield t
+                else:
+                    # not a BridgeState: its teardown would hang up the call
+                    pool = await bridge_pool(worker.client)
+                    br = await pool.get()
+                    reuse = False
+                    try:
+                        await br.addChannel(channel=state.channel.id)
+                        await t.attach(br)
+                        yield t
+                    finally:
+                        try:
+                            async with anyio.move_on_after(2, shield=True):
+                                await t.detach()
+                                with mayNotExist:
+                                    await br.removeChannel(channel=state.channel.id)
+                                reuse = True
+                        finally:
+                            async with anyio.move_on_after(2, shield=True):
+                                await pool.put(br, reuse=reuse)
+            finally:
+                async with anyio.open_cancel_scope(shield=True):
+                    await t.detach()
+                await tg.cancel_scope.cancel()
+
+        await t._flush()
+        t.result["duration"] = t.n_samples / t.rate
+        worker.audio_result(name, t.result)
+        try:
+            check(worker.call.audio, name, t.result)
+        except AudioError:
+            pass
+        else:
+            ok = True
+    finally:
+        await t._sock.close()
+        if not ok:
+            async with anyio.open_cancel_scope(shield=True):
+                await anyio.run_in_thread(t.save)
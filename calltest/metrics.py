@@ -0,0 +1,158 @@
+"""
+This module collects timing histograms and renders them in the
+Prometheus text format.
+
+All series are created up front, when the server starts, so a scrape only
+needs to join pre-formatted strings.
+"""
+
+from bisect import bisect_left
+
+PHASES = ("wait", "ringing", "answer", "dtmf", "total")
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _label(v):
+    return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _num(v):
+    return repr(float(v)) if v != int(v) else str(int(v))
+
+
+class Histogram:
+    """
+    A histogram with fixed buckets.
+
+    :param name: the metric name.
+    :param labels: the series' labels, as a string, e.g. ``test="foo"``.
+    :param buckets: the sorted upper bounds of the buckets, without
+                    ``+Inf``.
+    """
+    def __init__(self, name, labels, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets)+1)
+        self.sum = 0.0
+        self.count = 0
+
+        pre = "%s_bucket{%s," % (name, labels)
+        self._lines = [pre+'le="%s"} ' % _num(b) for b in buckets]
+        self._lines.append(pre+'le="+Inf"} ')
+        self._sum = "%s_sum{%s} " % (name, labels)
+        self._count = "%s_count{%s} " % (name, labels)
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, out):
+        n = 0
+        for line, c in zip(self._lines, self.counts):
+            n += c
+            out.append(line + str(n))
+        out.append(self._sum + repr(self.sum))
+        out.append(self._count + str(self.count))
+
+
+class Metrics:
+    """
+    Per-test and per-link phase timings.
+
+    :param cfg: the ``metrics`` section of the configuration.
+    :param checks: the tests to collect timings for. They need ``src``
+                   and ``dst`` attributes with the links they use.
+    """
+    def __init__(self, cfg, checks):
+        self.buckets = sorted(float(b) for b in cfg.buckets)
+        self._checks = checks
+        self._calls = {}  # test name > phase > histogram
+        self._links = {}  # link name > phase > histogram
+        self._t_stop = {}  # test name > end of the last run we counted
+        self._counters = {}  # test name > (runs line, fails line)
+        self._hists = {}  # test name > histograms to record its runs in
+
+        for c in checks.values():
+            self.add(c)
+
+    def add(self, call):
+        """
+        Set up the series for a new or reconfigured test.
+        """
+        name = call.name
+        buckets = self.buckets
+        lb = 'test="%s"' % (_label(name),)
+        if name not in self._calls:
+            self._calls[name] = {p: Histogram("calltest_phase_seconds", lb+',phase="%s"' % p, buckets)
+                    for p in PHASES}
+            self._counters[name] = ("calltest_runs_total{%s} " % lb,
+                    "calltest_failures_total{%s} " % lb)
+        hs = self._hists[name] = [self._calls[name]]
+        for l in (getattr(call, "src", None), getattr(call, "dst", None)):
+            if l is None:
+                continue
+            lh = self._links.get(l.name)
+            if lh is None:
+                lb = 'link="%s"' % (_label(l.name),)
+                lh = self._links[l.name] = {p: Histogram("calltest_link_phase_seconds",
+                        lb+',phase="%s"' % p, buckets) for p in PHASES}
+            if not any(h is lh for h in hs):
+                hs.append(lh)
+
+    def remove(self, name):
+        """
+        Drop this test's series.
+        """
+        for d in (self._calls, self._counters, self._hists, self._t_stop):
+            d.pop(name, None)
+
+    def update(self, call):
+        """
+        Record the phase timings of this test's last run, if it has
+        finished since the last call.
+        """
+        st = call.state
+        t = st.get("t_stop")
+        if t is None or self._t_stop.get(call.name) == t:
+            return
+        self._t_stop[call.name] = t
+        phases = st.get("phases")
+        if not phases:
+            return
+        hs = self._hists[call.name]
+        for p, v in phases.items():
+            if p not in PHASES:
+                continue
+            for h in hs:
+                h[p].observe(v)
+
+    def render(self):
+        """
+        Return all metrics in Prometheus' text format.
+        """
+        out = []
+        out.append("# HELP calltest_runs_total Number of test runs.")
+        out.append("# TYPE calltest_runs_total counter")
+        checks = self._checks
+        for name, (r, _) in self._counters.items():
+            if name in checks:
+                out.append(r + str(checks[name].state.get("n_run", 0)))
+        out.append("# HELP calltest_failures_total Number of failed test runs.")
+        out.append("# TYPE calltest_failures_total counter")
+        for name, (_, f) in self._counters.items():
+            if name in checks:
+                out.append(f + str(checks[name].state.get("n_fail", 0)))
+
+        out.append("# HELP calltest_phase_seconds Duration of test phases.")
+        out.append("# TYPE calltest_phase_seconds histogram")
+        for hs in self._calls.values():
+            for h in hs.values():
+                h.render(out)
+        out.append("# HELP calltest_link_phase_seconds Duration of test phases, by link.")
+        out.append("# TYPE calltest_link_phase_seconds histogram")
+        for hs in self._links.values():
+            for h in hs.values():
+                h.render(out)
+        out.append("")
+        return "\n".join(out)
@@ -2,12 +2,14 @@
 
 import anyio
 import random
+import time
+from collections import deque
 from contextlib import asynccontextmanager
 from functools import partial
 from ..util import attrdict
 from asyncari.util import mayNotExist
 
-from asyncari.state import DTMFHandler, SyncEvtHandler, ChannelState
+from asyncari.state import DTMFHandler, SyncEvtHandler, ChannelState, BridgeState
 from asyncari.model import Channel
 from asyncari.state import SyncPlay as _SyncPlay
 
@@ -19,14 +21,16 @@ logger = logging.getLogger(__name__)
 class IncomingCollisionError(RuntimeError):
     pass
 
+# The channel has no state until the reply to originating it, or its
+# first event, arrives
+
 async def wait_answered(chan_state):
-    await chan_state.channel.wait_for(lambda: chan_state.channel.state == "Up")
+    await chan_state.channel.wait_for(lambda: chan_state.channel.json.get("state") == "Up")
 
 async def wait_ringing(chan_state):
-    await chan_state.channel.wait_for(lambda: chan_state.channel.state in {"Up", "Ringing", "Ring"})
+    await chan_state.channel.wait_for(lambda: chan_state.channel.json.get("state") in {"Up", "Ringing", "Ring"})
 
-class ConfigError(RuntimeError):
-    pass
+from calltest.registry import ConfigError
 
 class WrongCallerID(ValueError):
     pass
@@ -39,11 +43,72 @@ class DTMFError(RuntimeError):
     def __str__(self):
         return "DTMFError(%s %s)" % (self.digit,self.dts)
 
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *tb):
+        return False
+
+_NO_SPAN = _NoSpan()
+
+
+class _Span:
+    __slots__ = ("worker", "name", "t0")
+
+    def __init__(self, worker, name):
+        self.worker = worker
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.monotonic()
+        return self
+
+    def __exit__(self, typ, exc, tb):
+        self.worker.add_span(self.name, self.t0, time.monotonic(), exc)
+        return False
+
+
+def span_of(state, name):
+    """
+    A context manager that traces ``name`` in the worker which owns this
+    channel state.
+
+    The span is named ``in.NAME`` or ``out.NAME``, depending on the
+    channel. If there's no such worker, nothing is traced.
+    """
+    while state is not None:
+        tr = getattr(state, "_calltest_trace", None)
+        if tr is not None:
+            worker, side = tr
+            return worker.span(side+"."+name)
+        state = getattr(state, "_prev", None)
+    return _NO_SPAN
+
+
 class SyncPlay(_SyncPlay):
     def __init__(self, base, filename):
         filename = base.client._calltest_config.asterisk.audio.play + filename
         super().__init__(base, filename)
 
+    async def _await(self):
+        with span_of(self._prev, "play"):
+            return await super()._await()
+
+def listening(state):
+    """
+    Returns an event that's set when this state machine, once started,
+    listens to its channel's events, i.e. after its ``on_start`` hook.
+    """
+    evt = anyio.create_event()
+    on_start = state.on_start
+
+    async def hook():
+        await on_start()
+        await evt.set()
+    state.on_start = hook
+    return evt
+
 async def start_record(state, filename, format="wav", ifExists="overwrite", **kw):
     #rec = chan_state.client._calltest_config.asterisk.audio.record
     evt = anyio.create_event()
@@ -64,6 +129,8 @@ def random_dtmf(len=6):
 class ExpectDTMF(DTMFHandler, SyncEvtHandler):
     """
     A state macine that processes incoming DTMF.
+
+    ``times`` notes when each expected digit arrived.
     """
     expected = ""
 
@@ -71,6 +138,7 @@ class ExpectDTMF(DTMFHandler, SyncEvtHandler):
         self.dtmf = dtmf
         self.dtmf_pos = 0
         self.may_repeat = may_repeat
+        self.times = []
         super().__init__(*a, **kw)
 
     @property
@@ -88,45 +156,211 @@ class ExpectDTMF(DTMFHandler, SyncEvtHandler):
             if self.may_repeat and self.dtmf_pos > 0 and self.dtmf[self.dtmf_pos-1] == evt.digit:
                 return
             raise DTMFError(evt.digit, self.dts)
+        self.times.append(time.monotonic())
         self.dtmf_pos += 1
         if self.dtmf_pos == len(self.dtmf):
             await self.done()
 
+    async def _await(self):
+        with span_of(self._prev, "dtmf"):
+            return await super()._await()
+
+
+def nr_intl(nr, dialplan):
+    """
+    Convert a phone number to international format.
+
+    Returns ``None`` if that's not possible.
+    """
+    if nr[0] == '+':
+        return nr
+    if dialplan.country == '1': ## NANP
+        if nr[0] == '1':
+            return '+'+nr
+        elif nr[0:3] == "011":
+            return '+'+nr[3:]
+        elif len(nr) == 7:
+            return "+1"+dialplan.city+nr
+        elif len(nr) == 10:
+            return "+1"+nr
+        else:
+            return None
+    else:
+        if nr.startswith(dialplan.intl):
+            return '+'+nr[len(dialplan.intl):]
+        elif nr.startswith(dialplan.natl):
+            return '+'+dialplan.country+nr[len(dialplan.natl):]
+        else:
+            return '+'+dialplan.country+dialplan.city+nr
+
 
 def nr_check(dialed, cid, dialplan):
     """Verify that the incoming callerid matches the dialled number"""
     if dialed[0] != '+':
         return cid.endswith(dialed)
-    if cid[0] != '+':
-        if dialplan.country == '1': ## NANP
-            if cid[0] == '1':
-                cid = '+'+cid
-            elif cid[0:3] == "011":
-                cid = '+'+cid[3:]
-            elif len(cid) == 7:
-                cid = "+1"+dialplan.city+cid
-            elif len(cid) == 10:
-                cid = "+1"+cid
-            else:
-                return False
-        else:
-            if cid.startswith(dialplan.intl):
-                cid = '+'+cid[len(dialplan.intl):]
-            elif cid.startswith(dialplan.natl):
-                cid = '+'+dialplan.country+cid[len(dialplan.natl):]
-            else:
-                cid = '+'+dialplan.country+dialplan.city+cid
-    return dialed == cid
+    return dialed == nr_intl(cid, dialplan)
 
 
 class BaseWorker:
+    defer = False  # raise LinkBusy instead of queueing?
+    links = ()  # the links a test needs: src and/or dst
+    spans = None  # this run's trace, if the test has ``trace`` set
+    audio = None  # this run's audio measurements, if any
+
     def __init__(self, client, call):
         self.client = client
         self.call = call
-    
+        self.t0 = time.monotonic()
+        if getattr(call, "trace", False):
+            self.spans = call.state.spans = []
+
     def repr(self):
         return "<%s:%s>" % (self.__class__.__name__, self.call.name)
 
+    def record(self, phase, seconds):
+        """
+        Note how long a phase of this test run took.
+
+        The phases of the current run are in the test's ``state.phases``.
+        """
+        self.call.state.phases[phase] = seconds
+
+    def audio_result(self, name, res):
+        """
+        Note the measurements of a recording or audio stream.
+
+        The results of the current run are in the test's ``state.audio``.
+        """
+        if self.audio is None:
+            self.audio = self.call.state.audio = {}
+        self.audio[name] = res
+
+    def check_audio(self):
+        """
+        Raise :cls:`calltest.analysis.AudioError` if the measured audio
+        violates the test's ``audio`` limits.
+
+        This is done after the call, so that a bad recording doesn't
+        disrupt the call's channel handlers.
+        """
+        if not self.audio:
+            return
+        from calltest.analysis import check
+        for name, r in self.audio.items():
+            check(self.call.audio, name, r)
+
+    @asynccontextmanager
+    async def capture(self, state, name):
+        """
+        A context manager that records the audio ``state`` (a channel or
+        bridge state) receives, to ``name``, while it's active.
+
+        If the test has ``audio.stream`` set, the audio is streamed and
+        measured instead, see :mod:`calltest.media`; call
+        :meth:`check_audio` after the call. If ``name`` is ``None``, this
+        does nothing.
+        """
+        if name is None:
+            yield None
+        elif self.call.audio.stream:
+            from calltest.media import tap
+            async with tap(self, state, name) as t:
+                yield t
+        else:
+            rec = await start_record(state, name)
+            try:
+                yield rec
+            finally:
+                async with anyio.open_cancel_scope(shield=True):
+                    with mayNotExist:
+                        await rec.stop(recordingName=name)
+
+    @asynccontextmanager
+    async def bridge(self, factory=None, **kw):
+        """
+        A context manager for a mixing bridge, borrowed from the client's
+        :cls:`BridgePool`, that's run by the state machine ``factory``
+        (a :cls:`PooledBridgeState`, the default). ``kw`` is passed to it.
+        """
+        pool = await bridge_pool(self.client)
+        async with (factory or PooledBridgeState)(await pool.get(), **kw).task as br:
+            yield br
+
+    async def expect_dtmf(self, state, dtmf, side, ready=None):
+        """
+        Wait until ``state``, a channel state, receives this DTMF sequence.
+        ``ready`` is set when it's listening.
+
+        If the test has ``dtmf.inband`` set, the digits are decoded from
+        the channel's audio, see :mod:`calltest.media`; their onsets and
+        levels are stored with :meth:`audio_result` as TEST_SIDE_dtmf.
+        Otherwise Asterisk's DTMF events are used.
+
+        Returns when each digit arrived, in seconds. Only the
+        differences between these times are meaningful.
+        """
+        cfg = self.call.dtmf
+        if not cfg.inband:
+            e = ExpectDTMF(state, dtmf=dtmf, ready=ready, may_repeat=cfg.may_repeat)
+            await e
+            return e.times
+
+        from calltest.media import tap
+        pos = 0
+        times = []
+        async with tap(self, state, "%s_%s_dtmf" % (self.call.name, side), dtmf=True) as t:
+            # a digit that starts before the audio does would be missed
+            await t.flowing()
+            if ready is not None:
+                await ready.set()
+            with span_of(state, "dtmf"):
+                async for digit, onset, level in t.digits():
+                    logger.debug("DTMF: %s at %.3f, %.1f dB for %s/%s", digit, onset,
+                            level, dtmf[:pos], dtmf[pos:])
+                    if dtmf[pos] != digit:
+                        if cfg.may_repeat and pos > 0 and dtmf[pos-1] == digit:
+                            continue
+                        raise DTMFError(digit, dtmf[:pos]+'/'+dtmf[pos:])
+                    times.append(onset)
+                    pos += 1
+                    if pos == len(dtmf):
+                        break
+        return times
+
+    def span(self, name):
+        """
+        A context manager that records how long its body takes::
+
+            with self.span("setup"):
+                await do_something()
+
+        Does nothing if tracing is off.
+        """
+        if self.spans is None:
+            return _NO_SPAN
+        return _Span(self, name)
+
+    def add_span(self, name, t0, t1, exc=None):
+        """
+        Add a span to this run's trace. ``t0`` and ``t1`` are from
+        :func:`time.monotonic`.
+        """
+        if self.spans is None:
+            return
+        s = dict(name=name, start=round(t0-self.t0, 4), dur=round(t1-t0, 4))
+        if exc is not None:
+            s["error"] = repr(exc)
+        self.spans.append(s)
+
+    def trace(self, state, side):
+        """
+        Mark this channel state as belonging to this test run, so that
+        handlers on it can trace themselves.
+        """
+        if self.spans is not None:
+            state._calltest_trace = (self, side)
+        return state
+
     async def __call__(self):
         """
         Single-shot test-once handler, propagates exceptions.
@@ -146,13 +380,15 @@ class BaseWorker:
                         await c.hang_up()
 
 class BaseInWorker(BaseWorker):
+    links = ("dst",)
+
     def __init__(self, *a, **kw):
         super().__init__(*a, **kw)
         self.in_logger = logging.getLogger("%s.in.%s" % (__name__, self.call.dst.name))
 
     @property
     def lock(self):
-        return self.call.dst.lock
+        return locked_links(self.call.dst, call=self.call, defer=self.defer)
 
     def in_call(self, delayed=False, state_factory=ChannelState):
         """
@@ -178,12 +414,14 @@ class BaseInWorker(BaseWorker):
             await anyio.sleep(pre_delay)
             if handle_ringing:
                 ring_delay = self.call.delay.ring
-                await state.channel.ring()
+                with self.span("in.ring"):
+                    await state.channel.ring()
                 await anyio.sleep(ring_delay)
             if handle_answer:
                 answer_delay = self.call.delay.answer
-                await state.channel.answer()
-                await wait_answered(state)
+                with self.span("in.answer"):
+                    await state.channel.answer()
+                    await wait_answered(state)
                 await anyio.sleep(answer_delay)
 
     async def url_open(self, dest_nr, url):
@@ -209,56 +447,327 @@ class BaseInWorker(BaseWorker):
         self.in_logger.info("Exec %s",args)
         await trio.run_process(args)
 
+class InDispatcher:
+    """
+    Routes incoming calls to the tests that wait for them.
+
+    There's one of these per ARI client. Waiting tests are indexed by link
+    name and dialled number. Calls that arrive before their test is ready
+    are kept for ``asterisk.early.keep`` seconds.
+    """
+    def __init__(self, client):
+        self.client = client
+        self.cfg = client._calltest_config.asterisk
+        self._index = {}  # link name > number > [waiting _InCall]
+        self._early = deque()  # (time, link name, dialled number, channel)
+        self._listener = client.on_channel_event("StasisStart", filter=self._filter)
+
+    async def start(self):
+        """Start listening. Returns when the listener is active."""
+        self._listener.open()
+        await self.client.taskgroup.spawn(self._run)
+
+    def _key(self, nr):
+        if not nr:
+            return None
+        if nr[0] != '+':
+            return nr  # site-local extension
+        return nr_intl(nr, self.cfg.dialplan)
+
+    @staticmethod
+    def _filter(evt):
+        args = getattr(evt, 'args', None)
+        return args and args[0] != ":dialed"  # ignore our own outgoing calls
+
+    async def _run(self):
+        try:
+            while True:
+                res = None
+                async with anyio.move_on_after(self.cfg.early.keep if self._early else None):
+                    res = await self._listener.__anext__()
+                if res is not None:
+                    ic_, evt_ = res
+                    args = evt_.args
+                    await self._route(args[0], args[1] if len(args) > 1 else "", ic_['channel'])
+                await self._expire()
+        finally:
+            self._listener.close()
+
+    def _find(self, link, dialed):
+        idx = self._index.get(link)
+        if not idx:
+            return None
+        if dialed:
+            w = idx.get(dialed) or idx.get(nr_intl(dialed, self.cfg.dialplan))
+            if w:
+                return w
+            for k,w in idx.items():
+                # site-local extension with a prefix
+                if k is not None and k[0] != '+' and w and dialed.endswith(k):
+                    return w
+            return idx.get(None)
+        for w in idx.values():
+            if w:
+                return w
+        return None
+
+    async def _route(self, link, dialed, channel):
+        waiting = self._find(link, dialed)
+        if not waiting:
+            logger.debug("Early incall on %s %s: %r", link, dialed, channel)
+            if len(self._early) >= self.cfg.early.max:
+                await self._drop(*self._early.popleft())
+            self._early.append((time.monotonic(), link, dialed, channel))
+            return
+
+        # If more than one test waits for this number, use the caller ID
+        # to pick the right one
+        ic = waiting[0]
+        if len(waiting) > 1:
+            for w in waiting:
+                if w._cid_ok(channel):
+                    ic = w
+                    break
+        self.unregister(ic)
+        await ic._offer(channel)
+
+    async def _drop(self, t, link, dialed, channel):
+        logger.error("Unclaimed incall on %s %s: %r", link, dialed, channel)
+        with mayNotExist:
+            await channel.hangup()
+
+    async def _expire(self):
+        t = time.monotonic() - self.cfg.early.keep
+        while self._early and self._early[0][0] < t:
+            await self._drop(*self._early.popleft())
+
+    async def register(self, ic):
+        """
+        Register a waiting incoming call handler. A matching call that
+        arrived early is delivered immediately.
+        """
+        link = ic.worker.call.dst.name
+        self._index.setdefault(link, {}).setdefault(self._key(ic.number), []).append(ic)
+        for e in self._early:
+            t, e_link, dialed, channel = e
+            if e_link == link and self._find(link, dialed):
+                self._early.remove(e)
+                await self._route(link, dialed, channel)
+                break
+
+    def unregister(self, ic):
+        idx = self._index.get(ic.worker.call.dst.name, {})
+        waiting = idx.get(self._key(ic.number), ())
+        if ic in waiting:
+            waiting.remove(ic)
+
+
+async def in_dispatcher(client):
+    """Returns the client's :cls:`InDispatcher`, starting it if necessary"""
+    try:
+        return client._calltest_dispatch
+    except AttributeError:
+        client._calltest_dispatch = d = InDispatcher(client)
+        await d.start()
+        return d
+
+
+class BridgePool:
+    """
+    Mixing bridges that tests borrow, so that Asterisk doesn't have to
+    create and destroy one for every call.
+
+    There's one of these per ARI client; see :func:`bridge_pool`. At most
+    ``asterisk.bridges.pool`` idle bridges are kept. Bridges that
+    Asterisk destroys are dropped, and one that has been idle for more
+    than ``asterisk.bridges.check`` seconds is verified before it's
+    handed out again.
+    """
+    def __init__(self, client):
+        self.client = client
+        self.cfg = client._calltest_config.asterisk.bridges
+        self._idle = []  # (time returned, bridge), most recent last
+        self._out = set()  # IDs of borrowed bridges
+        self._gone = set()  # IDs of borrowed bridges that Asterisk destroyed
+        self._closed = False
+        self._listener = client.on_bridge_event("BridgeDestroyed")
+        self.stats = attrdict(created=0, reused=0, evicted=0)
+
+    async def start(self):
+        """Start listening. Returns when the listener is active."""
+        self._listener.open()
+        await self.client.taskgroup.spawn(self._run)
+
+    async def _run(self):
+        try:
+            async for br, evt in self._listener:
+                self._evict(br.id)
+        finally:
+            self._listener.close()
+
+    def _evict(self, id):
+        if id in self._out:
+            self._gone.add(id)
+            return
+        for i, (t, br) in enumerate(self._idle):
+            if br.id == id:
+                del self._idle[i]
+                self.stats.evicted += 1
+                break
+
+    async def _alive(self, br):
+        try:
+            br = await self.client.bridges.get(bridgeId=br.id)
+        except Exception as exc:
+            logger.debug("Bridge %s is gone: %r", br.id, exc)
+            return False
+        if br.json.get("channels"):
+            logger.warning("Bridge %s isn't empty: %s", br.id, br.json["channels"])
+            with mayNotExist:
+                await br.destroy()
+            return False
+        return True
+
+    async def get(self):
+        """
+        Borrow an empty mixing bridge. Return it with :meth:`put`.
+        """
+        while self._idle:
+            t, br = self._idle.pop()
+            if time.monotonic()-t > self.cfg.check and not await self._alive(br):
+                self.stats.evicted += 1
+                continue
+            self.stats.reused += 1
+            break
+        else:
+            br = await self.client.bridges.create(type="mixing", bridgeId=self.client.generate_id("B"))
+            self.stats.created += 1
+        self._out.add(br.id)
+        return br
+
+    async def put(self, br, reuse=True):
+        """
+        Return a borrowed bridge.
+
+        If ``reuse`` is false, or the pool is full, it's destroyed.
+        Otherwise it's checked, and kept only if it's empty.
+        """
+        self._out.discard(br.id)
+        if br.id in self._gone:
+            self._gone.discard(br.id)
+            self.stats.evicted += 1
+            return
+        if reuse and not self._closed and len(self._idle) < self.cfg.pool:
+            if await self._alive(br):
+                self._idle.append((time.monotonic(), br))
+            else:
+                self.stats.evicted += 1
+            return
+        with mayNotExist:
+            await br.destroy()
+
+    async def close(self):
+        """
+        Destroy the idle bridges. Bridges that are returned later are
+        destroyed too.
+        """
+        self._closed = True
+        idle, self._idle = self._idle, []
+        for t, br in idle:
+            with mayNotExist:
+                await br.destroy()
+
+
+async def bridge_pool(client):
+    """Returns the client's :cls:`BridgePool`, starting it if necessary"""
+    try:
+        return client._calltest_bridges
+    except AttributeError:
+        client._calltest_bridges = p = BridgePool(client)
+        await p.start()
+        return p
+
+
+class PooledBridgeState(BridgeState):
+    """
+    A :cls:`BridgeState` for a bridge from the client's
+    :cls:`BridgePool`. When it ends, the channels in the bridge, and the
+    ones it dialled, are removed and hung up, and the bridge is returned
+    instead of destroyed.
+    """
+    def __init__(self, bridge, **kw):
+        super().__init__(bridge, **kw)
+        self.calls = set()  # BridgeState's is shared by all instances
+
+    async def teardown(self, hangup_reason="normal"):
+        if self.bridge is None:
+            return
+        reuse = False
+        async with anyio.move_on_after(2, shield=True):
+            try:
+                for ch in set(self.bridge.channels) | self.calls:
+                    # Removing is synchronous, hanging up isn't.
+                    try:
+                        await self.bridge.removeChannel(channel=ch.id)
+                    except Exception as exc:
+                        logger.debug("%s not in %s: %r", ch, self.bridge, exc)
+                    with mayNotExist:
+                        await ch.hang_up(reason=hangup_reason)
+                reuse = True
+            finally:
+                pool = await bridge_pool(self.client)
+                await pool.put(self.bridge, reuse=reuse)
+
+
 class _InCall:
-    _in_scope = None
     _in_channel = None
     _evt = None
     _state = None
+    _disp = None
 
     def __init__(self, worker, delayed=False, state_factory=ChannelState):
         self.worker = worker
         self.delayed = delayed
         self.state_factory = state_factory
 
-    async def _listen(self, evt):
-        w = self.worker
-        number = w.call.number or w.call.dst.number
-        async with anyio.open_cancel_scope() as sc:
-            self._in_scope = sc
-            self.worker.in_logger.debug("Wait for call: using %s", w.call.dst.name)
-            async with w.client.on_start_of(w.call.dst.name) as d:
-                await evt.set()
-                url = getattr(w.call,'url', None)
-                if url is not None:
-                    await self.worker.client.taskgroup.spawn(w.url_open, number, url)
-                args = getattr(w.call,'exec', None)
-                if args is not None:
-                    await self.worker.client.taskgroup.spawn(w.exec_open, number, args)
-                async for ic_, evt_ in d:
-                    if self._in_channel is None:
-                        self._in_channel = ic_['channel']
-                        await self._evt.set()
-                    else:
-                        self.worker.in_logger.error("Duplicate incall on %s %s %s", w.call.dst.name, ic_, evt_)
-                        #raise IncomingCollisionError(w.call.dst.name, ic_, evt_)
+    @property
+    def number(self):
+        return self.worker.call.number or self.worker.call.dst.number
+
+    def _cid_ok(self, channel):
+        call = self.worker.call
+        if not call.check_callerid or call.src is None or not call.src.number:
+            return True
+        cid = channel.caller['number']
+        return not cid or nr_check(call.src.number, cid, self.worker.client._calltest_config.asterisk.dialplan)
+
+    async def _offer(self, channel):
+        self._in_channel = channel
+        await self._evt.set()
 
     async def __aenter__(self):
-        self.worker.in_logger.debug("Enter InCall %s",self.worker.call.dst.name)
+        w = self.worker
+        w.in_logger.debug("Enter InCall %s",w.call.dst.name)
         self._evt = anyio.create_event()
-        evt = anyio.create_event()
-        await self.worker.client.taskgroup.spawn(self._listen, evt)
-        await evt.wait()
-        if self.delayed:
-            return self
-
+        self._disp = await in_dispatcher(w.client)
+        await self._disp.register(self)
         try:
-            await self._evt.wait()
-            self._state = self.state_factory(self._in_channel)
+            url = getattr(w.call,'url', None)
+            if url is not None:
+                await w.client.taskgroup.spawn(w.url_open, self.number, url)
+            args = getattr(w.call,'exec', None)
+            if args is not None:
+                await w.client.taskgroup.spawn(w.exec_open, self.number, args)
+            if self.delayed:
+                return self
+
+            with w.span("in.incoming"):
+                await self._evt.wait()
+            self._state = w.trace(self.state_factory(self._in_channel), "in")
             await self._state.start_task()
             return self._state
         except BaseException:
-            if self._in_scope is not None:
-                await self._in_scope.cancel()
+            self._disp.unregister(self)
             raise
 
     @asynccontextmanager
@@ -270,10 +779,11 @@ class _InCall:
         machine in the background.
         """
         self.worker.in_logger.debug("Wait for call")
-        await self._evt.wait()
+        with self.worker.span("in.incoming"):
+            await self._evt.wait()
         if state_factory is None:
             state_factory = self.state_factory
-        ics = state_factory(self._in_channel)
+        ics = self.worker.trace(state_factory(self._in_channel), "in")
         self.worker.in_logger.debug("Wait for call: %r", ics)
         async with ics.task:
             yield ics
@@ -285,9 +795,9 @@ class _InCall:
                 if self._state is not None:
                     await self._state.done()
                     self._state = None
-                if self._in_scope is not None:
-                    await self._in_scope.cancel()
-                    self._in_scope = None
+                if self._disp is not None:
+                    self._disp.unregister(self)
+                    self._disp = None
                 if self._in_channel is not None:
                     self.worker.in_logger.debug("Hang up %r", self._in_channel)
                     with mayNotExist:
@@ -296,6 +806,8 @@ class _InCall:
                 self._in_channel = None
 
 class BaseOutWorker(BaseWorker):
+    links = ("src",)
+
     def __init__(self, *a, **kw):
         super().__init__(*a, **kw)
         if self.call.src is None:
@@ -304,7 +816,7 @@ class BaseOutWorker(BaseWorker):
 
     @property
     def lock(self):
-        return self.call.src.lock
+        return locked_links(self.call.src, call=self.call, defer=self.defer)
 
     @asynccontextmanager
     async def out_call(self, dest_nr=None, state_factory=ChannelState):
@@ -323,6 +835,10 @@ class BaseOutWorker(BaseWorker):
                 await out_mgr.channel.wait_up()
                 pass # do whatever else with it
 
+        The body starts while the request to originate the call is still
+        in progress, so the channel might not exist yet. Wait for its
+        state to change (e.g. :func:`wait_ringing`) before using it. If
+        originating fails, the body is cancelled.
         """
         ep = self.call.src.channel
         if dest_nr is None:
@@ -334,6 +850,7 @@ class BaseOutWorker(BaseWorker):
         else:
             ep = ep.replace('{number}', dest_nr)
         oc = None
+        sent = False  # the request to originate the call
         self.out_logger.debug("Calling %s", ep)
 
         try:
@@ -350,35 +867,96 @@ class BaseOutWorker(BaseWorker):
             vars = {'CALLERID(name)': src_name, 'CALLERID(num)': src_number,
                     'CONNECTEDLINE(name)': src_name, 'CONNECTEDLINE(num)': src_number,}
             chan_id = self.client.generate_id("C")
-            oc = Channel(self.client, id=chan_id)
-            ocs = state_factory(oc)
+            # with its ID in the JSON, so that hanging up works even if
+            # originating it failed
+            oc = Channel(self.client, json={"id": chan_id})
+            ocs = self.trace(state_factory(oc), "out")
+
+            # Events may overtake the reply to the originate request, so
+            # the state machine must listen before that's sent.
+            ready = listening(ocs)
             await ocs.start_task()
-            await self.client.channels.originateWithId(channelId=chan_id, endpoint=ep, app=self.client._app,
-                    appArgs=[":dialed",dest_nr], variables=vars, callerId=src_cid)
-            self.out_logger.debug("Call placed: %r", ocs)
-            yield ocs
+            await ready.wait()
+
+            async def originate():
+                nonlocal sent
+                # The reply updates the channel, which would undo the
+                # events that overtook it
+                newer = None
+                def seen(evt):
+                    nonlocal newer
+                    newer = dict(oc.json)
+                h = oc.on_event("*", seen)
+
+                # not if we're cancelled already: the client may be gone
+                await anyio.sleep(0)
+                # shielded: if the request is cancelled halfway, we can't
+                # tell whether there's a channel to hang up
+                try:
+                    async with anyio.open_cancel_scope(shield=True):
+                        sent = True
+                        with self.span("out.originate"):
+                            await self.client.channels.originateWithId(channelId=chan_id, endpoint=ep,
+                                    app=self.client._app, appArgs=[":dialed",dest_nr],
+                                    variables=vars, callerId=src_cid)
+                finally:
+                    h.close()
+                if newer is not None:
+                    oc.json.update(newer)
+                self.out_logger.debug("Call placed: %r", ocs)
+
+            # Don't wait for the reply: the caller only waits for events
+            # anyway, and the other end may see the call before it
+            # arrives. If originating fails, the caller is cancelled.
+            t0 = time.monotonic()
+            async with anyio.create_task_group() as tg:
+                await tg.spawn(originate)
+                async with anyio.create_task_group() as tg2:
+                    await tg2.spawn(self._progress, ocs, t0)
+                    try:
+                        yield ocs
+                    finally:
+                        await tg2.cancel_scope.cancel()
         finally:
             async with anyio.open_cancel_scope(shield=True):
                 self.out_logger.debug("Hang up %r", oc)
-                if oc is not None:
+                if sent:
                     with mayNotExist:
                         await oc.hangup()
 
+    async def _progress(self, state, t0):
+        # records how long the call took to ring, and to be answered
+        try:
+            await wait_ringing(state)
+            t1 = time.monotonic()
+            self.record("ringing", t1-t0)
+            self.add_span("out.ringing", t0, t1)
+            await wait_answered(state)
+            t2 = time.monotonic()
+            self.record("answer", t2-t1)
+            self.add_span("out.answer", t1, t2)
+        except Exception as exc:
+            self.out_logger.debug("Progress: %r", exc)
+
     async def connect_out(self, state, handle_answer=True, handle_ringing=False):
         if handle_ringing:
             ring_delay = self.call.delay.ring
-            await wait_ringing(state)
+            with self.span("out.wait_ringing"):
+                await wait_ringing(state)
             await anyio.sleep(ring_delay)
         elif handle_answer:
             answer_delay = self.call.delay.answer
-            await wait_answered(state)
+            with self.span("out.wait_answer"):
+                await wait_answered(state)
             await anyio.sleep(answer_delay)
 
 
 class BaseDualWorker(BaseInWorker,BaseOutWorker):
+    links = ("src", "dst")
+
     @property
     def lock(self):
-        return locked_links(self.call.src, self.call.dst)
+        return locked_links(self.call.src, self.call.dst, call=self.call, defer=self.defer)
 
     @asynccontextmanager
     async def dual_call(self):
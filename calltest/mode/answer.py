@@ -8,9 +8,7 @@ immediately if there is no outgoing audio.
 import anyio
 
 from . import BaseInWorker
-from . import SyncPlay, start_record
-from asyncari.util import mayNotExist
-from asyncari.state import BridgeState
+from . import SyncPlay
 
 import logging
 logger = logging.getLogger(__name__)
@@ -24,16 +22,11 @@ class Worker(BaseInWorker):
             outfile = self.call.audio.dst_out
             infile = self.call.audio.dst_in
 
-            async with BridgeState.new(self.client) as br:
+            async with self.bridge() as br:
                 await br.add(icm.channel)
 
                 if outfile is not None:
-                    if infile is not None:
-                        res = await start_record(br, infile)
-                    else:
-                        res = None
-                    await SyncPlay(br, outfile)
-                    if res is not None:
-                        with mayNotExist:
-                            await res.stop(recordingName=infile)
+                    async with self.capture(br, infile):
+                        await SyncPlay(br, outfile)
+        self.check_audio()
                 
@@ -6,18 +6,27 @@ Then, the callee records until the caller has played their audio file.
 Then, both hang up.
 
 Synchronization is done in code, not via the phone call.
+
+If ``audio.analyze`` is set, the recordings are analysed afterwards; see
+:mod:`calltest.analysis`. With ``audio.stream``, the audio is measured
+while it's streamed instead; see :mod:`calltest.media`. The results are
+in the test's ``state.audio``.
 """
 
 import anyio
+import time
 
-from asyncari.util import mayNotExist
-from . import BaseDualWorker, SyncPlay, start_record
+from . import BaseDualWorker, SyncPlay
 
 import logging
 logger = logging.getLogger(__name__)
 
 class Worker(BaseDualWorker):
     async def __call__(self):
+        # when each recording started, and when the sound that's recorded
+        # in it started to play
+        t_rec = {}
+        t_play = {}
         async with self.dual_call() as (icm, ocm):
             # Coordinate between the tasks; DTMF sending must wait
             # until the receiver is listening
@@ -32,31 +41,63 @@ class Worker(BaseDualWorker):
                 await self.connect_in(icm)
                 await sync1.wait()
                 if outfile:
+                    t_play["src_in"] = time.monotonic()
                     await SyncPlay(icm, outfile)
-                res = await start_record(icm, infile) if infile is not None else None
-                await sync2.set()
-                await sync3.wait()
-                if res is not None:
-                    with mayNotExist:
-                        await res.stop(recordingName=infile)
-
+                async with self.capture(icm, infile):
+                    t_rec["dst_in"] = time.monotonic()
+                    await sync2.set()
+                    await sync3.wait()
 
             async def run_out():
                 outfile = self.call.audio.src_out
                 infile = self.call.audio.src_in
 
                 await self.connect_out(ocm)
-                res = await start_record(ocm, infile) if infile is not None else None
-                await sync1.set()
-                await sync2.wait()
-                if res is not None:
-                    with mayNotExist:
-                        await res.stop(recordingName=infile)
+                async with self.capture(ocm, infile):
+                    t_rec["src_in"] = time.monotonic()
+                    await sync1.set()
+                    await sync2.wait()
                 if outfile is not None:
+                    t_play["dst_in"] = time.monotonic()
                     await SyncPlay(ocm, outfile)
                 await sync3.set()
-                
+
             await icm.taskgroup.spawn(run_in)
             await ocm.taskgroup.spawn(run_out)
             await sync3.wait()
 
+        if self.call.audio.analyze and not self.call.audio.stream:
+            await self.analyze(t_rec, t_play)
+        self.check_audio()
+
+    async def analyze(self, t_rec, t_play):
+        """
+        Analyse both recordings and store the results in the test's
+        ``state.audio``.
+
+        The one-way ``delay`` is the position of the other side's sound
+        in the recording, minus the time between starting to record and
+        starting to play.
+        """
+        from calltest.analysis import run_analysis
+
+        cfg = self.client._calltest_config
+        audio = self.call.audio
+
+        async def one(rec, played):
+            name = getattr(audio, rec)
+            played = getattr(audio, played)
+            ref = None
+            if played is not None and cfg.asterisk.audio.sounds is not None:
+                ref = cfg.asterisk.audio.sounds + played + ".wav"
+            with self.span("analyze."+rec):
+                r = await run_analysis(cfg.analysis, cfg.asterisk.audio.record + name + ".wav", ref,
+                        dtmf=self.call.dtmf.inband)
+            if r.get("offset") is not None and rec in t_play:
+                r["delay"] = r["offset"] - (t_play[rec] - t_rec[rec])
+            self.audio_result(name, r)
+
+        async with anyio.create_task_group() as tg:
+            for rec, played in (("src_in", "dst_out"), ("dst_in", "src_out")):
+                if getattr(audio, rec) is not None:
+                    await tg.spawn(one, rec, played)
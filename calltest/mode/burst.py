@@ -0,0 +1,115 @@
+"""
+Exchange DTMF in both directions at once, at increasing speed.
+
+Both sides send a random DTMF sequence at the same time. This is
+repeated for each digit timing in ``dtmf.sweep``, slowest first, until a
+sequence doesn't arrive correctly, in time and evenly spaced. The
+fastest timing that worked is the link's DTMF rate.
+
+The test fails only if the first timing doesn't work.
+"""
+
+import anyio
+import time
+from functools import partial
+
+from . import BaseDualWorker
+from . import DTMFError, random_dtmf
+from calltest.registry import ConfigError
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class JitterError(RuntimeError):
+    """The DTMF digits didn't arrive evenly spaced."""
+    def __init__(self, jitter, limit):
+        self.jitter = jitter
+        self.limit = limit
+
+    def __str__(self):
+        return "JitterError(%.3f > %.3f)" % (self.jitter, self.limit)
+
+
+def jitter(times):
+    """
+    How far these arrival times deviate from being evenly spaced, at
+    most, in seconds. Also returns the mean distance between them.
+    """
+    n = len(times)-1
+    if n < 1:
+        return 0, 0
+    period = (times[-1]-times[0]) / n
+    return max(abs(t-times[0]-i*period) for i,t in enumerate(times)), period
+
+
+def _dtmf_failed(exc):
+    # True if this exception, or all parts of a multi-error, are due to
+    # DTMF that didn't arrive correctly
+    sub = getattr(exc, "exceptions", None)
+    if sub:
+        return all(_dtmf_failed(e) for e in sub)
+    return isinstance(exc, (DTMFError, JitterError, TimeoutError))
+
+
+class Worker(BaseDualWorker):
+    async def __call__(self):
+        cfg = self.call.dtmf
+        if not cfg.sweep:
+            raise ConfigError("Test %s: dtmf.sweep is empty" % (self.call.name,))
+        async with self.dual_call() as (icm, ocm):
+            async with anyio.create_task_group() as tg:
+                await tg.spawn(self.connect_in, icm)
+                await tg.spawn(self.connect_out, ocm)
+
+            fastest = None
+            for ms in cfg.sweep:
+                t0 = time.monotonic()
+                try:
+                    jit = await self._step(icm, ocm, ms)
+                except Exception as exc:
+                    if fastest is None or not _dtmf_failed(exc):
+                        raise
+                    logger.debug("%s: %d msec failed: %r", self.call.name, ms, exc)
+                    break
+                if fastest is None:
+                    self.record("dtmf", time.monotonic()-t0)
+                fastest = ms
+                self.record("dtmf_fastest", 2*ms/1000)
+                self.record("dtmf_jitter", jit)
+                # in-band DTMF is seen when a digit starts, not when it
+                # ends; don't let the last one run into the next step
+                await anyio.sleep(ms/1000)
+
+            for l in (self.call.src, self.call.dst):
+                l.dtmf_fastest = 2*fastest/1000
+                l.dtmf_jitter = jit
+
+    async def _step(self, icm, ocm, ms):
+        """
+        Send DTMF both ways, with tones and gaps of ``ms`` milliseconds.
+        Returns the worst jitter.
+        """
+        cfg = self.call.dtmf
+        in_dtmf = random_dtmf(len=cfg.len)
+        out_dtmf = random_dtmf(len=cfg.len)
+        in_ready = anyio.create_event()
+        out_ready = anyio.create_event()
+        res = []
+
+        async def expect(state, dtmf, side, ready):
+            j, period = jitter(await self.expect_dtmf(state, dtmf, side, ready=ready))
+            if j > period * cfg.jitter:
+                raise JitterError(j, period * cfg.jitter)
+            res.append(j)
+
+        with self.span("dtmf.%d" % ms):
+            async with anyio.fail_after(2*ms/1000*cfg.len + cfg.slack):
+                async with anyio.create_task_group() as tg:
+                    await tg.spawn(expect, icm, out_dtmf, "in", in_ready)
+                    await tg.spawn(expect, ocm, in_dtmf, "out", out_ready)
+                    await in_ready.wait()
+                    await out_ready.wait()
+                    await tg.spawn(partial(icm.channel.sendDTMF, dtmf=in_dtmf, between=ms, duration=ms))
+                    await tg.spawn(partial(ocm.channel.sendDTMF, dtmf=out_dtmf, between=ms, duration=ms))
+        return max(res)
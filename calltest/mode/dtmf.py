@@ -2,15 +2,17 @@
 Exchange DTMF signalling.
 
 Caller and receiver each select a random DTMF sequence whcih they send to
-the other side.
+the other side. With ``dtmf.inband``, the digits are decoded from the
+audio instead of relying on Asterisk's DTMF events.
 
 The callee sends first.
 """
 
 import anyio
+import time
 
 from . import BaseDualWorker
-from . import ExpectDTMF, random_dtmf
+from . import random_dtmf
 
 import logging
 logger = logging.getLogger(__name__)
@@ -30,18 +32,21 @@ class Worker(BaseDualWorker):
             async def run_in():
                 await self.connect_in(icm)
                 await sync1.wait()
-                await icm.channel.sendDTMF(dtmf=in_dtmf, between=0.5)
-                await ExpectDTMF(icm, dtmf=out_dtmf, ready=sync2, may_repeat=self.call.dtmf.may_repeat)
+                await icm.channel.sendDTMF(dtmf=in_dtmf)
+                await self.expect_dtmf(icm, out_dtmf, "in", ready=sync2)
                 await sync3.set()
 
             async def run_out():
                 await self.connect_out(ocm)
-                await ExpectDTMF(ocm, dtmf=in_dtmf, ready=sync1, may_repeat=self.call.dtmf.may_repeat)
+                await self.expect_dtmf(ocm, in_dtmf, "out", ready=sync1)
                 await sync2.wait()
-                await ocm.channel.sendDTMF(dtmf=out_dtmf, between=0.5)
+                await ocm.channel.sendDTMF(dtmf=out_dtmf)
                 await sync3.wait()
                 
             await icm.taskgroup.spawn(run_in)
             await ocm.taskgroup.spawn(run_out)
+            await sync1.wait()
+            t0 = time.monotonic()
             await sync3.wait()
+            self.record("dtmf", time.monotonic()-t0)
 
@@ -6,8 +6,7 @@ import anyio
 
 from . import BaseOutWorker
 from . import wait_ringing
-from . import SyncPlay, start_record
-from asyncari.util import mayNotExist
+from . import SyncPlay
 
 import logging
 logger = logging.getLogger(__name__)
@@ -20,12 +19,6 @@ class Worker(BaseOutWorker):
             outfile = self.call.audio.src_out
             infile = self.call.audio.src_in
             if outfile is not None:
-                if infile is not None:
-                    res = await start_record(ocm, infile)
-                else:
-                    res = None
-                await SyncPlay(ocm, outfile)
-                if res is not None:
-                    with mayNotExist:
-                        await res.stop(recordingName=infile)
-                
+                async with self.capture(ocm, infile):
+                    await SyncPlay(ocm, outfile)
+        self.check_audio()
@@ -5,14 +5,13 @@ Incoming call that records its audio until the originator hangs up.
 import anyio
 
 from . import BaseInWorker
-from . import SyncPlay, start_record
-from asyncari.util import mayNotExist
-from asyncari.state import BridgeState, DTMFHandler
+from . import SyncPlay, PooledBridgeState
+from asyncari.state import DTMFHandler
 
 import logging
 logger = logging.getLogger(__name__)
 
-class RecBridgeState(DTMFHandler, BridgeState):
+class RecBridgeState(DTMFHandler, PooledBridgeState):
     def __init__(self, *a, rec_evt=None, **k):
         super().__init__(*a, **k)
         self._rec_evt = rec_evt
@@ -30,19 +29,13 @@ class Worker(BaseInWorker):
             infile = self.call.audio.dst_in
 
             rec_evt = anyio.create_event()
-            async with RecBridgeState.new(self.client, rec_evt=rec_evt) as br:
+            async with self.bridge(RecBridgeState, rec_evt=rec_evt) as br:
                 await br.add(icm.channel)
 
-                if infile is not None:
-                    res = await start_record(br, infile)
-                else:
-                    res = None
-
-                if outfile is not None:
-                    await SyncPlay(br, outfile)
-
-                if res is not None:
-                    await rec_evt.wait()
-                    with mayNotExist:
-                        await res.stop(recordingName=infile)
+                async with self.capture(br, infile):
+                    if outfile is not None:
+                        await SyncPlay(br, outfile)
+                    if infile is not None:
+                        await rec_evt.wait()
+        self.check_audio()
                 
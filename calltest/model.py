@@ -2,29 +2,123 @@
 # calltest data model
 
 import anyio
-import importlib
 import time
 import math
 
 from contextlib import asynccontextmanager, AsyncExitStack
+from collections import deque
+from collections.abc import Mapping
 from functools import partial
 import traceback
 
-from .util import attrdict, combine_dict
+from .util import attrdict, merge_defaults, frozen, cancelled, NotGiven
 from .default import DEFAULT
+from .registry import get_mode
 
 import logging
 logger = logging.getLogger(__name__)
 
+WAIT_SAMPLES = 100  # per link, for wait time percentiles
+BUDGET_PERIOD = 3600  # seconds; links' call budget is per hour
+
+class LinkBusy(RuntimeError):
+    """
+    Too many tests are waiting for this link. The run should be deferred.
+    """
+    def __init__(self, link):
+        super().__init__(link.name)
+        self.link = link
+
+    def __str__(self):
+        return "LinkBusy(%s)" % (self.link.name,)
+
+class CallState:
+    """
+    The accumulated status of a test.
+
+    Fields that have not been set yet are missing, both as attributes and
+    in :meth:`to_json`.
+    """
+    __slots__ = (
+        "status", "running", "waiting", "exc", "last_exc",
+        "t_start", "t_wait", "t_stop", "t_next",
+        "ct_wait", "ct_run", "phases", "spans",
+        "n_run", "n_fail", "n_defer", "fail_map", "fail_count",
+        "retry_after", "repeat_after", "timeout", "audio", "ok_count",
+    )
+
+    def __init__(self, **kw):
+        for k,v in kw.items():
+            setattr(self,k,v)
+
+    @classmethod
+    def from_json(cls, data):
+        """
+        Build a state from :meth:`to_json`'s output. Unknown fields are
+        ignored.
+        """
+        self = cls()
+        for k in cls.__slots__:
+            v = data.get(k, NotGiven)
+            if v is not NotGiven:
+                setattr(self,k,v)
+        return self
+
+    def to_json(self):
+        """
+        The fields that have been set, as a dict.
+        """
+        res = {}
+        for k in self.__slots__:
+            v = getattr(self, k, NotGiven)
+            if v is not NotGiven:
+                res[k] = v
+        return res
+
+    def get(self, k, default=None):
+        if k not in self.__slots__:
+            return default
+        return getattr(self, k, default)
+
+    def update(self, d=(), **kw):
+        for k,v in dict(d, **kw).items():
+            setattr(self,k,v)
+
+    def __repr__(self):
+        return "<%s %r>" % (self.__class__.__name__, self.to_json())
+
+
+class _Waiter:
+    def __init__(self, call, seq, n):
+        self.call = call
+        self.seq = seq
+        self.n = n
+        self.evt = anyio.create_event()
+
 class Link:
-    def __init__(self, name, channel, number, prio=0, **kw):
+    n_admitted = 0
+    n_deferred = 0
+    budget = 0  # calls per hour that the scheduler may start
+    dtmf_fastest = None  # seconds per digit, as measured by the last "burst" test
+    dtmf_jitter = None
+    _backend = None  # calltest.backend.Backend
+    _records = ("queue",)  # sub-configs that are stored as frozen records
+
+    def __init__(self, name, channel, number, prio=0, capacity=1, **kw):
         self.name = name
         self.channel = channel
         self.number = number
         self._prio = prio
+        self.capacity = capacity
         for k,v in kw.items():
+            if k in self._records and isinstance(v, Mapping):
+                v = frozen(v)
             setattr(self,k,v)
-        self.lock = anyio.create_lock()
+        self._busy = 0
+        self._seq = 0
+        self._waiting = []
+        self._waits = deque(maxlen=WAIT_SAMPLES)
+        self._calls = deque()  # times the scheduler started a call
 
     def __repr__(self):
         return "<%s:%s>" % (self.__class__.__name__,self.name)
@@ -37,25 +131,169 @@ class Link:
             other = other.name
         return self.name == other
 
+    async def reconfigure(self, cfg):
+        """
+        Apply a changed configuration. Tests that are using or waiting for
+        this link are not affected.
+        """
+        self._cfg = cfg
+        kw = dict(cfg)
+        self.channel = kw.pop("channel")
+        self.number = kw.pop("number")
+        self._prio = kw.pop("prio", 0)
+        self.capacity = kw.pop("capacity", 1)
+        for k,v in kw.items():
+            if k in self._records and isinstance(v, Mapping):
+                v = frozen(v)
+            setattr(self,k,v)
+        # admit waiting tests if the capacity has increased
+        await self.release(0)
+
     @property
     def prio(self):
         """Relative priority. Used for deadlock avoidance."""
         return (self._prio, self.name)
 
+    def _next_waiter(self):
+        if self.queue.policy == "oldest":
+            # the test that has been idle for the longest time goes first
+            return min(self._waiting, key=lambda w: (w.call.state.get("t_stop", 0), w.seq))
+        return self._waiting[0]
+
+    async def acquire(self, call, n=1, defer=False):
+        """
+        Wait until ``n`` of this link's channels are free.
+
+        :param call: The test that wants to use this link.
+        :param n: The number of channels to allocate.
+        :param defer: if set, raise :cls:`LinkBusy` instead of queueing
+                      when ``queue.depth`` tests are already waiting.
+        """
+        if n > self.capacity:
+            raise ValueError("%s: need %d channels, capacity is %d" % (self.name, n, self.capacity))
+        t_wait = time.time()
+        if self._busy+n <= self.capacity and not self._waiting:
+            self._busy += n
+        else:
+            if defer and len(self._waiting) >= self.queue.depth:
+                self.n_deferred += 1
+                raise LinkBusy(self)
+            self._seq += 1
+            w = _Waiter(call, self._seq, n)
+            self._waiting.append(w)
+            try:
+                await w.evt.wait()
+            except BaseException:
+                if w in self._waiting:
+                    self._waiting.remove(w)
+                else:
+                    # we got the link but can't use it
+                    async with anyio.open_cancel_scope(shield=True):
+                        await self.release(n)
+                raise
+        self.n_admitted += 1
+        self._waits.append(time.time()-t_wait)
+
+    async def release(self, n=1):
+        """
+        Release ``n`` channels, and admit the next waiting test(s) (if any).
+        """
+        self._busy -= n
+        while self._waiting:
+            w = self._next_waiter()
+            if self._busy+w.n > self.capacity:
+                break
+            self._waiting.remove(w)
+            self._busy += w.n
+            await w.evt.set()
+
+    def _recent_calls(self):
+        calls = self._calls
+        t = time.monotonic() - BUDGET_PERIOD
+        while calls and calls[0] < t:
+            calls.popleft()
+        return calls
+
+    def spend(self):
+        """
+        Count a call against this link's ``budget``.
+        """
+        self._calls.append(time.monotonic())
+
+    def budget_wait(self):
+        """
+        Seconds until another call fits into this link's ``budget``.
+        """
+        calls = self._recent_calls()
+        if not self.budget or len(calls) < self.budget:
+            return 0
+        return calls[-self.budget] + BUDGET_PERIOD - time.monotonic()
+
+    @asynccontextmanager
+    async def slot(self, call, n=1, defer=False):
+        """
+        Context manager to use ``n`` of this link's channels.
+        """
+        await self.acquire(call, n=n, defer=defer)
+        try:
+            yield self
+        finally:
+            async with anyio.open_cancel_scope(shield=True):
+                await self.release(n)
+
+    @property
+    def stats(self):
+        """
+        Queue depth and wait time percentiles of this link.
+        """
+        waits = sorted(self._waits)
+        res = attrdict(
+            capacity=self.capacity,
+            busy=self._busy,
+            waiting=len(self._waiting),
+            depth=self.queue.depth,
+            policy=self.queue.policy,
+            n_admitted=self.n_admitted,
+            n_deferred=self.n_deferred,
+        )
+        if self.budget:
+            res.budget = self.budget
+            res.calls_hour = len(self._recent_calls())
+        if self.dtmf_fastest is not None:
+            res.dtmf_fastest = self.dtmf_fastest
+            res.dtmf_jitter = self.dtmf_jitter
+        if waits:
+            n = len(waits)-1
+            res.wait = {
+                "p50": waits[n//2],
+                "p90": waits[n*9//10],
+                "p99": waits[n*99//100],
+                "max": waits[-1],
+            }
+        return res
+
 
 @asynccontextmanager
-async def locked_links(*locks):
+async def locked_links(*links, call=None, defer=False):
     """
-    Given a number of :cls:`Link` objects, lock them all in an order that
-    prevents deadlocks.
+    Given a number of :cls:`Link` objects, allocate a channel on each of
+    them, in an order that prevents deadlocks. A link that's mentioned
+    more than once gets all of its channels allocated in one step.
+
+    :param call: the test that wants to use these links.
+    :param defer: raise :cls:`LinkBusy` if one of the links' wait queues
+                  is full.
 
     Usage::
-        async with lock(src, dst):
+        async with locked_links(src, dst, call=call):
             await process(src,dst)
     """
+    counts = {}
+    for l in links:
+        counts[l] = counts.get(l, 0) + 1
     async with AsyncExitStack() as s:
-        for l in sorted(locks, key=lambda x: x.prio):
-            await s.enter_async_context(l.lock)
+        for l in sorted(counts, key=lambda x: x.prio):
+            await s.enter_async_context(l.slot(call, n=counts[l], defer=defer))
         yield s
 
 
@@ -65,81 +303,200 @@ def gen_links(cfg):
     for k,v in cfg.links.items():
         if k == DEFAULT:
             continue
-        v = combine_dict(v, default, cls=attrdict)
+        v = merge_defaults(v, default, cls=attrdict)
         l = Link(name=k, **v)
+        l._cfg = v
         res[k] = l
     return res
 
+def link_groups(calls, links=()):
+    """
+    Partition the links used by these calls into groups, so that both
+    ends of each call are in the same group.
+
+    :param links: additional links, which become single-link groups if
+                  no call uses them.
+    Returns a list of ``(links, calls)`` tuples, both being lists.
+    """
+    parent = {}
+    def find(l):
+        while parent[l] is not l:
+            parent[l] = l = parent[parent[l]]
+        return l
+
+    for l in links:
+        parent.setdefault(l, l)
+    for c in calls:
+        ends = [l for l in (c.src, c.dst) if l is not None]
+        for l in ends:
+            parent.setdefault(l, l)
+        if len(ends) == 2:
+            a,b = find(ends[0]),find(ends[1])
+            if a is not b:
+                parent[a] = b
+
+    res = {}
+    for l in parent:
+        res.setdefault(find(l), ([],[]))[0].append(l)
+    for c in calls:
+        l = c.src if c.src is not None else c.dst
+        if l is not None:
+            res[find(l)][1].append(c)
+    return list(res.values())
+
+
+def assign_groups(calls, links, load, pin, kind):
+    """
+    Distribute the link groups of these calls (see :func:`link_groups`)
+    to bins, e.g. backends or workers, so that each bin gets about the
+    same number of tests.
+
+    :param load: dict of bin > number of tests it already has. Its keys
+                 are the valid bins. Updated.
+    :param pin: function that returns the bins a link is assigned to,
+                if any. A group goes to the bin its links are pinned to.
+    :param kind: what a bin is, for error messages.
+    Returns a list of ``(bin, links, calls)`` tuples.
+    """
+    groups = []
+    for g_links, g_calls in link_groups(calls, links):
+        pinned = set()
+        for l in g_links:
+            pinned.update(pin(l))
+        if len(pinned) > 1:
+            raise ValueError("Links %s are used together but assigned to different %ss %s" % (
+                ",".join(sorted(l.name for l in g_links)), kind, ",".join(str(b) for b in sorted(pinned))))
+        b = pinned.pop() if pinned else None
+        if b is not None and b not in load:
+            raise ValueError("Link %s: unknown %s %r" % (g_links[0].name, kind, b))
+        groups.append((b, g_links, g_calls))
+
+    # pinned groups first, then the largest remaining groups go to the
+    # least loaded bin
+    groups.sort(key=lambda g: (g[0] is None, -len(g[2]), g[1][0].name))
+    res = []
+    for b, g_links, g_calls in groups:
+        if b is None:
+            b = min(load, key=load.get)
+        load[b] += len(g_calls)
+        res.append((b, g_links, g_calls))
+    return res
+
+
 class Call:
     error = None
     err_count = 0
     _delay = None  # event for starting
+    _sched = None  # scheduler, in server mode
+    _due = None  # scheduled start, used by the scheduler
     scope = None  # scope for stopping
+    _records = ("test", "delay", "dtmf", "audio")  # sub-configs that are stored as frozen records
 
     def __init__(self, links, name, *, timeout, mode="dtmf", info="-", src=None, dst=None, **kw):
         self.name = name
-        self.mode = importlib.import_module("calltest.mode."+mode).Worker
+        self._mode = get_mode(mode)
         self.src = links[src] if src is not None else None
         self.dst = links[dst] if dst is not None else None
+        self._mode.check(self)
         self.info = info
         self.timeout = timeout
-        self.state = attrdict(status="new", ct_wait=0, ct_run=0)
-        self.state.t_start=time.time()
+        self.state = CallState(status="new", ct_wait=0, ct_run=0, t_start=time.time())
         for k,v in kw.items():
+            if k in self._records and isinstance(v, Mapping):
+                v = frozen(v)
             setattr(self,k,v)
         self.lock = anyio.create_lock()
 
     def __repr__(self):
         return "<%s:%s>" % (self.__class__.__name__,self.name)
 
-    async def __call__(self, client):
-        runner = self.mode(client, self)
+    @property
+    def mode(self):
+        """This test's worker class."""
+        return self._mode.worker
+
+    async def __call__(self, backends, defer=False):
+        """
+        Run this test once.
+
+        :param backends: the :cls:`calltest.backend.Backends` to get an
+                         ARI client from.
+        :param defer: if set, raise :cls:`LinkBusy` instead of waiting
+                      when a link's wait queue is full.
+        """
+        started = False
         self.state.t_wait=time.time()
+        self.state.phases=phases=attrdict()
         self.state.status="waiting"
         self.state.waiting=True
         try:
+            client = await backends.client_for(self)
+            runner = self.mode(client, self)
+            runner.defer = defer
             async with runner.lock:
+                started = True
                 self.state.waiting=False
                 self.state.running=True
                 self.state.status="running"
                 self.state.t_start=time.time()
-                self.state.ct_wait += self.state.t_start-self.state.t_wait
+                phases.wait = self.state.t_start-self.state.t_wait
+                runner.add_span("wait", runner.t0, time.monotonic())
+                self.state.ct_wait += phases.wait
                 async with anyio.fail_after(self.timeout):
                     try:
                         await runner()
                     except BaseException as exc:
-                        logger.exception("Oops %r", exc)
+                        if not cancelled(exc):
+                            logger.exception("Oops %r", exc)
                         raise
+        except LinkBusy:
+            self.state.waiting=False
+            self.state.status="deferred"
+            raise
         finally:
-            self.state.status="idle"
-            self.state.running=False
-            self.state.t_stop=time.time()
-            self.state.ct_run += self.state.t_stop-self.state.t_start
+            if started:
+                self.state.running=False
+                self.state.t_stop=time.time()
+                phases.total = self.state.t_stop-self.state.t_start
+                self.state.ct_run += phases.total
+            if self.state.status != "deferred":
+                self.state.waiting=False
+                self.state.status="idle"
 
-    async def _run(self,client):
+    async def _run(self,backends):
         state = self.state
+        deferred = False
         async with anyio.open_cancel_scope() as sc:
             self.scope = sc
             try:
                 logger.debug("START %s",self.name)
-                await self(client)
+                await self(backends, defer=True)
+            except LinkBusy as exc:
+                logger.debug("DEFER %s: %s", self.name, exc)
+                deferred = True
+                state.n_defer += 1
             except anyio.get_cancelled_exc_class():
                 state.exc = "Canceled"
                 if self.scope is not None:
                     state.n_fail += 1
                     state.fail_count += 1
+                    state.ok_count = 0
                     state.fail_map.append(True)
                 raise
             except Exception as exc:
                 state.exc = traceback.format_exc().split('\n')
                 state.n_fail += 1
                 state.fail_count += 1
+                state.ok_count = 0
                 state.fail_map.append(True)
             else:
+                if state.fail_count or state.ok_count is not None:
+                    state.ok_count = (state.ok_count or 0) + 1
                 state.fail_count = 0 
                 state.fail_map.append(False)
             finally:
-                state.n_run += 1
+                if not deferred:
+                    state.n_run += 1
 
                 if any(state.fail_map):
                     del state.fail_map[:-20]
@@ -149,7 +506,7 @@ class Call:
                 self.scope = None
                 logger.debug("END %s",self.name)
 
-    async def run(self, client, updated=None):
+    async def run(self, backends, updated=None):
         """
         Background task runner for this test, stores exceptions.
 
@@ -163,19 +520,7 @@ class Call:
         else:
             updated = partial(updated, self)
 
-        state = self.state
-        state.update({
-            "n_run": 0, # total
-            "n_fail": 0, # total
-
-            "running": False,
-            "last_exc": None,
-            "fail_map": [], # last 20 or whatever
-            "fail_count": 0,
-            "retry_after": self.test.retry,
-            "repeat_after": self.test.repeat,
-            "timeout": self.timeout,
-        })
+        self.setup_state()
 
         if self.test.skip:
             # on demand only
@@ -184,25 +529,60 @@ class Call:
                 self._delay = anyio.create_event()
                 await self._delay.wait()
                 await updated()
-                await self._run(client)
+                await self._run(backends)
 
         else:
             while True:
                 await updated()
-                await self._run(client)
+                await self._run(backends)
                 await updated()
                 self._delay = anyio.create_event()
-                if state.fail_count > 0:
-                    dly = self.test.retry
-                else:
-                    dly = self.test.repeat
-                async with anyio.move_on_after(dly):
+                async with anyio.move_on_after(self.next_delay()):
                     await self._delay.wait()
 
+    def setup_state(self):
+        """
+        Initialize the accumulated test status for background runs.
+        """
+        self.state.update({
+            "n_run": 0, # total
+            "n_fail": 0, # total
+            "n_defer": 0, # link was too busy
+
+            "running": False,
+            "last_exc": None,
+            "fail_map": [], # last 20 or whatever
+            "fail_count": 0,
+            "ok_count": None, # successes since the last failure
+            "retry_after": self.test.retry,
+            "repeat_after": self.test.repeat,
+            "timeout": self.timeout,
+        })
+
+    def next_delay(self):
+        """
+        Seconds until this test should run again.
+        """
+        if self.state.status == "deferred":
+            return self.test.defer
+        if self.state.fail_count > 0:
+            return self.test.retry
+        # back off after a failure
+        n = self.state.get("ok_count")
+        t = self.test
+        if not n or t.backoff <= 1 or not 0 < t.retry < t.repeat:
+            return t.repeat
+        # ok_count keeps growing, the power must not overflow
+        if n-1 >= math.log(t.repeat / t.retry, t.backoff):
+            return t.repeat
+        return min(t.repeat, t.retry * t.backoff ** (n-1))
+
     async def test_start(self):
         """
         Start this test, either prematurely or at all.
         """
+        if self._sched is not None:
+            return await self._sched.trigger(self)
         if self._delay is None or self._delay.is_set():
             return False
         await self._delay.set()
@@ -226,9 +606,102 @@ def gen_calls(links, cfg):
     for k,v in cfg.calls.items():
         if k == DEFAULT:
             continue
-        v = combine_dict(v, default, cls=attrdict)
+        v = merge_defaults(v, default, cls=attrdict)
         c = Call(links, name=k, **v)
+        c._cfg = v
         res[k] = c
     return res
 
 
+class Reconfig:
+    """
+    The difference between the current links and tests and a new
+    configuration.
+
+    Creating this object only checks the new configuration and creates
+    new :cls:`Link` and :cls:`Call` objects as required; :meth:`apply`
+    then updates the ``links`` and ``calls`` dicts.
+
+    Changed links are modified in place. Changed tests are replaced by
+    new objects which inherit the old one's state. Everything else is
+    left alone.
+
+    Attributes: ``added``, ``removed``: lists of tests; ``changed``: list
+    of ``(old, new)`` tests; ``new_links``: list of links.
+    """
+    def __init__(self, links, calls, cfg):
+        self.links = links
+        self.calls = calls
+
+        default = cfg.links[DEFAULT]
+        lcfg = {k: merge_defaults(v, default, cls=attrdict)
+                for k,v in cfg.links.items() if k != DEFAULT}
+        default = cfg.calls[DEFAULT]
+        ccfg = {k: merge_defaults(v, default, cls=attrdict)
+                for k,v in cfg.calls.items() if k != DEFAULT}
+
+        self.new_links = []
+        self.changed_links = []  # (link, cfg)
+        self.removed_links = [l for k,l in links.items() if k not in lcfg]
+        all_links = {}
+        for k,v in lcfg.items():
+            l = links.get(k)
+            if l is None:
+                l = Link(name=k, **v)
+                l._cfg = v
+                self.new_links.append(l)
+            elif l._cfg != v:
+                for attr in ("backend","worker"):
+                    if v.get(attr) != l._cfg.get(attr):
+                        logger.warning("Link %s: changing '%s' requires a restart", k, attr)
+                        v[attr] = l._cfg.get(attr)
+                if l._cfg != v:
+                    self.changed_links.append((l, v))
+            all_links[k] = l
+
+        self.added = []
+        self.changed = []
+        self.removed = [c for k,c in calls.items() if k not in ccfg]
+        for k,v in ccfg.items():
+            c = calls.get(k)
+            if c is not None and c._cfg == v:
+                for l in (c.src, c.dst):
+                    if l is not None and l.name not in all_links:
+                        raise ValueError("Test %s: link %s was removed" % (k, l.name))
+                continue
+            try:
+                n = Call(all_links, name=k, **v)
+            except KeyError as exc:
+                raise ValueError("Test %s: unknown link %s" % (k, exc)) from None
+            n._cfg = v
+            if c is None:
+                self.added.append(n)
+            else:
+                self.changed.append((c, n))
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed
+                or self.new_links or self.changed_links or self.removed_links)
+
+    async def apply(self):
+        """
+        Update the links and tests.
+        """
+        for l in self.removed_links:
+            del self.links[l.name]
+        for l in self.new_links:
+            self.links[l.name] = l
+        for l, v in self.changed_links:
+            await l.reconfigure(v)
+
+        for c in self.removed:
+            del self.calls[c.name]
+        for c in self.added:
+            self.calls[c.name] = c
+        for old, new in self.changed:
+            new.state = old.state
+            new.state.update(retry_after=new.test.retry, repeat_after=new.test.repeat,
+                    timeout=new.timeout)
+            self.calls[new.name] = new
+
+
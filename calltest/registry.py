@@ -0,0 +1,136 @@
+"""
+This module knows which test modes exist.
+
+Built-in modes live in :mod:`calltest.mode`. Other packages can add modes
+via the ``calltest.mode`` entry point group, e.g. in ``setup.py``::
+
+    entry_points={"calltest.mode": ["mymode = mypackage.mymode:Worker"]}
+
+A mode's code is only imported when a test that uses it runs.
+"""
+
+import importlib
+
+import logging
+logger = logging.getLogger(__name__)
+
+GROUP = "calltest.mode"
+
+
+class ConfigError(RuntimeError):
+    pass
+
+
+class Mode:
+    """
+    A test mode.
+
+    :param name: The mode's name.
+    :param target: Where to find the worker class, as ``module:Class``.
+    :param links: The links a test with this mode needs (``src``, ``dst``).
+                  ``None``: ask the worker class.
+    """
+    _worker = None
+
+    def __init__(self, name, target, links=None):
+        self.name = name
+        self.target = target
+        self.links = links
+
+    def __repr__(self):
+        return "<%s:%s>" % (self.__class__.__name__,self.name)
+
+    @property
+    def worker(self):
+        """The worker class. Imported on first use."""
+        if self._worker is None:
+            mod, cls = self.target.split(":")
+            self._worker = getattr(importlib.import_module(mod), cls)
+        return self._worker
+
+    @property
+    def ends(self):
+        """The links a test with this mode needs."""
+        if self.links is not None:
+            return self.links
+        return self.worker.links
+
+    def check(self, call):
+        """
+        Verify that this test has the links this mode needs.
+        """
+        for k in self.ends:
+            if getattr(call, k) is None:
+                raise ConfigError("Test %s: mode %s needs '%s'" % (call.name, self.name, k))
+
+
+_IN = ("dst",)
+_OUT = ("src",)
+_DUAL = ("src", "dst")
+
+_modes = {m.name: m for m in (
+    Mode("dtmf", "calltest.mode.dtmf:Worker", _DUAL),
+    Mode("burst", "calltest.mode.burst:Worker", _DUAL),
+    Mode("call", "calltest.mode.call:Worker", _DUAL),
+    Mode("audio", "calltest.mode.audio:Worker", _DUAL),
+    Mode("ring", "calltest.mode.ring:Worker", _OUT),
+    Mode("play", "calltest.mode.play:Worker", _OUT),
+    Mode("wait", "calltest.mode.wait:Worker", _IN),
+    Mode("answer", "calltest.mode.answer:Worker", _IN),
+    Mode("record", "calltest.mode.record:Worker", _IN),
+)}
+_loaded = False
+
+
+def _entry_points():
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:  # Python < 3.8
+        return ()
+    eps = entry_points()
+    if hasattr(eps, "select"):
+        return eps.select(group=GROUP)
+    return eps.get(GROUP, ())
+
+
+def _load():
+    global _loaded
+    if _loaded:
+        return
+    _loaded = True
+    for ep in _entry_points():
+        if ep.name in _modes:
+            logger.warning("Mode %s from %s: already known, ignored", ep.name, ep.value)
+            continue
+        _modes[ep.name] = Mode(ep.name, ep.value)
+
+
+def register(name, target, links=None):
+    """
+    Add a mode.
+
+    :param target: The worker class, or where to find it (``module:Class``).
+    """
+    m = _modes[name] = Mode(name, target if isinstance(target, str) else None, links)
+    if not isinstance(target, str):
+        m._worker = target
+    return m
+
+
+def get_mode(name):
+    """
+    Return the :class:`Mode` with this name.
+    """
+    _load()
+    try:
+        return _modes[name]
+    except KeyError:
+        raise ConfigError("Unknown mode %r. Known: %s" % (name, ", ".join(sorted(_modes)))) from None
+
+
+def modes():
+    """
+    All known modes, by name.
+    """
+    _load()
+    return dict(_modes)
@@ -0,0 +1,286 @@
+"""
+This module contains the central scheduler for server mode.
+
+Instead of one sleeping task per test, a single task keeps a heap of due
+times and hands tests that are due to a bounded pool of workers.
+
+Tests that share a link are related: when one of them starts failing,
+the others are run soon, to tell a broken link from a broken test, and
+when it recovers, the link's failing tests are re-run. Once a link has
+``sched.confirm`` failing tests, only one of them needs to keep retrying.
+Tests are held back while one of their links has used up its hourly
+call budget.
+"""
+
+import anyio
+import heapq
+import random
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Scheduler:
+    """
+    Periodically run a number of :class:`calltest.model.Call` objects.
+
+    :param backends: The :cls:`calltest.backend.Backends` to run the tests with.
+    :param cfg: The ``sched`` section of the configuration.
+    :param updated: Callback that's fired when a test's status changes.
+    """
+    _wake = None  # event for waking up the dispatcher
+    _queue = None  # tests that are due, waiting for a worker
+
+    def __init__(self, backends, cfg, updated=None):
+        self.backends = backends
+        self.cfg = cfg
+        if updated is None:
+            async def updated(call):
+                pass
+        self.updated = updated
+        self._heap = []
+        self._seq = 0
+        self._active = set()
+        self._successor = {}  # running test > its reconfigured replacement
+        self._by_link = {}  # link name > its tests
+        self._triggered = set()  # tests started manually, exempt from budgets
+
+        # how late tests were started, for benchmarking
+        self.n_started = 0
+        self.lag_sum = 0.0
+        self.lag_max = 0.0
+
+    def schedule(self, call, delay):
+        """
+        (Re)schedule this test to run in ``delay`` seconds.
+
+        Any previous schedule for this test is discarded.
+        """
+        if delay > 0 and self.cfg.jitter:
+            delay *= 1 + random.uniform(-self.cfg.jitter, self.cfg.jitter)
+        call._due = due = time.monotonic() + delay
+        call.state.t_next = time.time() + delay
+        self._seq += 1
+        heapq.heappush(self._heap, (due, self._seq, call))
+
+    @staticmethod
+    def _links(call):
+        return [l for l in (call.src, call.dst) if l is not None]
+
+    def _index(self, call, add=True):
+        for l in self._links(call):
+            calls = self._by_link.setdefault(l.name, set())
+            if add:
+                calls.add(call)
+            else:
+                calls.discard(call)
+
+    def _delay(self, call):
+        """
+        Seconds until this test should run again.
+        """
+        delay = call.next_delay()
+        links = self._links(call)
+        if call.state.fail_count and call.state.status != "deferred" and self.cfg.confirm:
+            # If the link is known to be down, one failing test that
+            # retries soon is enough.
+            soon = time.monotonic() + delay
+            for l in links:
+                failing = [c for c in self._by_link.get(l.name, ()) if c.state.get("fail_count")]
+                if len(failing) >= self.cfg.confirm and any(c is not call and c._due is not None
+                        and c._due <= soon for c in failing):
+                    delay = max(delay, call.test.repeat)
+                    break
+        for l in links:
+            delay = max(delay, l.budget_wait())
+        return delay
+
+    async def _probe(self, call, failing):
+        """
+        Run this test's siblings, i.e. the tests that share a link with
+        it, within ``sched.probe`` seconds. Only those that currently fail
+        if ``failing`` is set, otherwise the others.
+        """
+        if not self.cfg.probe:
+            return
+        due = time.monotonic() + self.cfg.probe
+        kick = False
+        for l in self._links(call):
+            for c in self._by_link.get(l.name, ()):
+                if c is call or c._due is None or c._due <= due:
+                    continue  # running, manual, or due soon anyway
+                if bool(c.state.get("fail_count")) != failing:
+                    continue
+                logger.debug("Probe %s: %s %s", l.name, c.name, "recovered" if failing else "failed")
+                self.schedule(c, self.cfg.probe)
+                kick = True
+        if kick:
+            await self._kick()
+
+    async def _correlate(self, call):
+        st = call.state
+        if st.status == "deferred":
+            return
+        if st.fail_count == 1:
+            # is it the test, or the link?
+            await self._probe(call, failing=False)
+        elif st.fail_count == 0 and st.get("ok_count") == 1:
+            # the link might be up again
+            await self._probe(call, failing=True)
+
+    async def trigger(self, call):
+        """
+        Run this test now.
+
+        Returns ``False`` if the test is already running.
+        """
+        if call in self._active or call in self._successor.values():
+            return False
+        self._triggered.add(call)
+        self.schedule(call, 0)
+        await self._kick()
+        return True
+
+    async def _kick(self):
+        if self._wake is not None:
+            await self._wake.set()
+
+    async def add(self, call):
+        """
+        Start running a new test.
+        """
+        call._sched = self
+        call.setup_state()
+        self._index(call)
+        await self.updated(call)
+        if not call.test.skip:
+            # Spread the initial runs instead of starting everything
+            # at once.
+            self.schedule(call, random.uniform(0, min(self.cfg.spread, call.test.repeat)))
+            await self._kick()
+
+    async def remove(self, call):
+        """
+        Stop running this test. If it's running, it is interrupted.
+        """
+        call._sched = None
+        call._due = None
+        self._index(call, add=False)
+        self._triggered.discard(call)
+        if call in self._active:
+            await call.test_stop(fail=False)
+
+    async def replace(self, old, new):
+        """
+        Replace a test with a reconfigured version, which continues its
+        schedule. If the old test is running, it may finish first.
+        """
+        due = old._due
+        old._sched = None
+        old._due = None
+        new._sched = self
+        self._index(old, add=False)
+        self._index(new)
+        await self.updated(new)
+        if old in self._active:
+            self._successor[old] = new
+        elif not new.test.skip:
+            self.schedule(new, due-time.monotonic() if due is not None else self._delay(new))
+            await self._kick()
+
+    async def reconfigure(self, rc, reconfigured=None):
+        """
+        Apply this :cls:`calltest.model.Reconfig`: start new tests, stop
+        removed ones and replace changed ones.
+
+        :param reconfigured: Callback that's fired with ``rc`` after
+                             removed tests have been stopped.
+        """
+        await self.backends.add(rc.new_links, rc.added+[n for _, n in rc.changed])
+        self.backends.remove(rc.removed+[o for o, _ in rc.changed])
+        await rc.apply()
+        for c in rc.removed:
+            await self.remove(c)
+        if reconfigured is not None:
+            await reconfigured(rc)
+        for old, new in rc.changed:
+            await self.replace(old, new)
+        for c in rc.added:
+            await self.add(c)
+
+    async def run(self, calls):
+        """
+        Run the scheduler and its workers. Never returns.
+        """
+        calls = list(calls)
+        self._queue = anyio.create_queue(self.cfg.workers)
+        for c in calls:
+            await self.add(c)
+
+        async with anyio.create_task_group() as tg:
+            for _ in range(self.cfg.workers):
+                await tg.spawn(self._worker)
+            await self._dispatch()
+
+    async def _dispatch(self):
+        heap = self._heap
+        while True:
+            self._wake = anyio.create_event()
+            now = time.monotonic()
+            while heap and heap[0][0] <= now:
+                due, _, call = heapq.heappop(heap)
+                if call._due != due:
+                    continue  # rescheduled, stale entry
+                links = self._links(call)
+                if call in self._triggered:
+                    self._triggered.discard(call)
+                else:
+                    wait = max([0] + [l.budget_wait() for l in links])
+                    if wait > 0:
+                        self.schedule(call, wait)
+                        continue
+                for l in links:
+                    l.spend()
+                call._due = None
+                self._active.add(call)
+                await self._queue.put((due, call))
+
+            dly = heap[0][0] - now if heap else None
+            async with anyio.move_on_after(dly):
+                await self._wake.wait()
+
+    async def _worker(self):
+        backends = self.backends
+        async for due, call in self._queue:
+            if call._sched is not self:
+                # removed or replaced while it was waiting for a worker
+                self._active.discard(call)
+                call = self._successor.pop(call, None)
+                if call is None:
+                    continue
+                self._active.add(call)
+            lag = time.monotonic() - due
+            self.n_started += 1
+            self.lag_sum += lag
+            if self.lag_max < lag:
+                self.lag_max = lag
+            try:
+                await self.updated(call)
+                await call._run(backends)
+                if call._sched is self:
+                    # not if it was removed or replaced meanwhile
+                    await self.updated(call)
+            finally:
+                self._active.discard(call)
+            new = self._successor.pop(call, None)
+            if new is not None:
+                call = new
+                await self.updated(call)
+            elif call._sched is not self:
+                continue  # removed
+            else:
+                await self._correlate(call)
+            if call._due is None and not call.test.skip:
+                self.schedule(call, self._delay(call))
+                await self._kick()
@@ -1,13 +1,24 @@
 import anyio
-import asyncari
+import json
+import signal
+import time
 from .util import attrdict
+from .sched import Scheduler
+from .backend import Backends
+from .model import Reconfig
+from .status import StatusIndex, StateVersions
+from .metrics import Metrics, CONTENT_TYPE as METRICS_TYPE
+from .history import History, OK
 from typing import Optional, Any
 from functools import partial
 from quart_trio import QuartTrio as Quart
 from hypercorn.config import Config as HyperConfig
 from hypercorn.trio import serve as hyper_serve
 from quart.logging import create_serving_logger
-from quart import jsonify, websocket
+from quart import jsonify, websocket, request
+
+import logging
+logger = logging.getLogger(__name__)
 
 async def run (  # type: ignore
     self, # app
@@ -38,45 +49,199 @@ async def run (  # type: ignore
     await hyper_serve(self, config)
 
 
-async def serve(cfg, checks):
-    ast = cfg.asterisk
-    url = "http://%s:%d/" % (ast.host,ast.port)
+class _WSClient:
+    """
+    One websocket listener.
+
+    Changed tests are queued by name, and written in batches by a separate
+    task. Each update only contains the fields that changed since the
+    version this client last saw. A listener that falls too far behind
+    gets a snapshot instead; one that doesn't accept data at all is
+    dropped.
+
+    :param sock: the websocket.
+    :param cfg: the ``server.ws`` section of the configuration.
+    :param versions: the :cls:`calltest.status.StateVersions` to send
+                     updates from.
+    """
+    def __init__(self, sock, cfg, versions):
+        self.sock = sock
+        self.cfg = cfg
+        self.versions = versions
+        self.pending = {}  # test names, in order of change
+        self.seen = {}  # test name > version this client has
+        self.resync = False
+        self._wake = anyio.create_event()
+
+    async def _kick(self):
+        if not self._wake.is_set():
+            await self._wake.set()
+
+    async def push(self, name):
+        """
+        Queue an update for this test. Never blocks.
+        """
+        if not self.resync:
+            self.pending[name] = None
+            if len(self.pending) > self.cfg.max_pending:
+                self.pending.clear()
+                self.resync = True
+        await self._kick()
+
+    async def snapshot(self):
+        """
+        Send the complete state of all tests.
+        """
+        self.pending.clear()
+        self.resync = True
+        await self._kick()
+
+    async def since(self, version):
+        """
+        Send everything that changed after this version.
+        """
+        if version > self.versions.version:
+            # we restarted, probably
+            await self.snapshot()
+            return
+        self.resync = False
+        self.pending.clear()
+        self.seen.clear()
+        for name in self.versions:
+            self.seen[name] = version
+            self.pending[name] = None
+        await self._kick()
+
+    def _batch(self):
+        vs = self.versions
+        items = []
+        for name in self.pending:
+            if name not in vs:
+                if self.seen.pop(name, None) is not None:
+                    items.append(dict(action="delete", name=name))
+                continue
+            since = self.seen.get(name, 0)
+            v = vs.version_of(name)
+            if v <= since:
+                continue
+            state, deleted = vs.delta(name, since)
+            item = dict(action="update", name=name, version=v, state=state)
+            if deleted:
+                item["deleted"] = deleted
+            items.append(item)
+            self.seen[name] = v
+        self.pending.clear()
+        return items
+
+    async def run(self):
+        """
+        Send queued updates. Raises ``TimeoutError`` if the client is too slow.
+        """
+        cfg = self.cfg
+        vs = self.versions
+        while True:
+            await self._wake.wait()
+            await anyio.sleep(cfg.interval)
+            self._wake = anyio.create_event()
+            if self.resync:
+                self.resync = False
+                self.pending.clear()
+                states = vs.snapshot()
+                self.seen = {name: vs.version_of(name) for name in states}
+                msg = dict(action="snapshot", version=vs.version, states=states)
+            else:
+                items = self._batch()
+                if not items:
+                    continue
+                msg = dict(action="batch", version=vs.version, items=items)
+            async with anyio.fail_after(cfg.timeout):
+                await self.sock.send(json.dumps(msg))
+
+    async def received(self, data):
+        """
+        Process a message from the client.
+        """
+        try:
+            msg = json.loads(data)
+            action = msg["action"]
+        except (ValueError, TypeError, KeyError):
+            return
+        if action == "snapshot":
+            await self.snapshot()
+        elif action == "resync":
+            await self.since(int(msg.get("since", 0)))
+
+
+def make_app(cfg, checks, links, reload=None):
+    """
+    Build the web application.
+
+    :param checks: the tests to report on. These need to have ``name``,
+                   ``test`` and ``state`` attributes, as well as
+                   ``test_start`` and ``test_stop`` methods.
+    :param links: the links to report on. These need a ``stats`` attribute.
+    :param reload: async callable that reloads the configuration. It
+                   returns a dict describing what changed.
 
-    stats = {}
+    Returns the app, a callback that must be called when a test's
+    state changes, and one that must be called with the
+    :cls:`calltest.model.Reconfig` after tests have been added, removed or
+    changed.
+    """
+    status = StatusIndex()
+    versions = StateVersions()
+    metrics = Metrics(cfg.metrics, checks)
+    history = History(cfg.history) if cfg.history.file else None
     socks = set()
     app = Quart("calltest.server", root_path="/tmp")
     @app.route("/", methods=['GET'])
     @app.route("/list", defaults={'with_ok':True}, methods=['GET'])
     async def index(with_ok=False):
-        s = attrdict()
-        s.fail = list(k for k,v in stats.items() if v.fail_count >= checks[k].test.fail)
-        s.warn = list(k for k,v in stats.items() if checks[k].test.fail > v.fail_count >= checks[k].test.warn)
-        s.note = list(k for k,v in stats.items() if checks[k].test.warn > v.fail_count > 0 or v.fail_count == 0 and v.fail_map)
-        ok = list(k for k,v in stats.items() if v.fail_count == 0 and v.n_run > 0)
-        if with_ok:
-            s.ok = ok
-            s.skip = list(k for k,v in stats.items() if checks[k].test.skip)
-            s.n_skip = len(s.skip)
-        s.n_fail = len(s.fail)
-        s.n_warn = len(s.warn)
-        s.n_note = len(s.note)
-        s.n_ok = len(ok)
-        return jsonify(s)
-
-    async def alert(**msg):
-        nonlocal socks
-        ds = set()
-        for s in socks:
-            try:
-                await s.send(msg)
-            except Exception:
-                ds.add(s)
-        socks -= ds
+        return status.summary(with_ok), 200, {"Content-Type": "application/json"}
+
+    @app.route("/metrics", methods=['GET'])
+    async def metrics_text():
+        return metrics.render(), 200, {"Content-Type": METRICS_TYPE}
 
     @app.route("/test/<test>", methods=['GET'])
     async def test_detail(test):
         c = checks[test]
-        return jsonify(c.state)
+        return jsonify(c.state.to_json())
+
+    @app.route("/test/<test>/history", methods=['GET'])
+    async def test_history(test):
+        if history is None:
+            return jsonify({"error": "no history file configured"}), 404
+        checks[test]
+        args = request.args
+        t_to = args.get("to", type=float)
+        if t_to is None:
+            t_to = time.time()
+        t_from = args.get("from", type=float)
+        if t_from is None:
+            t_from = t_to - 86400
+        step = args.get("step", type=float)
+
+        # a long history takes a while to read
+        if step:
+            return jsonify(await anyio.run_in_thread(history.aggregate, test, t_from, t_to, step))
+        def get():
+            res = []
+            for t, outcome, phases in history.records(test, t_from, t_to):
+                res.append(dict(t=t, ok=(outcome == OK), phases=phases))
+                if len(res) >= cfg.history.max_records:
+                    break
+            return res
+        return jsonify(await anyio.run_in_thread(get))
+
+    @app.route("/links", methods=['GET'])
+    async def link_list():
+        return jsonify({k:v.stats for k,v in links.items()})
+
+    @app.route("/link/<link>", methods=['GET'])
+    async def link_detail(link):
+        l = links[link]
+        return jsonify(l.stats)
 
     @app.route("/test/<test>/start", methods=['PUT'])
     async def test_start(test):
@@ -96,27 +261,123 @@ async def serve(cfg, checks):
         res = await c.test_stop(fail=True)
         return jsonify({"success":res})
 
+    @app.route("/reload", methods=['PUT'])
+    async def do_reload():
+        if reload is None:
+            return jsonify({"error": "Reloading is not supported"}), 501
+        try:
+            res = await reload()
+        except Exception as exc:
+            logger.exception("Reload failed")
+            return jsonify({"error": str(exc)}), 400
+        return jsonify(res)
+
     @app.websocket('/ws')
     async def ws():
+        sock = websocket._get_current_object()
+        client = _WSClient(sock, cfg.server.ws, versions)
+        since = websocket.args.get("since", type=int)
+        if since is None:
+            await client.snapshot()
+        else:
+            await client.since(since)
+        socks.add(client)
         try:
-            sock = websocket._get_current_object()
-            socks.add(sock)
-            while True:
-                data = await sock.receive()
-                print("IN",data)
+            async with anyio.create_task_group() as tg:
+                await tg.spawn(client.run)
+                while True:
+                    await client.received(await sock.receive())
+        except TimeoutError:
+            logger.warning("Websocket client too slow, dropped")
         finally:
-            socks.discard(sock)
+            socks.discard(client)
 
     async def updated(call):
-        await alert(action="update", name=call.name, state=call.state)
-        stats[call.name] = call.state
-
-    async with asyncari.connect(url, ast.app, username=ast.username, password=ast.password) as client:
-        client._calltest_config = cfg
-        async with anyio.create_task_group() as tg:
-            await tg.spawn(partial(run, app, **cfg.server, debug=True))
-            for c in checks.values():
-                await tg.spawn(partial(c.run, client, updated=updated))
-            pass # end loop
+        if versions.update(call.name, call.state.to_json()) is not None:
+            for s in socks:
+                await s.push(call.name)
+        status.update(call)
+        metrics.update(call)
+        if history is not None:
+            try:
+                history.update(call)
+            except OSError:
+                # don't kill the scheduler
+                logger.exception("Writing the history")
+
+    async def reconfigured(rc):
+        for c in rc.removed:
+            status.remove(c.name)
+            versions.remove(c.name)
+            metrics.remove(c.name)
+            for s in socks:
+                await s.push(c.name)
+        for c in rc.added:
+            metrics.add(c)
+        for _, c in rc.changed:
+            metrics.add(c)
+
+    return app, updated, reconfigured
+
+
+def reconfig_result(rc):
+    """
+    What ``PUT /reload`` reports about this :cls:`calltest.model.Reconfig`.
+    """
+    res = {"added": [c.name for c in rc.added],
+            "removed": [c.name for c in rc.removed],
+            "changed": [n.name for _, n in rc.changed],
+            "links": sorted(l.name for l in rc.new_links+rc.removed_links+[l for l, _ in rc.changed_links])}
+    logger.info("Reloaded: %r", res)
+    return res
+
+
+async def reload_on_hup(reload):
+    """
+    Call ``reload`` whenever we get a SIGHUP.
+    """
+    async with anyio.receive_signals(signal.SIGHUP) as sigs:
+        async for _ in sigs:
+            try:
+                await reload()
+            except Exception:
+                logger.exception("Reload failed")
+
+
+async def serve(cfg, checks, links, workers=0, reload=None):
+    """
+    Run all tests in the background, and a web server that reports on
+    them.
+
+    :param workers: if set, run the tests in this many worker processes.
+    :param reload: callable that returns a new configuration. If set,
+                   SIGHUP and ``PUT /reload`` apply it.
+    """
+    if workers:
+        from .workers import serve_workers
+        await serve_workers(cfg, checks, links, workers, reload=reload)
+        return
+
+    lock = anyio.create_lock()
+
+    async def do_reload():
+        new_cfg = reload()
+        async with lock:
+            rc = Reconfig(links, checks, new_cfg)
+            if not rc:
+                return {}
+            await sched.reconfigure(rc, reconfigured)
+        return reconfig_result(rc)
+
+    app, updated, reconfigured = make_app(cfg, checks, links,
+            reload=do_reload if reload is not None else None)
+    backends = Backends(cfg, links.values(), checks.values())
+    async with anyio.create_task_group() as tg:
+        await tg.spawn(backends.run)
+        await tg.spawn(partial(run, app, **cfg.server, debug=True))
+        sched = Scheduler(backends, cfg.sched, updated=updated)
+        await tg.spawn(sched.run, checks.values())
+        if reload is not None:
+            await tg.spawn(reload_on_hup, do_reload)
         pass # end taskgroup
 
@@ -0,0 +1,175 @@
+"""
+This module contains the server's view of the tests' states.
+"""
+
+import copy
+import json
+
+BUCKETS = ("fail", "warn", "note", "ok", "skip")
+
+
+class StatusIndex:
+    """
+    Sorts tests into fail/warn/note/ok/skip buckets.
+
+    The buckets are updated whenever a test's state changes, so listing
+    them doesn't need to look at every test. The JSON summaries are cached
+    until the next change.
+    """
+    def __init__(self):
+        self._buckets = {b: set() for b in BUCKETS}
+        self._where = {}  # test name > buckets
+        self._json = {}  # with_ok > cached summary
+
+    @staticmethod
+    def buckets(call):
+        """
+        Returns the set of buckets this test belongs to.
+        """
+        st = call.state
+        t = call.test
+        fc = st.fail_count
+        res = set()
+        if fc >= t.fail:
+            res.add("fail")
+        if t.fail > fc >= t.warn:
+            res.add("warn")
+        if t.warn > fc > 0 or fc == 0 and st.fail_map:
+            res.add("note")
+        if fc == 0 and st.n_run > 0:
+            res.add("ok")
+        if t.skip:
+            res.add("skip")
+        return res
+
+    def update(self, call):
+        """
+        Re-sort this test. Returns ``True`` if anything changed.
+        """
+        new = self.buckets(call)
+        old = self._where.get(call.name, set())
+        if new == old:
+            return False
+        for b in old - new:
+            self._buckets[b].discard(call.name)
+        for b in new - old:
+            self._buckets[b].add(call.name)
+        self._where[call.name] = new
+        self._json.clear()
+        return True
+
+    def remove(self, name):
+        """
+        Forget about this test.
+        """
+        for b in self._where.pop(name, ()):
+            self._buckets[b].discard(name)
+        self._json.clear()
+
+    def summary(self, with_ok=False):
+        """
+        The test names in each bucket, plus counts, as JSON text.
+        """
+        res = self._json.get(with_ok)
+        if res is None:
+            b = self._buckets
+            s = {}
+            for k in ("fail", "warn", "note"):
+                s[k] = sorted(b[k])
+                s["n_"+k] = len(b[k])
+            if with_ok:
+                s["ok"] = sorted(b["ok"])
+                s["skip"] = sorted(b["skip"])
+                s["n_skip"] = len(b["skip"])
+            s["n_ok"] = len(b["ok"])
+            self._json[with_ok] = res = json.dumps(s, sort_keys=True)
+        return res
+
+
+_DELETED = object()
+
+
+class StateVersions:
+    """
+    Remembers when each field of each test's state last changed.
+
+    Every change gets a new version number from a single counter, so
+    listeners can be sent just the fields that changed since the version
+    they last saw.
+    """
+    def __init__(self):
+        self.version = 0
+        self._fields = {}  # test name > field > (version, value)
+        self._versions = {}  # test name > latest version
+
+    def update(self, name, state):
+        """
+        Record this test's new state.
+
+        Returns the new version, or ``None`` if nothing changed.
+        """
+        fields = self._fields.setdefault(name, {})
+        v = None
+        for k, val in state.items():
+            old = fields.get(k)
+            if old is not None and old[1] == val:
+                continue
+            if v is None:
+                self.version += 1
+                v = self.version
+            # copy, as the caller may modify lists etc. in place
+            fields[k] = (v, copy.deepcopy(val))
+        for k in fields.keys() - state.keys():
+            if fields[k][1] is not _DELETED:
+                if v is None:
+                    self.version += 1
+                    v = self.version
+                fields[k] = (v, _DELETED)
+        if v is not None:
+            self._versions[name] = v
+        return v
+
+    def __iter__(self):
+        return iter(self._versions)
+
+    def __contains__(self, name):
+        return name in self._fields
+
+    def remove(self, name):
+        """
+        Forget about this test.
+        """
+        self._fields.pop(name, None)
+        self._versions.pop(name, None)
+        self.version += 1
+
+    def version_of(self, name):
+        """
+        The version of this test's latest change.
+        """
+        return self._versions.get(name, 0)
+
+    def delta(self, name, since=0):
+        """
+        The fields of this test's state that changed after version
+        ``since``.
+
+        Returns a ``(state, deleted)`` tuple: a dict of new values and a
+        list of fields that have been removed.
+        """
+        state = {}
+        deleted = []
+        for k, (v, val) in self._fields.get(name, {}).items():
+            if v > since:
+                if val is _DELETED:
+                    deleted.append(k)
+                else:
+                    state[k] = val
+        return state, deleted
+
+    def snapshot(self):
+        """
+        The current state of all tests.
+        """
+        return {name: {k: val for k, (v, val) in fields.items() if val is not _DELETED}
+                for name, fields in self._fields.items()}
@@ -1,6 +1,7 @@
 """
 This module contains various helper functions and classes.
 """
+from collections import namedtuple
 from collections.abc import Mapping
 
 import logging
@@ -59,6 +60,66 @@ def combine_dict(*d, cls=dict):
     return res
 
 
+def merge_defaults(d, default, cls=dict):
+    """
+    Returns ``d``, with missing keys filled in from ``default``. This
+    recurses if both values are dicts.
+
+    Unlike :func:`combine_dict` this only walks ``d``. Sub-dicts that
+    only exist in ``default`` are shared, not copied, so don't modify
+    them.
+
+    Args:
+      cls (type): a class to instantiate the result with. Default: dict.
+    """
+    res = cls(default)
+    for k, v in d.items():
+        dv = res.get(k)
+        if isinstance(v, Mapping) and isinstance(dv, Mapping):
+            v = merge_defaults(v, dv, cls=cls)
+        res[k] = v
+    return res
+
+
+def percentile(values, q):
+    """
+    The ``q``-th quantile (0 to 1) of these sorted values, or ``None``
+    if there are none.
+    """
+    if not values:
+        return None
+    return values[int(q * (len(values)-1))]
+
+
+def cancelled(exc):
+    """
+    Whether this exception is a cancellation, or a group of them.
+    """
+    import anyio
+
+    if isinstance(exc, anyio.get_cancelled_exc_class()):
+        return True
+    sub = getattr(exc, "exceptions", None)
+    return bool(sub) and all(cancelled(e) for e in sub)
+
+
+_records = {}  # keys > record class
+
+
+def frozen(d):
+    """
+    Convert a dict to an immutable record, recursively. Values are
+    accessed as attributes; use ``_asdict()`` to get a dict back.
+
+    Keys which aren't valid identifiers can't be accessed.
+    """
+    keys = tuple(d.keys())
+    cls = _records.get(keys)
+    if cls is None:
+        cls = _records[keys] = namedtuple("record", keys, rename=True)
+    return cls._make(frozen(v) if isinstance(v, Mapping) else v for v in d.values())
+
+
 class attrdict(dict):
     """A dictionary which can be accessed via attributes, for convenience"""
 
@@ -81,8 +142,3 @@ class attrdict(dict):
             del self[a]
         except KeyError:
             raise AttributeError(a) from None
-
-from yaml.representer import SafeRepresenter
-
-SafeRepresenter.add_representer(attrdict, SafeRepresenter.represent_dict)
-
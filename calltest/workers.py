@@ -0,0 +1,413 @@
+"""
+Run the tests in several worker processes.
+
+The front-end process serves the HTTP API. Each worker runs its own
+scheduler and ARI client(s) and reports state changes to the front end,
+which forwards start/stop requests and reloads in the other direction.
+
+Workers talk to the front end via a Unix socket, using JSON messages,
+one per line. A worker that dies is restarted.
+"""
+
+import anyio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from functools import partial
+
+from .util import attrdict
+from .default import DEFAULT
+from .model import assign_groups, gen_links, gen_calls, CallState, Reconfig
+
+import logging
+from logging.config import dictConfig
+logger = logging.getLogger(__name__)
+
+MAX_MSG = 1024*1024
+RESTART = 5  # seconds before restarting a worker that died
+START_TIMEOUT = 30  # seconds a request waits for its worker to (re)start
+STOP_TIMEOUT = 5  # seconds a worker gets to exit before it's killed
+
+
+def partition(calls, links, n):
+    """
+    Distribute these calls to ``n`` workers. Tests that share a link
+    always end up in the same worker.
+
+    A link's ``worker`` attribute, if set, selects the worker for it and
+    everything that shares it.
+
+    Returns a list of ``(links, calls)`` tuples.
+    """
+    res = [([],[]) for _ in range(n)]
+    pin = lambda l: () if l.worker is None else (l.worker,)
+    for w, g_links, g_calls in assign_groups(calls, links, dict.fromkeys(range(n), 0), pin, "worker"):
+        res[w][0].extend(g_links)
+        res[w][1].extend(g_calls)
+    return res
+
+
+def app_name(app, worker):
+    """The Stasis application name used by this worker"""
+    return "%s-%d" % (app, worker)
+
+
+class _Conn:
+    """
+    A JSON-lines connection.
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self._lock = anyio.create_lock()
+
+    async def send(self, **msg):
+        data = json.dumps(msg).encode("utf-8")+b"\n"
+        async with self._lock:
+            await self.sock.send_all(data)
+
+    async def receive(self):
+        return json.loads(await self.sock.receive_until(b"\n", MAX_MSG), object_hook=attrdict)
+
+
+class RemoteLink:
+    """
+    Front-end stand-in for a link that's handled by a worker.
+    """
+    def __init__(self, link, worker):
+        self.name = link.name
+        self.worker = worker
+        self.stats = attrdict(worker=worker)
+
+
+class RemoteCall:
+    """
+    Front-end stand-in for a test that runs in a worker.
+    """
+    def __init__(self, call, worker):
+        self.name = call.name
+        self.test = call.test
+        self.state = call.state
+        self.src = call.src
+        self.dst = call.dst
+        self.worker = worker
+
+    def __repr__(self):
+        return "<%s:%s@%d>" % (self.__class__.__name__,self.name,self.worker.idx)
+
+    async def test_start(self):
+        return await self.worker.request("start", self.name)
+
+    async def test_stop(self, fail=True):
+        return await self.worker.request("fail" if fail else "stop", self.name)
+
+
+def _env():
+    # The worker must find this package even if it's not installed,
+    # e.g. when started via "./ct".
+    env = dict(os.environ)
+    top = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    path = env.get("PYTHONPATH")
+    env["PYTHONPATH"] = top + os.pathsep + path if path else top
+    return env
+
+
+class _Worker:
+    """
+    Front-end state for one worker process.
+    """
+    conn = None
+    proc = None
+
+    def __init__(self, idx):
+        self.idx = idx
+        self._seq = 0
+        self._pending = {}  # seq > event
+        self._results = {}  # seq > result
+        self._ready = anyio.create_event()
+
+    async def request(self, action, name):
+        """
+        Forward a start/stop request to the worker. Returns its result,
+        or ``False`` if the worker isn't running.
+        """
+        async with anyio.move_on_after(START_TIMEOUT):
+            await self._ready.wait()
+        conn = self.conn
+        if conn is None:
+            return False
+        self._seq += 1
+        seq = self._seq
+        evt = anyio.create_event()
+        self._pending[seq] = evt
+        try:
+            await conn.send(action=action, name=name, seq=seq)
+            await evt.wait()
+            return self._results.pop(seq, False)
+        except (OSError, anyio.exceptions.ClosedResourceError):
+            return False
+        finally:
+            del self._pending[seq]
+
+    async def _result(self, msg):
+        evt = self._pending.get(msg.seq)
+        if evt is not None:
+            self._results[msg.seq] = msg.result
+            await evt.set()
+
+    async def connected(self, conn):
+        self.conn = conn
+        await self._ready.set()
+
+    async def disconnected(self, conn):
+        """
+        The connection to the worker is gone. Fail its pending requests.
+        """
+        if self.conn is not conn:
+            return
+        self.conn = None
+        self._ready = anyio.create_event()
+        for evt in list(self._pending.values()):
+            await evt.set()
+
+    async def reload(self, cfg):
+        """
+        Tell the worker to apply this configuration to its tests. If it
+        isn't running, it gets it when it (re)starts.
+        """
+        conn = self.conn
+        if conn is None:
+            return
+        try:
+            await conn.send(action="reload", cfg=cfg, calls=self.calls)
+        except (OSError, anyio.exceptions.ClosedResourceError):
+            pass  # it died
+
+    def _start(self, path):
+        return subprocess.Popen([sys.executable, "-m", __name__, path, str(self.idx)], env=_env())
+
+    def _stop(self):
+        self.proc.terminate()
+        try:
+            self.proc.wait(STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            logger.warning("Worker %d: didn't stop, killing it", self.idx)
+            self.proc.kill()
+            self.proc.wait()
+
+    async def run(self, path):
+        """
+        Run the worker process, and restart it when it dies.
+
+        :param path: the front end's socket.
+        """
+        while True:
+            self.proc = self._start(path)
+            try:
+                res = await anyio.run_in_thread(self.proc.wait, cancellable=True)
+            except BaseException:
+                async with anyio.open_cancel_scope(shield=True):
+                    await anyio.run_in_thread(self._stop)
+                raise
+            logger.error("Worker %d: exited with status %d, restarting", self.idx, res)
+            await anyio.sleep(RESTART)
+
+
+async def serve_workers(cfg, checks, links, n, reload=None):
+    """
+    Serve the HTTP API and run the tests in ``n`` worker processes.
+
+    :param reload: callable that returns a new configuration. If set,
+                   SIGHUP and ``PUT /reload`` apply it.
+    """
+    from .server import make_app, run, reconfig_result, reload_on_hup
+
+    workers = [_Worker(i) for i in range(n)]
+    r_checks = {}
+    r_links = {}
+    parts = partition(checks.values(), links.values(), n)
+    for w,(p_links, p_calls) in zip(workers, parts):
+        w.calls = [c.name for c in p_calls]
+        for l in p_links:
+            r_links[l.name] = RemoteLink(l, w.idx)
+        for c in p_calls:
+            r_checks[c.name] = RemoteCall(c, w)
+        logger.info("Worker %d: app %s, links %s", w.idx, app_name(cfg.asterisk.app, w.idx),
+                ",".join(sorted(l.name for l in p_links)))
+
+    lock = anyio.create_lock()
+
+    async def do_reload():
+        nonlocal cfg
+        new_cfg = reload()
+        async with lock:
+            rc = Reconfig(links, checks, new_cfg)
+            if not rc:
+                return {}
+
+            # New and changed tests go to the worker that has their links.
+            # Tests can't move, so one that would join links of different
+            # workers requires a restart.
+            def pin(l):
+                rl = r_links.get(l.name)
+                if rl is not None:
+                    return (rl.worker,)
+                return () if l.worker is None else (l.worker,)
+            load = {w.idx: len(w.calls) for w in workers}
+            new_calls = rc.added+[new for _, new in rc.changed]
+            groups = assign_groups(new_calls, rc.new_links, load, pin, "worker")
+
+            await rc.apply()
+            old = {}
+            for c in rc.removed+[o for o, _ in rc.changed]:
+                old[c.name] = r = r_checks.pop(c.name)
+                r.worker.calls.remove(c.name)
+            for l in rc.removed_links:
+                del r_links[l.name]
+            for idx, g_links, g_calls in groups:
+                w = workers[idx]
+                for l in g_links:
+                    if l.name not in r_links:
+                        r_links[l.name] = RemoteLink(l, w.idx)
+                for c in g_calls:
+                    r = r_checks[c.name] = RemoteCall(c, w)
+                    if c.name in old:
+                        r.state = old[c.name].state
+                    w.calls.append(c.name)
+            # workers that (re)start from now on get the new version
+            cfg = new_cfg
+
+            await reconfigured(rc)
+            for w in workers:
+                await w.reload(new_cfg)
+        return reconfig_result(rc)
+
+    app, updated, reconfigured = make_app(cfg, r_checks, r_links,
+            reload=do_reload if reload is not None else None)
+
+    async def handle(sock):
+        conn = _Conn(sock)
+        w = None
+        try:
+            msg = await conn.receive()
+            w = workers[msg.worker]
+            w_cfg = cfg
+            await conn.send(action="init", cfg=w_cfg, calls=w.calls)
+            await w.connected(conn)
+            if cfg is not w_cfg:
+                await w.reload(cfg)  # reloaded meanwhile
+            while True:
+                msg = await conn.receive()
+                if msg.action == "update":
+                    c = r_checks.get(msg.name)
+                    if c is None or c.worker is not w:
+                        continue  # sent before a reload removed it
+                    c.state = CallState.from_json(msg.state)
+                    for k,v in msg.links.items():
+                        if k in r_links:
+                            r_links[k].stats = attrdict(v, worker=w.idx)
+                    await updated(c)
+                elif msg.action == "result":
+                    await w._result(msg)
+                else:
+                    logger.warning("Worker %d: unknown message %r", w.idx, msg)
+        except (OSError, anyio.exceptions.IncompleteRead, anyio.exceptions.ClosedResourceError):
+            pass  # the worker died
+        finally:
+            if w is not None:
+                await w.disconnected(conn)
+            await sock.close()
+
+    with tempfile.TemporaryDirectory(prefix="calltest.") as tmp:
+        path = os.path.join(tmp, "workers")
+        server = await anyio.create_unix_server(path)
+        try:
+            async with anyio.create_task_group() as tg:
+                await tg.spawn(partial(run, app, **cfg.server, debug=True))
+                for w in workers:
+                    await tg.spawn(w.run, path)
+                if reload is not None:
+                    await tg.spawn(reload_on_hup, do_reload)
+                while True:
+                    sock = await server.accept()
+                    await tg.spawn(handle, sock)
+        finally:
+            await server.close()
+
+
+async def worker(path, idx):
+    """
+    The main code of a worker process.
+    """
+    from .backend import Backends
+    from .sched import Scheduler
+
+    conn = _Conn(await anyio.connect_unix(path))
+    await conn.send(worker=idx)
+    msg = await conn.receive()
+    cfg = msg.cfg
+    dictConfig(cfg.logging)
+    # Asterisk delivers each app's events to one connection only
+    cfg.asterisk.app = app_name(cfg.asterisk.app, idx)
+
+    links = gen_links(cfg)
+    calls = gen_calls(links, cfg)
+    calls = {k: calls[k] for k in msg.calls}
+
+    async def send(**msg):
+        try:
+            await conn.send(**msg)
+        except (OSError, anyio.exceptions.ClosedResourceError):
+            # the front end is gone
+            await tg.cancel_scope.cancel()
+
+    async def updated(call):
+        ls = {}
+        for l in (call.src, call.dst):
+            if l is not None:
+                ls[l.name] = l.stats
+        await send(action="update", name=call.name, state=call.state.to_json(), links=ls)
+
+    async def request(msg):
+        c = calls.get(msg.name)
+        if c is None:
+            res = False  # removed by a reload
+        elif msg.action == "start":
+            res = await c.test_start()
+        else:
+            res = await c.test_stop(fail=(msg.action == "fail"))
+        await send(action="result", seq=msg.seq, result=res)
+
+    async def do_reload(msg):
+        new = msg.cfg
+        new.calls = attrdict((k, v) for k, v in new.calls.items() if k == DEFAULT or k in msg.calls)
+        try:
+            rc = Reconfig(links, calls, new)
+        except ValueError:
+            # the front end checked this
+            logger.exception("Reload failed")
+            return
+        if rc:
+            await sched.reconfigure(rc)
+
+    backends = Backends(cfg, links.values(), calls.values())
+    async with anyio.create_task_group() as tg:
+        await tg.spawn(backends.run)
+        sched = Scheduler(backends, cfg.sched, updated=updated)
+        await tg.spawn(sched.run, calls.values())
+        while True:
+            try:
+                msg = await conn.receive()
+            except (OSError, anyio.exceptions.IncompleteRead):
+                break  # the front end is gone
+            if msg.action == "reload":
+                # not concurrently with the next one
+                await do_reload(msg)
+            else:
+                await tg.spawn(request, msg)
+        await tg.cancel_scope.cancel()
+
+
+if __name__ == "__main__":
+    anyio.run(worker, sys.argv[1], int(sys.argv[2]), backend="trio")
@@ -22,6 +22,9 @@ setup(
         "jsonschema >= 2.5",
         "pyyaml >= 3",
     ],
+    extras_require={
+        "audio": ["numpy"],
+    },
     tests_require=[
         "pytest",
         "pytest-trio",
@@ -0,0 +1,77 @@
+"""
+Test fixtures.
+
+Tests that place calls run against the simulated Asterisk in
+:mod:`calltest.fakeari`, with its delays shortened so that a call takes
+a fraction of a second.
+"""
+
+import anyio
+import pytest
+import yaml
+from contextlib import asynccontextmanager
+
+from calltest.backend import Backends
+from calltest.config import load_cfg
+from calltest.model import gen_links, gen_calls
+from calltest.util import combine_dict
+
+BASE = dict(
+    asterisk=dict(
+        fake=dict(
+            enabled=True,
+            seed=1,
+            tempo=0.1,
+            delay=dict(ring=0.01, answer=0.01, play=0.1, drop=0.1),
+        ),
+    ),
+    sched=dict(spread=0.1, jitter=0),
+    calls={
+        ":default:": dict(
+            timeout=5,
+            delay=dict(ring=0, answer=0),
+            test=dict(retry=1, repeat=1),
+        ),
+    },
+)
+
+
+@pytest.fixture
+def make_cfg(tmp_path):
+    """
+    Returns a function that builds a configuration from a dict, on top
+    of ``BASE`` and the defaults, plus ``-C``-style overrides.
+    """
+    def make(cfg, *conf):
+        p = tmp_path / "calltest.cfg"
+        p.write_text(yaml.safe_dump(combine_dict(cfg, BASE)))
+        return load_cfg(str(p), conf)
+    return make
+
+
+@pytest.fixture
+def setup():
+    """
+    Returns a function that builds the links and tests of a
+    configuration.
+    """
+    def setup(cfg):
+        links = gen_links(cfg)
+        return links, gen_calls(links, cfg)
+    return setup
+
+
+@pytest.fixture
+def backends():
+    """
+    Returns an async context manager that connects to the simulated
+    Asterisk, for these links and tests.
+    """
+    @asynccontextmanager
+    async def run(cfg, links, calls):
+        b = Backends(cfg, links.values(), calls.values())
+        async with anyio.create_task_group() as tg:
+            await tg.spawn(b.run)
+            yield b
+            await tg.cancel_scope.cancel()
+    return run
@@ -0,0 +1,103 @@
+"""
+Audio analysis, on synthetic signals.
+"""
+
+import pytest
+import wave
+
+np = pytest.importorskip("numpy")
+
+from calltest.analysis import measure, analyze, correlate, check, AudioError, DTMF_LOW, DTMF_HIGH, DTMF_KEYS
+from calltest.util import attrdict
+
+RATE = 8000
+
+
+def tone(f, t, level=0.3):
+    return level * np.sin(2*np.pi*f*np.arange(int(t*RATE))/RATE)
+
+
+def silence(t):
+    return np.zeros(int(t*RATE))
+
+
+def pcm(x):
+    return (x*32767).astype(np.int16)
+
+
+def dtmf(digits, on=0.08, off=0.06):
+    parts = [silence(0.1)]
+    for d in digits:
+        row = next(i for i, r in enumerate(DTMF_KEYS) if d in r)
+        col = DTMF_KEYS[row].index(d)
+        parts.append(tone(DTMF_LOW[row], on, 0.2) + tone(DTMF_HIGH[col], on, 0.2))
+        parts.append(silence(off))
+    return pcm(np.concatenate(parts))
+
+
+def test_tones():
+    x = pcm(np.concatenate((tone(440, 1), silence(1), tone(1000, 2))))
+    res = measure(x, RATE, tones=(440, 1000, 2000))
+    assert res["duration"] == 4
+    assert res["silence"] == pytest.approx(0.25, abs=0.01)
+    assert res["silence_max"] == pytest.approx(1, abs=0.03)
+    assert res["level"] == pytest.approx(20*np.log10(0.3/np.sqrt(2)), abs=0.1)
+    assert res["clipping"] == 0
+    t = res["tones"]
+    assert t[440] == pytest.approx(1/3, abs=0.02)
+    assert t[1000] == pytest.approx(2/3, abs=0.02)
+    assert t[2000] == 0
+
+
+def test_silence():
+    res = measure(pcm(silence(1)), RATE, tones=(440,), dtmf=True)
+    assert res["silence"] == 1
+    assert res["level"] is None
+    assert res["tones"] == {440: 0.0}
+    assert res["dtmf"] == []
+
+
+def test_clipping():
+    res = measure(pcm(np.clip(tone(440, 1, 2), -1, 1)), RATE, clip=32000)
+    assert res["clipping"] > 0.5
+    with pytest.raises(AudioError):
+        check(attrdict(max_silence=None, max_clipping=0.1, min_similarity=None), "t", res)
+
+
+@pytest.mark.parametrize("digits", ["0123456789", "*#ABCD", "5555"])
+def test_dtmf(digits):
+    res = measure(dtmf(digits), RATE, dtmf=True)
+    assert "".join(d for d, _, _ in res["dtmf"]) == digits
+    onsets = [t for _, t, _ in res["dtmf"]]
+    for i, t in enumerate(onsets):
+        assert t == pytest.approx(0.1 + i*0.14, abs=0.02)
+    for _, _, level in res["dtmf"]:
+        assert level == pytest.approx(20*np.log10(0.2/np.sqrt(2)) + 3, abs=1)
+
+
+def test_dtmf_noise():
+    # a single tone, or noise, is not a digit
+    rng = np.random.default_rng(1)
+    x = np.concatenate((tone(DTMF_LOW[0], 0.5), 0.2*rng.standard_normal(RATE)))
+    res = measure(pcm(x), RATE, dtmf=True)
+    assert res["dtmf"] == []
+
+
+def test_analyze(tmp_path):
+    ref = pcm(np.random.default_rng(2).uniform(-0.3, 0.3, RATE))
+    rec = np.concatenate((pcm(silence(0.5)), ref // 2, pcm(silence(0.5))))
+    paths = []
+    for name, x in (("ref", ref), ("rec", rec)):
+        p = tmp_path / (name+".wav")
+        with wave.open(str(p), "wb") as w:
+            w.setnchannels(1)
+            w.setsampwidth(2)
+            w.setframerate(RATE)
+            w.writeframes(x.tobytes())
+        paths.append(str(p))
+    res = analyze(paths[1], paths[0])
+    assert res["offset"] == 0.5
+    assert res["similarity"] > 0.99
+    assert res["duration"] == 2
+
+    assert correlate(ref[:100], ref, 10) == (None, 0.0)
@@ -0,0 +1,58 @@
+"""
+Reading the configuration.
+"""
+
+import copy
+
+from calltest import config
+from calltest.config import load_cfg, logging_cfg
+from calltest.default import CFG
+
+
+def test_defaults(tmp_path):
+    p = tmp_path / "calltest.cfg"
+    p.write_text("calls:\n  t:\n    src: a\n")
+    cfg = load_cfg(str(p))
+    assert cfg.server.port == 8080
+    assert cfg.calls.t["src"] == "a"  # merged with calls[":default:"] later
+    assert cfg.calls[":default:"]["timeout"] == 30
+
+
+def test_override(tmp_path):
+    before = copy.deepcopy(CFG)
+    p = tmp_path / "calltest.cfg"
+    p.write_text("server:\n  host: example.com\n")
+    cfg = load_cfg(str(p), ("server.port=1234", "sched.workers=2", "history.file='x'", "server.prio"))
+    assert cfg.server.port == 1234
+    assert cfg.server.host == "example.com"
+    assert "prio" not in cfg.server
+    assert cfg.sched.workers == 2
+    assert cfg.history.file == "x"
+
+    cfg = load_cfg("-", ("server.port=4321",))
+    assert cfg.server.port == 4321
+    assert CFG == before
+    assert load_cfg("-").server.port == 8080
+
+
+def test_logging(tmp_path, monkeypatch):
+    # adjusting the log levels touches neither the defaults nor the cache
+    before = copy.deepcopy(CFG)
+    parsed = []
+    parse = config._parse
+    monkeypatch.setattr(config, "_parse", lambda data: parsed.append(data) or parse(data))
+    p = tmp_path / "calltest.cfg"
+    p.write_text("server:\n  port: 1234\n")
+    cache = str(tmp_path / "cache")
+
+    cfg = load_cfg(str(p), cache=cache)
+    lcfg = logging_cfg(cfg, 3, ("asyncari=DEBUG", "calltest.sched=WARNING"))
+    assert lcfg["root"]["level"] == "DEBUG"
+    assert lcfg["loggers"]["asyncari"] == {"level": "DEBUG"}
+    assert lcfg["loggers"]["calltest.sched"] == {"level": "WARNING"}
+    assert logging_cfg(load_cfg("-"))["root"]["level"] == "ERROR"
+    assert CFG == before
+
+    # a reload
+    assert load_cfg(str(p), cache=cache).server.port == 1234
+    assert len(parsed) == 1
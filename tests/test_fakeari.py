@@ -0,0 +1,297 @@
+"""
+Run the test modes against the simulated Asterisk.
+"""
+
+import pytest
+
+LINKS = dict(
+    a=dict(channel="Fake/a/{number}", number="101", capacity=4),
+    b=dict(channel="Fake/b/{number}", number="102", capacity=4),
+)
+
+
+@pytest.mark.trio
+@pytest.mark.parametrize("mode", ["dtmf", "call", "burst"])
+async def test_dual(make_cfg, setup, backends, mode):
+    cfg = make_cfg(dict(links=LINKS, calls=dict(
+        t=dict(src="a", dst="b", mode=mode, dtmf=dict(sweep=[100, 50])))))
+    links, calls = setup(cfg)
+    async with backends(cfg, links, calls) as b:
+        await calls.t(b)
+    ph = calls.t.state.phases
+    assert ph.ringing > 0
+    assert "total" in ph
+    if mode == "burst":
+        assert links.a.dtmf_fastest == 0.1
+
+
+@pytest.mark.trio
+@pytest.mark.parametrize("mode", ["ring", "play"])
+async def test_out(make_cfg, setup, backends, mode):
+    # any number that isn't a link's is a simulated phone
+    cfg = make_cfg(dict(links=LINKS, calls=dict(
+        t=dict(src="a", number="555", mode=mode, audio=dict(src_out="hello")))))
+    links, calls = setup(cfg)
+    async with backends(cfg, links, calls) as b:
+        await calls.t(b)
+        assert links.a._backend.fake.stats.calls == 1
+    assert calls.t.state.phases.ringing < 1
+
+
+@pytest.mark.trio
+async def test_answer(make_cfg, setup, backends):
+    # a "play" test calls an "answer" test
+    import anyio
+
+    cfg = make_cfg(dict(links=LINKS, calls=dict(
+        o=dict(src="a", number="102", mode="play", audio=dict(src_out="hello")),
+        i=dict(dst="b", mode="answer", audio=dict(dst_out="world")),
+    )))
+    links, calls = setup(cfg)
+    async with backends(cfg, links, calls) as b:
+        for _ in range(3):
+            async with anyio.create_task_group() as tg:
+                await tg.spawn(calls.i, b)
+                await anyio.sleep(0.01)
+                await tg.spawn(calls.o, b)
+        fake = links.a._backend.fake
+        pool = links.b._backend.client._calltest_bridges
+        assert pool.stats.created == 1
+        assert pool.stats.reused == 2
+    assert not fake.bridges
+
+
+@pytest.mark.trio
+async def test_lost_dtmf(make_cfg, setup, backends):
+    cfg = make_cfg(dict(links=LINKS, calls=dict(
+        t=dict(src="a", dst="b", mode="dtmf", timeout=1))),
+        "asterisk.fake.lose_dtmf=1")
+    links, calls = setup(cfg)
+    async with backends(cfg, links, calls) as b:
+        with pytest.raises(TimeoutError):
+            await calls.t(b)
+
+
+@pytest.mark.trio
+async def test_bridge_teardown(make_cfg, setup, backends):
+    # a pooled bridge is only reused when it's empty
+    import anyio
+    from calltest.mode import bridge_pool, PooledBridgeState
+
+    cfg = make_cfg(dict(links=LINKS, calls=dict(t=dict(src="a", number="555", mode="ring"))))
+    links, calls = setup(cfg)
+    async with backends(cfg, links, calls) as b:
+        client = await b.client_for(calls.t)
+        fake = links.a._backend.fake
+        pool = await bridge_pool(client)
+
+        async def bridged(br=None):
+            ch = await client.channels.originate(endpoint="Fake/a/555", app=client._app,
+                    appArgs=[":dialed", "555"])
+            while fake.channels[ch.id].state != "Up":
+                await anyio.sleep(0.01)
+            if br is not None:
+                await br.addChannel(channel=ch.id)
+            return ch
+
+        br = await pool.get()
+        ch = await bridged(br)
+        async with PooledBridgeState(br).task as st:
+            dialled = await bridged()
+            st.calls.add(dialled)  # as if the bridge had dialled it
+        assert ch.id not in fake.channels
+        assert dialled.id not in fake.channels
+        assert not fake.bridges[br.id].channels
+        assert pool._idle[-1][1] is br
+
+        # a bridge that's returned with a channel in it is destroyed
+        br = await pool.get()
+        ch = await bridged(br)
+        await pool.put(br)
+        assert br.id not in fake.bridges
+        assert not pool._idle
+        await client.channels.get(channelId=ch.id)  # left alone
+
+
+@pytest.mark.trio
+async def test_originate_fails(make_cfg, setup, backends):
+    from asyncari.model import OperationError
+
+    cfg = make_cfg(dict(links=LINKS, calls=dict(t=dict(src="a", number="555", mode="ring"))),
+        "asterisk.fake.error=1")
+    links, calls = setup(cfg)
+    async with backends(cfg, links, calls) as b:
+        with pytest.raises(OperationError):
+            await calls.t(b)
+
+
+@pytest.mark.trio
+async def test_originate_slow(make_cfg, setup, backends):
+    # the test ends before the reply to originating its call arrives
+    cfg = make_cfg(dict(links=LINKS, calls=dict(
+        t=dict(src="a", number="555", mode="ring", timeout=0.1))),
+        "asterisk.fake.delay.reply=0.3")
+    links, calls = setup(cfg)
+    async with backends(cfg, links, calls) as b:
+        with pytest.raises(TimeoutError):
+            await calls.t(b)
+        fake = links.a._backend.fake
+        assert fake.stats.calls == 1
+        assert not fake.channels
+
+
+@pytest.mark.trio
+async def test_stream(make_cfg, setup, backends, tmp_path):
+    # concurrent streams; the audio of failed ones is saved
+    import anyio
+    from calltest.analysis import AudioError
+
+    audio = dict(src_out="hello", stream=True, max_silence=0)
+    cfg = make_cfg(dict(links=LINKS, calls={
+        c: dict(src="a", number="555", mode="play", audio=dict(audio, src_in=c)) for c in ("s", "t")}),
+        "asterisk.audio.record='%s/'" % (tmp_path,))
+    links, calls = setup(cfg)
+    async def run(call, b):
+        with pytest.raises(AudioError):
+            await call(b)
+
+    async with backends(cfg, links, calls) as b:
+        async with anyio.create_task_group() as tg:
+            await tg.spawn(run, calls.s, b)
+            await tg.spawn(run, calls.t, b)
+    for c in ("s", "t"):
+        assert calls[c].state.audio[c]["duration"] > 0
+        assert (tmp_path / (c + ".wav")).stat().st_size > 44
+
+
+@pytest.mark.trio
+async def test_stream_teardown(make_cfg, setup, backends, tmp_path, monkeypatch):
+    # the pooled bridge is destroyed if it can't be emptied
+    from asyncari.model import Bridge
+
+    async def removeChannel(self, **kw):
+        raise RuntimeError("nope")
+    monkeypatch.setattr(Bridge, "removeChannel", removeChannel, raising=False)
+
+    cfg = make_cfg(dict(links=LINKS, calls=dict(t=dict(src="a", number="555", mode="play",
+        audio=dict(src_out="hello", src_in="t", stream=True)))),
+        "asterisk.audio.record='%s/'" % (tmp_path,))
+    links, calls = setup(cfg)
+    async with backends(cfg, links, calls) as b:
+        with pytest.raises(RuntimeError):
+            await calls.t(b)
+        pool = links.a._backend.client._calltest_bridges
+        assert not pool._out
+        assert not pool._idle
+        assert not links.a._backend.fake.bridges
+
+
+def incall(client, call):
+    # a test that waits for its call, without running it
+    import anyio
+    from types import SimpleNamespace
+    from calltest.mode import _InCall
+
+    ic = _InCall(SimpleNamespace(call=call, client=client))
+    ic._evt = anyio.create_event()
+    return ic
+
+
+@pytest.mark.trio
+async def test_in_route(make_cfg, setup, backends):
+    # incoming calls go to the test that waits for the dialled number;
+    # tests that share a number are told apart by the caller ID
+    import anyio
+    from calltest.mode import in_dispatcher
+
+    links = dict(LINKS, c=dict(channel="Fake/c/{number}", number="103"))
+    cfg = make_cfg(dict(links=links, calls=dict(
+        x=dict(src="a", dst="b", mode="answer"),
+        y=dict(src="c", dst="b", mode="answer"),
+        z=dict(dst="b", number="10255", mode="answer"),
+        w=dict(dst="b", number="+4930555", mode="answer"),
+    ), asterisk=dict(fake=dict(numbers={"030555": "b"}))))
+    links, calls = setup(cfg)
+    async with backends(cfg, links, calls) as b:
+        client = await b.client_for(calls.x)
+        disp = await in_dispatcher(client)
+        ics = {c: incall(client, calls[c]) for c in "xyzw"}
+        for ic in ics.values():
+            await disp.register(ic)
+
+        async def dial(nr, cid):
+            await client.channels.originate(endpoint="Fake/a/" + nr, app=client._app,
+                    appArgs=[":dialed", nr], variables={"CALLERID(num)": cid})
+
+        async with anyio.fail_after(2):
+            await dial("102", "103")
+            await ics["y"]._evt.wait()
+            assert not ics["x"]._evt.is_set()
+
+            await dial("10255", "101")
+            await ics["z"]._evt.wait()
+            assert not ics["x"]._evt.is_set()
+
+            await dial("030555", "101")  # national form
+            await ics["w"]._evt.wait()
+
+            await dial("102", "101")
+            await ics["x"]._evt.wait()
+        assert ics["x"]._in_channel.caller["number"] == "101"
+        assert ics["y"]._in_channel.caller["number"] == "103"
+        assert not disp._early
+        assert not any(disp._index["b"].values())
+
+
+@pytest.mark.trio
+async def test_in_early(make_cfg, setup, backends):
+    # calls that arrive before their test is ready are kept for a while
+    import anyio
+    from calltest.mode import in_dispatcher
+
+    cfg = make_cfg(dict(links=LINKS, calls=dict(
+        x=dict(src="a", dst="b", mode="answer"))),
+        "asterisk.early.keep=0.3", "asterisk.early.max=2")
+    links, calls = setup(cfg)
+    async with backends(cfg, links, calls) as b:
+        client = await b.client_for(calls.x)
+        fake = links.b._backend.fake
+        disp = await in_dispatcher(client)
+
+        async def early(n=1):
+            for _ in range(n):
+                await client.channels.originate(endpoint="Fake/a/102", app=client._app,
+                        appArgs=[":dialed", "102"], variables={"CALLERID(num)": "101"})
+            async with anyio.fail_after(1):
+                while len(disp._early) < n:
+                    await anyio.sleep(0.01)
+            return [e[3] for e in disp._early]
+
+        # claimed in time
+        ch, = await early()
+        ic = incall(client, calls.x)
+        await disp.register(ic)
+        assert ic._evt.is_set()
+        assert ic._in_channel is ch
+        assert not disp._early
+        await ch.hangup()
+
+        # expired, then hung up
+        ch, = await early()
+        await anyio.sleep(0.5)
+        assert not disp._early
+        assert ch.id not in fake.channels
+        ic = incall(client, calls.x)
+        await disp.register(ic)
+        assert not ic._evt.is_set()
+        disp.unregister(ic)
+
+        # too many: the oldest is dropped
+        chs = await early(2)
+        await client.channels.originate(endpoint="Fake/a/102", app=client._app,
+                appArgs=[":dialed", "102"], variables={"CALLERID(num)": "101"})
+        async with anyio.fail_after(1):
+            while chs[0].id in fake.channels:
+                await anyio.sleep(0.01)
+        assert [e[3] for e in disp._early][0] is chs[1]
+        assert len(disp._early) == 2
@@ -0,0 +1,123 @@
+"""
+The on-disk results log.
+"""
+
+import pytest
+from types import SimpleNamespace
+
+from calltest import history
+from calltest.history import History, RECORD, OK, FAIL
+from calltest.model import CallState
+from calltest.util import attrdict
+
+
+def make_cfg(path, recent=1000):
+    return attrdict(file=str(path / "hist"), recent=recent)
+
+
+@pytest.fixture(params=[1000, 4])
+def hist(tmp_path, request):
+    # with few recent runs in memory, most are searched on disk
+    h = History(make_cfg(tmp_path, request.param))
+    yield h
+    h.close()
+
+
+def fill(h):
+    # phases are stored as float32, these values are exact
+    # "a" runs every 10 seconds and fails every third time, "b" every 15
+    for t in range(0, 300, 5):
+        if t % 10 == 0:
+            h.add("a", 1000+t, FAIL if t % 30 == 0 else OK, dict(total=t/40, wait=1))
+        if t % 15 == 0:
+            h.add("b", 1000+t, OK, dict(ringing=2))
+
+
+def test_records(hist):
+    fill(hist)
+    assert hist.n_records == 30 + 20
+    r = list(hist.records("a"))
+    assert len(r) == 30
+    assert r[0] == (1000, FAIL, dict(wait=1, total=0))
+    assert r[1] == (1010, OK, dict(wait=1, total=0.25))
+    assert [t for t, _, _ in hist.records("a", 1095, 1130)] == [1100, 1110, 1120, 1130]
+    assert [t for t, _, _ in hist.records("b", 1200)] == list(range(1210, 1300, 15))
+    assert [t for t, _, _ in hist.records("b", t_to=1020)] == [1000, 1015]
+    assert list(hist.records("b", 2000)) == []
+    assert list(hist.records("nope")) == []
+
+
+def test_aggregate(hist):
+    fill(hist)
+    agg = hist.aggregate("a", 1000, 1100, 60)
+    assert [(x["t"], x["n"], x["n_fail"]) for x in agg] == [(1000, 6, 2), (1060, 5, 2)]
+    assert agg[0]["avg"] == dict(wait=1, total=0.625)
+    assert agg[0]["max"] == dict(wait=1, total=1.25)
+    assert hist.aggregate("b", 1000, 1029, 10)[1] == dict(t=1010, n=1, n_fail=0,
+            avg=dict(ringing=2), max=dict(ringing=2))
+
+
+def test_reopen(tmp_path):
+    cfg = make_cfg(tmp_path)
+    h = History(cfg)
+    fill(h)
+    expected = list(h.records("a", 1100))
+    h.close()
+
+    # a partial record from a crash is discarded
+    with open(cfg.file, "ab") as f:
+        f.write(b"x" * (RECORD.size//2))
+    h = History(cfg)
+    try:
+        assert list(h.records("a", 1100)) == expected
+        assert h.n_records == 50
+        # time doesn't run backwards
+        h.add("c", 500, OK, {})
+        assert list(h.records("c")) == [(1290, OK, {})]
+    finally:
+        h.close()
+
+
+def test_update(hist):
+    call = SimpleNamespace(name="t", state=CallState(fail_count=0))
+    hist.update(call)
+    assert hist.n_records == 0
+    call.state.update(t_stop=1000, phases=dict(total=3))
+    hist.update(call)
+    hist.update(call)
+    call.state.update(t_stop=1010, fail_count=1)
+    hist.update(call)
+    assert list(hist.records("t")) == [(1000, OK, dict(total=3)), (1010, FAIL, dict(total=3))]
+
+
+def test_query_during_append(hist):
+    fill(hist)
+    it = hist.records("a")
+    next(it)
+    hist.add("a", 2000, OK, {})
+    # the query only sees what was there when it started
+    assert len(list(it)) == 29
+    assert len(list(hist.records("a"))) == 31
+
+
+def test_recent(tmp_path, monkeypatch):
+    # memory use doesn't grow with the history
+    monkeypatch.setattr(history, "SCAN", 7)
+    cfg = make_cfg(tmp_path, recent=4)
+    h = History(cfg)
+    fill(h)
+    assert max(len(r) for _, r in h._recent.values()) <= 8
+    expected = list(h.records("a", 1095, 1250))
+    h.close()
+
+    h = History(cfg)
+    try:
+        assert not h._recent
+        assert list(h.records("a", 1095, 1250)) == expected
+        # runs since the start are indexed, older ones are on disk
+        h.add("a", 1300, OK, {})
+        h.add("b", 1305, OK, {})
+        assert [t for t, _, _ in h.records("a", 1270)] == [1270, 1280, 1290, 1300]
+        assert [t for t, _, _ in h.records("b", 1280, 1305)] == [1285, 1305]
+    finally:
+        h.close()
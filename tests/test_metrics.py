@@ -0,0 +1,107 @@
+"""
+Phase timings in Prometheus' text format.
+"""
+
+from types import SimpleNamespace
+
+from calltest.metrics import Metrics
+from calltest.util import attrdict
+
+
+def link(name):
+    return SimpleNamespace(name=name)
+
+
+def call(name, src, dst=None):
+    return SimpleNamespace(name=name, src=src, dst=dst, state=attrdict(n_run=0, n_fail=0))
+
+
+def run(c, t_stop, fail=False, **phases):
+    c.state.t_stop = t_stop
+    c.state.phases = phases
+    c.state.n_run += 1
+    c.state.n_fail += fail
+
+
+def lines(m, prefix):
+    return [l for l in m.render().split("\n") if l.startswith(prefix)]
+
+
+def test_render():
+    a, b = link("a"), link('b"x')
+    checks = dict(t1=call("t1", a, b), t2=call("t2", a))
+    m = Metrics(attrdict(buckets=[1, 0.5, 2]), checks)
+
+    run(checks["t1"], 100, wait=0.2, total=1.5, other=3)
+    m.update(checks["t1"])
+    m.update(checks["t1"])  # same run: not counted again
+    run(checks["t1"], 200, fail=True, wait=0.5, total=4)
+    m.update(checks["t1"])
+    run(checks["t2"], 150, wait=1)
+    m.update(checks["t2"])
+    run(checks["t2"], 160)  # no phases, e.g. the call wasn't placed
+    m.update(checks["t2"])
+
+    assert lines(m, "calltest_runs_total") == [
+        'calltest_runs_total{test="t1"} 2',
+        'calltest_runs_total{test="t2"} 2']
+    assert lines(m, "calltest_failures_total") == [
+        'calltest_failures_total{test="t1"} 1',
+        'calltest_failures_total{test="t2"} 0']
+
+    # buckets are sorted and cumulative; a value on a bound is counted in it
+    assert lines(m, 'calltest_phase_seconds_bucket{test="t1",phase="wait"') == [
+        'calltest_phase_seconds_bucket{test="t1",phase="wait",le="0.5"} 2',
+        'calltest_phase_seconds_bucket{test="t1",phase="wait",le="1"} 2',
+        'calltest_phase_seconds_bucket{test="t1",phase="wait",le="2"} 2',
+        'calltest_phase_seconds_bucket{test="t1",phase="wait",le="+Inf"} 2']
+    assert lines(m, 'calltest_phase_seconds_bucket{test="t1",phase="total"') == [
+        'calltest_phase_seconds_bucket{test="t1",phase="total",le="0.5"} 0',
+        'calltest_phase_seconds_bucket{test="t1",phase="total",le="1"} 0',
+        'calltest_phase_seconds_bucket{test="t1",phase="total",le="2"} 1',
+        'calltest_phase_seconds_bucket{test="t1",phase="total",le="+Inf"} 2']
+    assert lines(m, 'calltest_phase_seconds_sum{test="t1",phase="total"}') == [
+        'calltest_phase_seconds_sum{test="t1",phase="total"} 5.5']
+    assert lines(m, 'calltest_phase_seconds_count{test="t1",phase="ringing"}') == [
+        'calltest_phase_seconds_count{test="t1",phase="ringing"} 0']
+    assert not lines(m, 'calltest_phase_seconds_bucket{test="t1",phase="other"')
+
+    # per link: "a" is used by both tests, "b" only by t1
+    assert lines(m, 'calltest_link_phase_seconds_count{link="a",phase="wait"}') == [
+        'calltest_link_phase_seconds_count{link="a",phase="wait"} 3']
+    assert lines(m, 'calltest_link_phase_seconds_sum{link="a",phase="wait"}') == [
+        'calltest_link_phase_seconds_sum{link="a",phase="wait"} 1.7']
+    assert lines(m, 'calltest_link_phase_seconds_count{link="b\\"x",phase="wait"}') == [
+        'calltest_link_phase_seconds_count{link="b\\"x",phase="wait"} 2']
+
+    # each metric is announced once, before its series
+    out = m.render()
+    assert out.endswith("\n")
+    assert out.count("# TYPE calltest_phase_seconds histogram\n") == 1
+    assert out.index("# TYPE calltest_link_phase_seconds") < out.index("calltest_link_phase_seconds_bucket")
+
+
+def test_remove():
+    a = link("a")
+    checks = dict(t1=call("t1", a), t2=call("t2", a))
+    m = Metrics(attrdict(buckets=[1]), checks)
+    run(checks["t1"], 100, wait=0.5)
+    m.update(checks["t1"])
+
+    del checks["t1"]
+    m.remove("t1")
+    out = m.render()
+    assert 'test="t1"' not in out
+    assert 'test="t2"' in out
+    # the link's series keep their counts
+    assert 'calltest_link_phase_seconds_count{link="a",phase="wait"} 1\n' in out
+
+    # a test that comes back starts from scratch
+    checks["t1"] = call("t1", a)
+    m.add(checks["t1"])
+    assert lines(m, 'calltest_phase_seconds_count{test="t1",phase="wait"}') == [
+        'calltest_phase_seconds_count{test="t1",phase="wait"} 0']
+    run(checks["t1"], 100, wait=0.5)  # same t_stop as before the removal
+    m.update(checks["t1"])
+    assert lines(m, 'calltest_phase_seconds_count{test="t1",phase="wait"}') == [
+        'calltest_phase_seconds_count{test="t1",phase="wait"} 1']
@@ -0,0 +1,268 @@
+"""
+The data model: tests' schedules and links' budgets.
+"""
+
+import pytest
+from types import SimpleNamespace
+
+from calltest.model import CallState, Link, LinkBusy, assign_groups
+
+
+@pytest.fixture
+def make_call(make_cfg, setup):
+    def make(**test):
+        cfg = make_cfg(dict(
+            links=dict(a=dict(channel="Fake/a/{number}", number="101")),
+            calls=dict(t=dict(src="a", number="555", mode="ring", test=test))))
+        c = setup(cfg)[1].t
+        c.setup_state()
+        return c
+    return make
+
+
+@pytest.mark.trio
+async def test_backoff(make_call):
+    c = make_call(retry=10, repeat=100, backoff=2)
+    assert c.next_delay() == 100
+    c.state.update(fail_count=1)
+    assert c.next_delay() == 10
+    c.state.update(fail_count=0)
+    delays = []
+    for n in range(1, 7):
+        c.state.update(ok_count=n)
+        delays.append(c.next_delay())
+    assert delays == [10, 20, 40, 80, 100, 100]
+
+    c.state.update(status="deferred")
+    assert c.next_delay() == c.test.defer
+
+
+@pytest.mark.trio
+@pytest.mark.parametrize("n", [1000, 5000, 10**9])
+async def test_backoff_long(make_call, n):
+    # a test that has been OK for a long time
+    c = make_call(retry=0.5, repeat=600.5, backoff=1.5)
+    c.state.update(ok_count=n)
+    assert c.next_delay() == 600.5
+
+
+@pytest.mark.trio
+async def test_backoff_off(make_call):
+    for test in (dict(backoff=0), dict(backoff=1.5, retry=0), dict(backoff=2, retry=200, repeat=100)):
+        c = make_call(**test)
+        c.state.update(ok_count=3)
+        assert c.next_delay() == c.test.repeat
+
+
+@pytest.mark.trio
+async def test_assign_groups(make_cfg, setup):
+    cfg = make_cfg(dict(
+        links={k: dict(channel="Fake/%s/{number}" % k, number=n) for k, n in
+            dict(a="101", b="102", c="103", d="104").items()},
+        calls=dict(
+            ab=dict(src="a", dst="b"),
+            c1=dict(src="c", number="555", mode="ring"),
+            c2=dict(src="c", number="556", mode="ring"),
+            d=dict(dst="d", mode="answer"),
+        )))
+    links, calls = setup(cfg)
+    pins = dict(d="y")
+    pin = lambda l: {pins[l.name]} if l.name in pins else ()
+    load = dict(x=0, y=5)
+    res = assign_groups(calls.values(), links.values(), load, pin, "bin")
+    assert [(b, sorted(l.name for l in g_links), len(g_calls)) for b, g_links, g_calls in res] == [
+        ("y", ["d"], 1), ("x", ["c"], 2), ("x", ["a", "b"], 1)]
+    assert load == dict(x=3, y=6)
+
+    pins.update(a="x", b="y")
+    with pytest.raises(ValueError, match="different bins"):
+        assign_groups(calls.values(), links.values(), load, pin, "bin")
+    pins.update(a="z", b="z")
+    with pytest.raises(ValueError, match="unknown bin 'z'"):
+        assign_groups(calls.values(), links.values(), load, pin, "bin")
+
+
+def test_budget():
+    l = Link("a", "Fake/a/{number}", "101", budget=2)
+    assert l.budget_wait() == 0
+    l.spend()
+    assert l.budget_wait() == 0
+    l.spend()
+    assert 3599 < l.budget_wait() <= 3600
+    l.budget = 0
+    assert l.budget_wait() == 0
+
+
+@pytest.mark.trio
+async def test_cancel_quietly(make_call, caplog):
+    # stopping a test, e.g. at shutdown, is not an error
+    import anyio
+
+    c = make_call()
+
+    class Runner:
+        lock = anyio.create_lock()
+        t0 = 0
+        def __init__(self, client, call):
+            pass
+        def add_span(self, *a):
+            pass
+        async def __call__(self):
+            async with anyio.create_task_group() as tg:
+                await tg.spawn(anyio.sleep, 10)
+                await anyio.sleep(10)
+
+    class Backends:
+        async def client_for(self, call):
+            return None
+
+    c._mode = type("Mode", (), dict(worker=Runner))()
+    async with anyio.move_on_after(0.1):
+        await c(Backends())
+    assert c.state.status == "idle"
+    assert not caplog.records
+
+    c.timeout = 0.1
+    with pytest.raises(TimeoutError):
+        await c(Backends())
+
+
+def make_link(capacity=2, depth=1, policy="fifo"):
+    return Link("l", "Fake/l/{number}", "100", capacity=capacity,
+            queue=dict(depth=depth, policy=policy))
+
+
+def make_waiter(t_stop=None):
+    st = CallState() if t_stop is None else CallState(t_stop=t_stop)
+    return SimpleNamespace(state=st)
+
+
+@pytest.mark.trio
+async def test_capacity():
+    import anyio
+
+    l = make_link()
+    c = make_waiter()
+    await l.acquire(c)
+    await l.acquire(c)
+    assert l.stats.busy == 2
+    got = []
+
+    async def wait(n):
+        await l.acquire(c, n=n)
+        got.append(n)
+
+    async with anyio.create_task_group() as tg:
+        await tg.spawn(wait, 2)
+        await anyio.sleep(0.01)
+        await tg.spawn(wait, 1)
+        await anyio.sleep(0.01)
+        assert l.stats.waiting == 2
+        assert got == []
+        await l.release()
+        await anyio.sleep(0.01)
+        assert got == []  # the first waiter needs both channels
+        await l.release()
+        await anyio.sleep(0.01)
+        assert got == [2]
+        await l.release(2)
+    assert got == [2, 1]
+    assert (l.stats.busy, l.stats.waiting, l.stats.n_admitted) == (1, 0, 4)
+
+    with pytest.raises(ValueError):
+        await l.acquire(c, n=3)
+
+
+@pytest.mark.trio
+async def test_depth():
+    # a test that would wait behind "queue.depth" others is deferred
+    import anyio
+
+    l = make_link(capacity=1, depth=1)
+    c = make_waiter()
+    await l.acquire(c)
+    async with anyio.create_task_group() as tg:
+        await tg.spawn(l.acquire, c, 1, True)
+        await anyio.sleep(0.01)
+        with pytest.raises(LinkBusy) as exc:
+            await l.acquire(c, defer=True)
+        assert exc.value.link is l
+        # without "defer", it queues anyway
+        await tg.spawn(l.acquire, c)
+        await anyio.sleep(0.01)
+        assert l.stats.waiting == 2
+        await l.release()
+        await l.release()
+    assert (l.stats.n_deferred, l.stats.n_admitted, l.stats.busy) == (1, 3, 1)
+
+
+@pytest.mark.trio
+async def test_defer(make_cfg, setup):
+    # a deferred run doesn't count as a run, nor as a failure
+    cfg = make_cfg(dict(
+        links=dict(a=dict(channel="Fake/a/{number}", number="101", queue=dict(depth=0))),
+        calls=dict(t=dict(src="a", number="555", mode="ring"))))
+    links, calls = setup(cfg)
+    c = calls.t
+    c.setup_state()
+
+    class Backends:
+        async def client_for(self, call):
+            return None
+
+    async with links.a.slot(make_waiter()):
+        await c._run(Backends())
+    assert (c.state.status, c.state.n_defer, c.state.n_run, c.state.fail_count) == ("deferred", 1, 0, 0)
+    assert links.a.n_deferred == 1
+    assert links.a.stats.busy == 0
+
+
+@pytest.mark.trio
+async def test_oldest():
+    # the test that has been idle for the longest time goes first
+    import anyio
+
+    l = make_link(capacity=1, depth=5, policy="oldest")
+    await l.acquire(make_waiter())
+    got = []
+
+    async def wait(name, t_stop):
+        await l.acquire(make_waiter(t_stop))
+        got.append(name)
+
+    async with anyio.create_task_group() as tg:
+        for name, t_stop in (("late", 300), ("b1", 100), ("new", None), ("b2", 100)):
+            await tg.spawn(wait, name, t_stop)
+            await anyio.sleep(0.01)
+        for n in range(4):
+            await l.release()
+            await anyio.sleep(0.01)
+            assert len(got) == n+1
+    assert got == ["new", "b1", "b2", "late"]
+
+
+@pytest.mark.trio
+async def test_oldest_cancel():
+    # a waiter that's cancelled after it was given the link passes it on
+    import anyio
+
+    l = make_link(capacity=1, depth=5, policy="oldest")
+    await l.acquire(make_waiter())
+    got = []
+    scopes = {}
+
+    async def wait(name, t_stop):
+        async with anyio.open_cancel_scope() as sc:
+            scopes[name] = sc
+            await l.acquire(make_waiter(t_stop))
+            got.append(name)
+
+    async with anyio.fail_after(1):
+        async with anyio.create_task_group() as tg:
+            await tg.spawn(wait, "a", 100)
+            await tg.spawn(wait, "b", 200)
+            await anyio.sleep(0.01)
+            await scopes["a"].cancel()
+            await l.release()  # goes to "a", which is cancelled already
+    assert got == ["b"]
+    assert (l.stats.busy, l.stats.waiting) == (1, 0)
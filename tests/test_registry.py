@@ -0,0 +1,67 @@
+"""
+The mode registry.
+"""
+
+import pytest
+from types import SimpleNamespace
+
+from calltest import registry
+from calltest.registry import get_mode, modes, register, ConfigError
+from calltest.mode import BaseWorker
+
+
+@pytest.fixture(autouse=True)
+def clean(monkeypatch):
+    monkeypatch.setattr(registry, "_modes", dict(registry._modes))
+    monkeypatch.setattr(registry, "_loaded", False)
+
+
+def test_builtin():
+    m = modes()
+    for name in ("dtmf", "burst", "call", "audio", "ring", "play", "wait", "answer", "record"):
+        assert m[name].name == name
+    assert get_mode("ring").ends == ("src",)
+    assert get_mode("answer").ends == ("dst",)
+    assert get_mode("dtmf").ends == ("src", "dst")
+    assert issubclass(get_mode("dtmf").worker, BaseWorker)
+
+
+def test_unknown():
+    with pytest.raises(ConfigError) as exc:
+        get_mode("nope")
+    assert "dtmf" in str(exc.value)
+
+
+def test_check():
+    m = get_mode("dtmf")
+    m.check(SimpleNamespace(name="t", src=1, dst=2))
+    with pytest.raises(ConfigError) as exc:
+        m.check(SimpleNamespace(name="t", src=1, dst=None))
+    assert "'dst'" in str(exc.value)
+    get_mode("answer").check(SimpleNamespace(name="t", src=None, dst=2))
+
+
+class Worker(BaseWorker):
+    links = ("src",)
+
+
+def test_register():
+    m = register("mine", Worker)
+    assert get_mode("mine") is m
+    assert m.worker is Worker
+    assert m.ends == ("src",)
+
+    m = register("lazy", __name__+":Worker", ("dst",))
+    assert m._worker is None
+    assert m.ends == ("dst",)
+    assert m.worker is Worker
+
+
+def test_entry_points(monkeypatch):
+    eps = [SimpleNamespace(name="ep", value=__name__+":Worker"),
+            SimpleNamespace(name="dtmf", value=__name__+":Worker")]
+    monkeypatch.setattr(registry, "_entry_points", lambda: eps)
+    assert get_mode("ep").worker is Worker
+    assert get_mode("ep").ends == ("src",)
+    # built-in modes can't be replaced
+    assert get_mode("dtmf").worker is not Worker
@@ -0,0 +1,129 @@
+"""
+Reloading the configuration.
+"""
+
+import anyio
+import os
+import pytest
+import signal
+
+from calltest.model import Call, Reconfig
+from calltest.server import serve
+
+LINKS = dict(
+    a=dict(channel="Fake/a/{number}", number="101", capacity=4),
+    b=dict(channel="Fake/b/{number}", number="102", capacity=4),
+)
+
+
+def reconfig(make_cfg, setup):
+    cfg = make_cfg(dict(links=LINKS, calls=dict(
+        same=dict(src="a", dst="b"),
+        changed=dict(src="a", dst="b"),
+        gone=dict(src="b", number="555", mode="ring"),
+    )))
+    links, calls = setup(cfg)
+    same, changed = calls.same, calls.changed
+    changed.state.update(n_run=5)
+    assert not Reconfig(links, calls, cfg)
+
+    new = make_cfg(dict(links=dict(LINKS, c=dict(channel="Fake/c/{number}", number="103")),
+        calls=dict(
+            same=dict(src="a", dst="b"),
+            changed=dict(src="a", dst="b", timeout=2),
+            new=dict(src="c", number="555", mode="ring"),
+        )), "links.a.capacity=2")
+    rc = Reconfig(links, calls, new)
+    assert [c.name for c in rc.added] == ["new"]
+    assert [c.name for c in rc.removed] == ["gone"]
+    assert [(o, n.name) for o, n in rc.changed] == [(changed, "changed")]
+    assert [l.name for l in rc.new_links] == ["c"]
+    assert [l.name for l, _ in rc.changed_links] == ["a"]
+    assert "c" not in links  # nothing happens before apply()
+    return rc, links, calls, same, changed
+
+
+@pytest.mark.trio
+async def test_reconfig(make_cfg, setup):
+    # tests create locks, which need an event loop
+    rc, links, calls, same, changed = reconfig(make_cfg, setup)
+    await rc.apply()
+    assert sorted(calls) == ["changed", "new", "same"]
+    assert calls.same is same
+    assert calls.changed is not changed
+    assert calls.changed.timeout == 2
+    assert calls.changed.state.n_run == 5  # inherited
+    assert calls.changed.state.timeout == 2
+    assert links.a.capacity == 2
+    assert calls.new.src is links.c
+
+
+@pytest.mark.trio
+async def test_bad(make_cfg, setup):
+    cfg = make_cfg(dict(links=LINKS, calls=dict(t=dict(src="a", dst="b"))))
+    links, calls = setup(cfg)
+    with pytest.raises(ValueError):
+        Reconfig(links, calls, make_cfg(dict(links=LINKS, calls=dict(t=dict(src="a", dst="x")))))
+    with pytest.raises(ValueError):
+        Reconfig(links, calls, make_cfg(dict(links=dict(a=LINKS["a"]), calls=dict(t=dict(src="a", dst="b")))))
+
+
+@pytest.mark.trio
+async def test_sighup(make_cfg, setup):
+    # a running server picks up a changed configuration
+    test = dict(src="a", dst="b", mode="call", test=dict(repeat=0.2, retry=0.2))
+    conf = ("server.port=0", "sched.spread=0")
+    cfg = make_cfg(dict(links=LINKS, calls=dict(t=test)), *conf)
+    links, calls = setup(cfg)
+    t = calls.t
+    new = make_cfg(dict(links=LINKS, calls=dict(u=test)), *conf)
+
+    async with anyio.create_task_group() as tg:
+        await tg.spawn(serve, cfg, calls, links, 0, lambda: new)
+        await anyio.sleep(1)
+        os.kill(os.getpid(), signal.SIGHUP)
+        await anyio.sleep(1)
+        n = t.state.n_run
+        await tg.cancel_scope.cancel()
+
+    assert sorted(calls) == ["u"]
+    assert n >= 2
+    assert t.state.n_run == n  # not run any more
+    assert calls.u.state.n_run >= 2
+    assert calls.u.state.n_fail == 0
+
+
+@pytest.mark.trio
+@pytest.mark.parametrize("change", ["remove", "change"])
+async def test_queued(make_cfg, setup, monkeypatch, change):
+    # a test that's waiting for a free scheduler worker when it's removed
+    # doesn't run; if it's changed, the new version runs instead
+    runs = []
+
+    async def run(self, backends, defer=False):
+        runs.append(self)
+        await anyio.sleep(0.5 if self.name == "a" else 0.01)
+    monkeypatch.setattr(Call, "__call__", run)
+
+    test = dict(src="a", number="555", mode="ring", test=dict(repeat=10, retry=10))
+    conf = ("server.port=0", "sched.spread=0", "sched.workers=1")
+    cfg = make_cfg(dict(links=LINKS, calls=dict(a=test, b=test)), *conf)
+    links, calls = setup(cfg)
+    new = dict(a=test)
+    if change == "change":
+        new["b"] = dict(test, timeout=2)
+    new = make_cfg(dict(links=LINKS, calls=new), *conf)
+
+    async with anyio.create_task_group() as tg:
+        await tg.spawn(serve, cfg, calls, links, 0, lambda: new)
+        await anyio.sleep(0.2)
+        os.kill(os.getpid(), signal.SIGHUP)
+        await anyio.sleep(0.6)
+        await tg.cancel_scope.cancel()
+
+    if change == "remove":
+        assert sorted(calls) == ["a"]
+        assert runs == [calls.a]
+    else:
+        assert runs == [calls.a, calls.b]
+        assert calls.b.timeout == 2
@@ -0,0 +1,138 @@
+"""
+The server's scheduler, with a stand-in for running the tests and with
+the simulated Asterisk.
+"""
+
+import anyio
+import pytest
+
+from calltest.model import Call
+from calltest.sched import Scheduler
+
+LINKS = dict(
+    a=dict(channel="Fake/a/{number}", number="101", capacity=4),
+    b=dict(channel="Fake/b/{number}", number="102", capacity=4),
+)
+
+
+@pytest.fixture
+def failing(monkeypatch):
+    """
+    Replaces running a test with a short sleep. Tests whose names are in
+    the returned set fail.
+    """
+    res = set()
+
+    async def run(self, backends, defer=False):
+        await anyio.sleep(0.01)
+        if self.name in res:
+            raise RuntimeError("failed")
+
+    monkeypatch.setattr(Call, "__call__", run)
+    return res
+
+
+async def run_sched(sched, calls, t):
+    async with anyio.move_on_after(t):
+        await sched.run(calls.values())
+
+
+def call(repeat=0.2, retry=None, skip=False, src="a"):
+    return dict(src=src, number="555", mode="ring",
+            test=dict(repeat=repeat, retry=retry or repeat, backoff=0, skip=skip))
+
+
+@pytest.mark.trio
+async def test_repeat(make_cfg, setup, failing):
+    cfg = make_cfg(dict(links=LINKS, calls=dict(
+        fast=call(0.2), slow=call(5), skip=call(0.2, skip=True))))
+    links, calls = setup(cfg)
+    sched = Scheduler(None, cfg.sched)
+    await run_sched(sched, calls, 1)
+    assert 4 <= calls.fast.state.n_run <= 6
+    assert calls.slow.state.n_run == 1
+    assert calls.skip.state.n_run == 0
+    assert sched.n_started == calls.fast.state.n_run + 1
+
+
+@pytest.mark.trio
+async def test_trigger(make_cfg, setup, failing):
+    cfg = make_cfg(dict(calls=dict(t=call(skip=True)),
+        links=dict(LINKS, **{":default:": dict(budget=1)})))
+    links, calls = setup(cfg)
+    sched = Scheduler(None, cfg.sched)
+    async with anyio.create_task_group() as tg:
+        await tg.spawn(run_sched, sched, calls, 0.5)
+        await anyio.sleep(0.1)
+        for _ in range(3):
+            # manual runs ignore the budget
+            assert await calls.t.test_start()
+            await anyio.sleep(0.001)
+            assert not await calls.t.test_start()
+            await anyio.sleep(0.05)
+    assert calls.t.state.n_run == 3
+
+
+@pytest.mark.trio
+async def test_retry(make_cfg, setup, failing):
+    failing.add("t")
+    cfg = make_cfg(dict(links=LINKS, calls=dict(t=call(5, retry=0.2))))
+    links, calls = setup(cfg)
+    await run_sched(Scheduler(None, cfg.sched), calls, 0.9)
+    st = calls.t.state
+    assert 4 <= st.n_fail == st.n_run == st.fail_count <= 5
+
+
+@pytest.mark.trio
+async def test_probe(make_cfg, setup, failing):
+    # "bad" fails: its sibling on link "a" is run soon, the one on "b" is not
+    cfg = make_cfg(dict(sched=dict(probe=0.3), links=LINKS, calls=dict(
+        bad=call(5), sib=call(5), other=call(5, src="b"))))
+    links, calls = setup(cfg)
+    async with anyio.create_task_group() as tg:
+        await tg.spawn(run_sched, Scheduler(None, cfg.sched), calls, 0.8)
+        await anyio.sleep(0.2)
+        failing.add("bad")
+        await calls.bad.test_start()
+    assert calls.bad.state.fail_count == 1
+    assert calls.sib.state.n_run == 2
+    assert calls.other.state.n_run == 1
+
+
+@pytest.mark.trio
+async def test_confirm(make_cfg, setup, failing):
+    # once two tests on a link fail, only one of them keeps retrying
+    failing.update(("x", "y", "z"))
+    cfg = make_cfg(dict(sched=dict(probe=0, confirm=2), links=LINKS, calls=dict(
+        x=call(5, retry=0.1), y=call(5, retry=0.1), z=call(5, retry=0.1))))
+    links, calls = setup(cfg)
+    await run_sched(Scheduler(None, cfg.sched), calls, 1)
+    runs = sorted(c.state.n_run for c in calls.values())
+    assert runs[:2] == [1, 1]
+    assert runs[2] >= 7
+
+
+@pytest.mark.trio
+async def test_budget(make_cfg, setup, failing):
+    cfg = make_cfg(dict(calls=dict(t=call(0.05), u=call(0.05, src="b")),
+        links=dict(LINKS, **{":default:": dict(budget=3)})))
+    links, calls = setup(cfg)
+    await run_sched(Scheduler(None, cfg.sched), calls, 0.6)
+    assert calls.t.state.n_run == 3
+    assert calls.u.state.n_run == 3
+    assert links.a.stats.calls_hour == 3
+    assert links.a.budget_wait() > 3000
+
+
+@pytest.mark.trio
+async def test_fake(make_cfg, setup, backends):
+    # the real thing
+    cfg = make_cfg(dict(links=LINKS, calls=dict(
+        t=dict(src="a", dst="b", mode="call", test=dict(repeat=0.3, retry=0.3)))))
+    links, calls = setup(cfg)
+    async with backends(cfg, links, calls) as b:
+        await run_sched(Scheduler(b, cfg.sched), calls, 2)
+    st = calls.t.state
+    assert st.n_run >= 2
+    assert st.n_fail == 0
+    assert st.fail_map == []
@@ -0,0 +1,186 @@
+"""
+The web API.
+"""
+
+import anyio
+import json
+import pytest
+
+from calltest.server import make_app, _WSClient
+from calltest.status import StateVersions
+from calltest.util import attrdict
+
+
+@pytest.fixture
+async def app(make_cfg, setup, tmp_path):
+    """
+    Returns the app for a test "t", its callbacks, and the test.
+    """
+    cfg = make_cfg(dict(
+        links=dict(a=dict(channel="Fake/a/{number}", number="101")),
+        calls=dict(t=dict(src="a", number="555", mode="ring"))),
+        "history.file=%r" % str(tmp_path / "hist"), "server.ws.interval=0.01")
+    links, calls = setup(cfg)
+    calls.t.setup_state()
+    return make_app(cfg, calls, links) + (calls.t,)
+
+
+@pytest.mark.trio
+async def test_history(app):
+    app, updated, _, t = app
+    for ts in (10, 100000, 150000):
+        t.state.update(t_stop=ts, fail_count=0, phases=dict(total=1))
+        await updated(t)
+    client = app.test_client()
+
+    async def get(query):
+        r = await client.get("/test/t/history?" + query)
+        return [x["t"] for x in await r.get_json()]
+    assert await get("from=0&to=200000") == [10, 100000, 150000]
+    assert await get("to=200000") == [150000]  # the day before
+    assert await get("from=50&to=100000") == [100000]
+
+
+
+
+@pytest.mark.trio
+async def test_list(app):
+    app, updated, _, t = app
+    client = app.test_client()
+
+    async def get(path):
+        return await (await client.get(path)).get_json()
+    await updated(t)
+    assert (await get("/list"))["n_ok"] == 0  # not run yet
+    t.state.update(n_run=1, fail_count=0)
+    await updated(t)
+    assert (await get("/list"))["ok"] == ["t"]
+    t.state.update(n_run=2, fail_count=t.test.fail)
+    await updated(t)
+    res = await get("/")
+    assert (res["fail"], res["n_fail"], res["n_ok"]) == (["t"], 1, 0)
+    assert "ok" not in res
+
+
+@pytest.mark.trio
+async def test_ws(app):
+    app, updated, _, t = app
+    await updated(t)
+    async with app.test_client().websocket("/ws") as ws:
+        msg = json.loads(await ws.receive())
+        assert msg["action"] == "snapshot"
+        assert msg["states"]["t"]["n_run"] == 0
+        t.state.update(n_run=1)
+        await updated(t)
+        msg = json.loads(await ws.receive())
+        assert msg["items"] == [dict(action="update", name="t", version=msg["version"], state=dict(n_run=1))]
+
+
+class Sock:
+    """
+    Collects what a websocket client is sent. Blocks while ``stuck``.
+    """
+    stuck = False
+
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, data):
+        while self.stuck:
+            await anyio.sleep(1)
+        self.sent.append(json.loads(data))
+
+
+@pytest.fixture
+async def ws(nursery):
+    """
+    A websocket client, running, with a snapshot of tests "a" and "b"
+    already sent.
+    """
+    vs = StateVersions()
+    vs.update("a", dict(x=1, n=0))
+    vs.update("b", dict(x=1, n=0))
+    sock = Sock()
+    client = _WSClient(sock, attrdict(interval=0.01, max_pending=3, timeout=0.2), vs)
+    await client.snapshot()
+    nursery.start_soon(client.run)
+    await anyio.sleep(0.05)
+    assert sock.sent == [dict(action="snapshot", version=2,
+        states=dict(a=dict(x=1, n=0), b=dict(x=1, n=0)))]
+    del sock.sent[:]
+    return client, vs, sock
+
+
+@pytest.mark.trio
+async def test_ws_burst(ws):
+    # a burst of updates is sent as one batch, with the latest changes only
+    client, vs, sock = ws
+    for n in range(1, 6):
+        for name in "ab":
+            vs.update(name, dict(x=1, n=n))
+            await client.push(name)
+    vs.update("b", dict(n=5))
+    await client.push("b")
+    await anyio.sleep(0.05)
+    assert sock.sent == [dict(action="batch", version=13, items=[
+        dict(action="update", name="a", version=11, state=dict(n=5)),
+        dict(action="update", name="b", version=13, state=dict(n=5), deleted=["x"]),
+    ])]
+
+    # nothing changed, nothing sent
+    vs.update("a", dict(x=1, n=5))
+    await client.push("a")
+    await anyio.sleep(0.05)
+    assert len(sock.sent) == 1
+
+    vs.remove("a")
+    await client.push("a")
+    await anyio.sleep(0.05)
+    assert sock.sent[1] == dict(action="batch", version=14, items=[dict(action="delete", name="a")])
+
+
+@pytest.mark.trio
+async def test_ws_overflow(ws):
+    # too many queued tests: the client gets a snapshot instead
+    client, vs, sock = ws
+    for name in "abcde":
+        vs.update(name, dict(x=2))
+        await client.push(name)
+    await anyio.sleep(0.05)
+    assert sock.sent == [dict(action="snapshot", version=7,
+        states={name: dict(x=2) for name in "abcde"})]
+
+    # and continues with updates after that
+    vs.update("c", dict(x=3))
+    await client.push("c")
+    await anyio.sleep(0.05)
+    assert sock.sent[1]["items"] == [dict(action="update", name="c", version=8, state=dict(x=3))]
+
+
+@pytest.mark.trio
+async def test_ws_resync(ws):
+    # a client that reconnects gets what changed since the version it saw
+    client, vs, sock = ws
+    vs.update("b", dict(x=1, n=1))
+    await client.received(json.dumps(dict(action="resync", since=2)))
+    await client.received("garbage")
+    await anyio.sleep(0.05)
+    assert sock.sent == [dict(action="batch", version=3, items=[
+        dict(action="update", name="b", version=3, state=dict(n=1))])]
+
+    # ... unless we restarted
+    await client.received(json.dumps(dict(action="resync", since=99)))
+    await anyio.sleep(0.05)
+    assert sock.sent[1]["action"] == "snapshot"
+
+
+@pytest.mark.trio
+async def test_ws_drop():
+    # a client that doesn't accept data is dropped
+    sock = Sock()
+    sock.stuck = True
+    client = _WSClient(sock, attrdict(interval=0.01, max_pending=3, timeout=0.2), StateVersions())
+    await client.snapshot()
+    async with anyio.fail_after(1):
+        with pytest.raises(TimeoutError):
+            await client.run()
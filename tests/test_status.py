@@ -0,0 +1,94 @@
+"""
+The server's view of the tests' states.
+"""
+
+import json
+from types import SimpleNamespace
+
+from calltest.status import StatusIndex, StateVersions
+from calltest.util import attrdict
+
+
+def call(name, fail_count=0, n_run=1, fail_map=(), skip=False):
+    return SimpleNamespace(name=name,
+            state=attrdict(fail_count=fail_count, n_run=n_run, fail_map=list(fail_map)),
+            test=attrdict(fail=3, warn=1, skip=skip))
+
+
+def summary(idx, with_ok=True):
+    return json.loads(idx.summary(with_ok))
+
+
+def test_index():
+    idx = StatusIndex()
+    assert summary(idx) == dict(fail=[], warn=[], note=[], ok=[], skip=[],
+            n_fail=0, n_warn=0, n_note=0, n_ok=0, n_skip=0)
+
+    assert idx.update(call("a"))
+    assert idx.update(call("b", n_run=0, skip=True))
+    assert idx.update(call("c", fail_count=1))
+    assert not idx.update(call("a"))  # same buckets
+    s = summary(idx)
+    assert (s["ok"], s["skip"], s["warn"]) == (["a"], ["b"], ["c"])
+    assert (s["n_ok"], s["n_skip"], s["n_warn"], s["n_fail"]) == (1, 1, 1, 0)
+    # without the long lists
+    assert summary(idx, False) == dict(fail=[], warn=["c"], note=[],
+            n_fail=0, n_warn=1, n_note=0, n_ok=1)
+
+    # tests move between buckets as they fail and recover
+    idx.update(call("a", fail_count=3))
+    idx.update(call("c", fail_map=[True]))
+    s = summary(idx)
+    assert (s["fail"], s["warn"], s["note"], s["ok"]) == (["a"], [], ["c"], ["c"])
+    assert (s["n_fail"], s["n_warn"], s["n_note"], s["n_ok"]) == (1, 0, 1, 1)
+
+    idx.remove("c")
+    idx.remove("nope")
+    s = summary(idx)
+    assert (s["note"], s["ok"], s["n_ok"]) == ([], [], 0)
+    assert s["fail"] == ["a"]
+
+
+def test_versions():
+    vs = StateVersions()
+    assert vs.update("a", dict(x=1, y=[1])) == 1
+    assert vs.update("b", dict(x=1)) == 2
+    assert vs.update("a", dict(x=1, y=[1])) is None  # unchanged
+    assert vs.version == 2
+
+    y = [1, 2]
+    assert vs.update("a", dict(x=1, y=y)) == 3
+    y.append(3)  # copied
+    assert vs.delta("a") == (dict(x=1, y=[1, 2]), [])
+    assert vs.delta("a", 1) == (dict(y=[1, 2]), [])
+    assert vs.delta("a", 3) == ({}, [])
+
+    # fields that vanish are reported as deleted, once
+    assert vs.update("a", dict(y=[1, 2])) == 4
+    assert vs.delta("a", 3) == ({}, ["x"])
+    assert vs.delta("a", 2) == (dict(y=[1, 2]), ["x"])
+    assert vs.update("a", dict(y=[1, 2])) is None
+    assert vs.update("a", dict(x=2, y=[1, 2])) == 5
+    assert vs.delta("a", 4) == (dict(x=2), [])
+
+    assert vs.version_of("a") == 5
+    assert vs.version_of("b") == 2
+    assert vs.snapshot() == dict(a=dict(x=2, y=[1, 2]), b=dict(x=1))
+
+
+def test_versions_remove():
+    vs = StateVersions()
+    vs.update("a", dict(x=1))
+    vs.update("b", dict(x=1))
+    vs.remove("a")
+    # the removal counts as a change, so listeners notice it
+    assert vs.version == 3
+    assert "a" not in vs
+    assert list(vs) == ["b"]
+    assert vs.version_of("a") == 0
+    assert vs.delta("a") == ({}, [])
+    assert vs.snapshot() == dict(b=dict(x=1))
+
+    # a test that's added again starts over
+    assert vs.update("a", dict(y=1)) == 4
+    assert vs.delta("a") == (dict(y=1), [])
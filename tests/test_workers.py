@@ -0,0 +1,181 @@
+"""
+Running the tests in worker processes.
+"""
+
+import anyio
+import os
+import pytest
+import subprocess
+import sys
+
+from calltest import workers
+from calltest.workers import _Worker, _env, partition
+
+LINKS = dict(
+    a=dict(channel="Fake/a/{number}", number="101", worker=1),
+    b=dict(channel="Fake/b/{number}", number="102"),
+    c=dict(channel="Fake/c/{number}", number="103"),
+    d=dict(channel="Fake/d/{number}", number="104"),
+)
+
+
+@pytest.mark.trio
+async def test_partition(make_cfg, setup):
+    cfg = make_cfg(dict(links=LINKS, calls=dict(
+        ab=dict(src="a", dst="b"),
+        c1=dict(src="c", number="555", mode="ring"),
+        c2=dict(src="c", number="556", mode="ring"),
+        d=dict(dst="d", mode="answer"),
+    )))
+    links, calls = setup(cfg)
+    parts = partition(calls.values(), links.values(), 2)
+    assert sorted(l.name for l in parts[1][0]) == ["a", "b", "d"]
+    assert sorted(l.name for l in parts[0][0]) == ["c"]
+    assert sorted(c.name for c in parts[0][1]) == ["c1", "c2"]
+    with pytest.raises(ValueError):
+        partition(calls.values(), links.values(), 1)
+
+
+def test_env(monkeypatch):
+    # "python -m calltest.workers" must work from anywhere
+    monkeypatch.delenv("PYTHONPATH", raising=False)
+    out = subprocess.run([sys.executable, "-c", "import calltest; print(calltest.__file__)"],
+            env=_env(), cwd="/", stdout=subprocess.PIPE, check=True).stdout.decode()
+    assert out.strip() == os.path.abspath(workers.__file__.replace("workers.py", "__init__.py"))
+
+
+class Conn:
+    sent = ()
+
+    async def send(self, **msg):
+        self.sent += (msg,)
+
+
+@pytest.mark.trio
+async def test_request(monkeypatch):
+    monkeypatch.setattr(workers, "START_TIMEOUT", 0.1)
+    w = _Worker(0)
+    # not started
+    assert await w.request("start", "t") is False
+
+    conn = Conn()
+    await w.connected(conn)
+    async with anyio.create_task_group() as tg:
+        async def answer():
+            await anyio.sleep(0.05)
+            await w._result(workers.attrdict(seq=conn.sent[0]["seq"], result=True))
+        await tg.spawn(answer)
+        assert await w.request("start", "t") is True
+    assert conn.sent[0]["action"] == "start"
+
+    # the worker dies while it's processing a request
+    async with anyio.create_task_group() as tg:
+        await tg.spawn(w.disconnected, Conn())  # stale, ignored
+        async def die():
+            await anyio.sleep(0.05)
+            await w.disconnected(conn)
+        await tg.spawn(die)
+        assert await w.request("stop", "t") is False
+    assert not w._pending
+    assert await w.request("start", "t") is False
+
+
+def _start(cmd):
+    procs = []
+
+    def start(self, path):
+        procs.append(subprocess.Popen([sys.executable, "-c", cmd]))
+        return procs[-1]
+    return start, procs
+
+
+@pytest.mark.trio
+async def test_restart(monkeypatch):
+    start, procs = _start("import sys; sys.exit(3)")
+    monkeypatch.setattr(_Worker, "_start", start)
+    monkeypatch.setattr(workers, "RESTART", 0.1)
+    async with anyio.move_on_after(1):
+        await _Worker(0).run("/nonexistent")
+    assert len(procs) >= 4
+    assert all(p.returncode is not None for p in procs)
+
+
+@pytest.mark.trio
+async def test_stop(monkeypatch):
+    # the worker is terminated and reaped
+    start, procs = _start("import time; time.sleep(30)")
+    monkeypatch.setattr(_Worker, "_start", start)
+    async with anyio.move_on_after(0.5):
+        await _Worker(0).run("/nonexistent")
+    assert len(procs) == 1
+    assert procs[0].returncode == -15
+
+
+@pytest.mark.trio
+async def test_kill(monkeypatch):
+    # ... or killed if it doesn't want to
+    start, procs = _start("import signal, time; signal.signal(signal.SIGTERM, signal.SIG_IGN); time.sleep(30)")
+    monkeypatch.setattr(_Worker, "_start", start)
+    monkeypatch.setattr(workers, "STOP_TIMEOUT", 0.2)
+    async with anyio.move_on_after(0.5):
+        await _Worker(0).run("/nonexistent")
+    assert procs[0].returncode == -9
+
+
+@pytest.mark.trio
+async def test_reload(make_cfg, setup, monkeypatch):
+    from calltest import server
+    from calltest.server import serve
+
+    monkeypatch.setattr(workers, "RESTART", 0.1)
+
+    apps = []
+    make_app = server.make_app
+
+    def capture(cfg, checks, links, reload=None):
+        apps.append((checks, reload))
+        return make_app(cfg, checks, links, reload=reload)
+    monkeypatch.setattr(server, "make_app", capture)
+
+    test = dict(mode="ring", test=dict(repeat=0.2, retry=0.2))
+    ab = dict(a=LINKS["a"], b=LINKS["b"])
+    conf = ("server.port=0", "sched.spread=0")
+    cfg = make_cfg(dict(links=ab, calls=dict(
+        t=dict(test, src="a", number="555"), u=dict(test, src="b", number="556"))), *conf)
+    new = [make_cfg(dict(links=ab, calls=dict(
+        t=dict(test, src="a", number="555", timeout=2), v=dict(test, src="b", number="557"))), *conf)]
+
+    links, calls = setup(cfg)
+    async with anyio.create_task_group() as tg:
+        await tg.spawn(serve, cfg, calls, links, 2, lambda: new[0])
+        await anyio.sleep(2)
+        checks, reload = apps[0]
+        t = checks["t"]
+        w_t, w_u = t.worker, checks["u"].worker
+        assert w_t is not w_u
+        n = t.state.n_run
+        assert n >= 2
+
+        assert await reload() == dict(added=["v"], removed=["u"], changed=["t"], links=[])
+        assert sorted(checks) == ["t", "v"]
+        assert checks["v"].worker is w_u  # it has link b
+        assert w_u.calls == ["v"]
+        assert checks["t"].state.n_run >= n  # kept
+        await anyio.sleep(1)
+        assert checks["t"].state.n_run >= n+2
+        assert checks["t"].state.timeout == 2
+        assert checks["v"].state.n_run >= 2
+
+        # a worker that restarts gets the new configuration
+        w_u.proc.kill()
+        await anyio.sleep(2)
+        n = checks["v"].state.n_run
+        await anyio.sleep(0.5)
+        assert checks["v"].state.n_run > n
+
+        # a test can't join links of different workers
+        new[0] = make_cfg(dict(links=ab, calls=dict(t=dict(test, src="a", dst="b"))), *conf)
+        with pytest.raises(ValueError, match="different workers"):
+            await reload()
+        assert sorted(checks) == ["t", "v"]
+        await tg.cancel_scope.cancel()